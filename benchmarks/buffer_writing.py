@@ -0,0 +1,94 @@
+"""Peak memory of writing the binary buffer of a GLTF file.
+
+    python benchmarks/buffer_writing.py [--vertices N] [--shapes N]
+
+Makes --shapes synthetic shapes of --vertices vertices each and writes them to a .bin file
+three ways, each in a fresh process:
+
+- copy: all shapes are kept until the end, then written with a tobytes() copy of every array
+- zero-copy: all shapes are kept until the end, then written with gltf_builder.write_buffers
+- streaming: every shape is added to a GLTFFile, which writes it to the .bin file straight
+  away, and dropped before the next one is made
+
+Prints the peak resident set size of the process once the shapes are made and once they are
+written, measured with getrusage (Unix only).
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geometry import vertex_array
+from gltf_builder import GLTFFile, write_buffers
+
+MODES = ("copy", "zero-copy", "streaming")
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB, Linux reports KB and macOS bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def make_shape(vertices, shape):
+    """Vertex and index arrays of a shape. They are filled in place, temporaries would raise
+    the peak and hide what writing adds to it."""
+    vertex_dtype = vertex_array(*(np.zeros((0, columns)) for columns in (3, 3, 4, 2, 4))).dtype
+    vertex_data = np.empty(vertices, dtype=vertex_dtype)
+    vertex_data.view(np.uint8).fill(shape + 1)
+    indices = np.empty(vertices * 2 * 3, dtype=np.uint32)
+    indices.fill(shape)
+    return vertex_data, indices
+
+
+def write_copies(f, buffers):
+    for buffer in buffers:
+        f.write(buffer.tobytes())
+
+
+def run(mode, vertices, shapes):
+    with tempfile.TemporaryDirectory() as folder:
+        bin_path = os.path.join(folder, "benchmark.bin")
+        start = time.perf_counter()
+        if mode == "streaming":
+            gltf = GLTFFile("benchmark", os.path.join(folder, "benchmark.gltf"), bin_path)
+            for shape in range(shapes):
+                gltf.add_geometry(*make_shape(vertices, shape), "shape" + str(shape), None)
+            made = peak_rss()
+            gltf.save()
+        else:
+            buffers = [array for shape in range(shapes) for array in make_shape(vertices, shape)]
+            made = peak_rss()
+            with open(bin_path, "wb", buffering=0) as f:
+                if mode == "copy":
+                    write_copies(f, buffers)
+                else:
+                    write_buffers(f, buffers)
+        seconds = time.perf_counter() - start
+        size = os.path.getsize(bin_path)
+    print(mode + ": " + "{:.1f}".format(size / 2 ** 20) + " MB made and written in " +
+          "{:.1f}".format(seconds * 1000) + " ms, peak RSS " + "{:.1f}".format(made) + " MB once made, " +
+          "{:.1f}".format(peak_rss()) + " MB once written")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the peak memory of binary buffer writing.")
+    parser.add_argument("--vertices", type=int, default=1000000, help="vertices per synthetic shape")
+    parser.add_argument("--shapes", type=int, default=4, help="number of synthetic shapes")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.vertices, args.shapes)
+    else:
+        # every mode in its own process, the peak RSS of a process never goes down
+        for mode in MODES:
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--mode", mode,
+                            "--vertices", str(args.vertices), "--shapes", str(args.shapes)], check=True)
@@ -0,0 +1,98 @@
+"""Throughput of the native DDS decoder against the vips.exe subprocess path.
+
+    python benchmarks/dds_throughput.py <folder with dds files> [--limit N] [--vips PATH]
+
+Every DDS below the folder (up to --limit) is converted to PNG in a temporary folder,
+once with dds.DDSFile and once with one vips process per image like main.py used to.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess as sp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dds import DDSFile, DDSError
+
+
+def find_dds_files(folder, limit):
+    result = []
+    for dirpath, dirs, files in os.walk(folder):
+        for file in sorted(files):
+            if file.lower().endswith(".dds"):
+                result.append(os.path.join(dirpath, file))
+                if len(result) >= limit:
+                    return result
+    return result
+
+
+def run_native(files, out_folder):
+    pixels = 0
+    failed = 0
+    start = time.perf_counter()
+    for idx, path in enumerate(files):
+        try:
+            dds = DDSFile(path)
+            dds.save_png(os.path.join(out_folder, str(idx) + ".png"))
+            pixels += dds.width * dds.height
+        except DDSError:
+            failed += 1
+    return time.perf_counter() - start, pixels, failed
+
+
+def run_vips(files, out_folder, vips):
+    failed = 0
+    start = time.perf_counter()
+    for idx, path in enumerate(files):
+        if sp.call([vips, "affine", path, os.path.join(out_folder, str(idx) + ".png"), " 1 0 0 1"]) != 0:
+            failed += 1
+    return time.perf_counter() - start, failed
+
+
+def report(name, seconds, count, megabytes, pixels=None):
+    line = "{:<8} {:8.2f}s {:8.1f} images/s {:8.1f} MB/s".format(name, seconds, count / seconds, megabytes / seconds)
+    if pixels is not None:
+        line += " {:8.1f} Mpixel/s".format(pixels / seconds / 1e6)
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DDS to PNG conversion.")
+    parser.add_argument("folder", help="folder that is searched for DDS files")
+    parser.add_argument("--limit", type=int, default=200, help="maximum number of files to convert")
+    # the bundled vips.exe only runs on Windows, elsewhere vips is looked up on the PATH
+    bundled = os.name == "nt" and os.path.isfile("vips/vips.exe")
+    default_vips = "vips/vips.exe" if bundled else shutil.which("vips")
+    parser.add_argument("--vips", default=default_vips, help="vips executable for the subprocess path")
+    args = parser.parse_args()
+
+    files = find_dds_files(args.folder, args.limit)
+    if not files:
+        print("No DDS files found in " + args.folder)
+        return
+    megabytes = sum(os.path.getsize(path) for path in files) / (1 << 20)
+    print("Converting " + str(len(files)) + " DDS files ({:.1f} MB)".format(megabytes))
+
+    with tempfile.TemporaryDirectory() as out_folder:
+        seconds, pixels, failed = run_native(files, out_folder)
+        report("native", seconds, len(files) - failed, megabytes, pixels)
+        if failed:
+            print("    " + str(failed) + " files use unsupported formats")
+
+    if args.vips:
+        with tempfile.TemporaryDirectory() as out_folder:
+            try:
+                seconds, failed = run_vips(files, out_folder, args.vips)
+            except OSError as err:
+                print("can't run " + args.vips + " (" + str(err) + "), skipping the subprocess path")
+                return
+            report("vips", seconds, len(files) - failed, megabytes)
+    else:
+        print("vips not found, skipping the subprocess path")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Per element against bulk extraction of NIF geometry into numpy arrays.
+
+    python benchmarks/geometry_extraction.py [<folder with nif files>] [--limit N] [--vertices N]
+
+With a folder every NiTriShape and NiTriStrips below it (up to --limit files) is extracted
+twice, once the way read_geometry_object used to build its arrays and once with
+geometry.extract_geometry. Without a folder a synthetic shape with --vertices vertices is used.
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyffi.formats.nif import NifFormat
+
+from geometry import extract_geometry
+
+
+def extract_per_element(data):
+    """The python loops read_geometry_object used before the bulk path, without the padding."""
+    vertices = np.array([vertex.as_tuple() for vertex in data.vertices], dtype=tuple)
+    triangles = []
+    for tri in data.get_triangles():
+        triangles.append(tri[0])
+        triangles.append(tri[1])
+        triangles.append(tri[2])
+    triangles = np.array(triangles, dtype=np.uint32)
+    normals = np.array([tuple(np.array([n.x, n.y, n.z])) for n in data.normals], dtype=tuple)
+    tangents = np.array([tangent.as_tuple() + (1.0,) for tangent in data.tangents], dtype=tuple)
+    uvs = np.array([uv.as_list() for uv in data.uv_sets[0]]) if len(data.uv_sets) else np.zeros((0, 2))
+    colors = np.array([(col.r, col.g, col.b, 1.0) for col in data.vertex_colors], dtype=tuple)
+    return vertices, normals, tangents, uvs, colors, triangles
+
+
+def synthetic_shape(vertex_count):
+    data = NifFormat.NiTriShapeData()
+    rng = np.random.default_rng(0)
+    data.num_vertices = vertex_count
+    data.has_vertices = True
+    data.has_normals = True
+    # tangent and bitangent arrays follow the normals
+    data.extra_vectors_flags = 16
+    data.has_vertex_colors = True
+    data.has_uv = True
+    data.num_uv_sets = 1
+    for name in ("vertices", "normals", "tangents", "bitangents", "vertex_colors", "uv_sets"):
+        getattr(data, name).update_size()
+    values = rng.random((vertex_count, 4))
+    for idx in range(vertex_count):
+        x, y, z, w = values[idx]
+        for vector in (data.vertices[idx], data.normals[idx], data.tangents[idx]):
+            vector.x, vector.y, vector.z = x, y, z
+        color = data.vertex_colors[idx]
+        color.r, color.g, color.b, color.a = x, y, z, w
+        uv = data.uv_sets[0][idx]
+        uv.u, uv.v = x, y
+    # the triangle count is stored as an unsigned short
+    triangle_count = min(2 * vertex_count, 65535)
+    data.num_triangles = triangle_count
+    data.num_triangle_points = 3 * triangle_count
+    data.has_triangles = True
+    data.triangles.update_size()
+    indices = rng.integers(0, vertex_count, (triangle_count, 3))
+    for triangle, (v_1, v_2, v_3) in zip(data.triangles, indices):
+        triangle.v_1, triangle.v_2, triangle.v_3 = int(v_1), int(v_2), int(v_3)
+    return data
+
+
+def nif_shapes(folder, limit):
+    count = 0
+    for dirpath, dirs, files in os.walk(folder):
+        for file in sorted(files):
+            if not file.lower().endswith(".nif"):
+                continue
+            data = NifFormat.Data()
+            with open(os.path.join(dirpath, file), "rb") as stream:
+                try:
+                    data.read(stream)
+                except Exception as err:
+                    print("skipping " + file + ": " + str(err))
+                    continue
+            for block in data.blocks:
+                if isinstance(block, NifFormat.NiTriBasedGeomData) and len(block.vertices):
+                    yield file, block
+            count += 1
+            if count >= limit:
+                return
+
+
+def compare(label, data):
+    start = time.perf_counter()
+    before = extract_per_element(data)
+    before_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    after = extract_geometry(data)
+    after_seconds = time.perf_counter() - start
+
+    for name, old, new in zip(("positions", "normals", "tangents", "texcoords", "colors", "indices"),
+                              before, after):
+        if len(old) and not np.allclose(np.asarray(old.tolist(), dtype=np.float64), new):
+            print("  mismatch in " + name + " of " + label)
+    return len(after[0]), before_seconds, after_seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NIF geometry extraction.")
+    parser.add_argument("folder", nargs="?", help="folder with nif files, a synthetic shape is used without it")
+    parser.add_argument("--limit", type=int, default=100, help="the maximum number of nif files to read")
+    parser.add_argument("--vertices", type=int, default=60000, help="vertices of the synthetic shape")
+    args = parser.parse_args()
+
+    if args.folder:
+        shapes = nif_shapes(args.folder, args.limit)
+    else:
+        shapes = [("synthetic", synthetic_shape(args.vertices))]
+
+    vertices = 0
+    before_total = 0.0
+    after_total = 0.0
+    for label, data in shapes:
+        count, before_seconds, after_seconds = compare(label, data)
+        vertices += count
+        before_total += before_seconds
+        after_total += after_seconds
+        print(label + ": " + str(count) + " vertices, per element " + "{:.1f}".format(before_seconds * 1000) +
+              " ms, bulk " + "{:.1f}".format(after_seconds * 1000) + " ms")
+
+    print("total: " + str(vertices) + " vertices, per element " + "{:.2f}".format(before_total) + "s, bulk " +
+          "{:.2f}".format(after_total) + "s, " + "{:.1f}".format(before_total / after_total if after_total else 0.0) +
+          "x faster")
@@ -0,0 +1,80 @@
+"""Round trip and throughput of the EXT_meshopt_compression codecs in meshopt.py.
+
+    python benchmarks/meshopt_codec.py [--size N] [--quantize]
+
+Encodes the vertices and indices of a synthetic N x N grid shape, in the order the
+converter writes them with --optimize, decodes them again and checks the result. Prints the
+compression ratio and the encode and decode throughput of both codecs.
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import meshopt
+from geometry import vertex_array
+from gltf_builder import quantize_vertices
+from mesh_optimizer import optimize_mesh
+
+
+def grid_shape(size):
+    y, x = np.mgrid[0:size + 1, 0:size + 1].astype(np.float32) / size
+    count = (size + 1) * (size + 1)
+    positions = np.stack([x.ravel(), y.ravel(), np.sin(x * 6.0).ravel() * 0.1], axis=1)
+    normals = np.tile(np.array([0.0, 0.0, 1.0], dtype=np.float32), (count, 1))
+    tangents = np.tile(np.array([1.0, 0.0, 0.0, 1.0], dtype=np.float32), (count, 1))
+    colors = np.ones((count, 4), dtype=np.float32)
+    corners = (np.arange(size)[:, None] * (size + 1) + np.arange(size)[None, :]).ravel().astype(np.uint32)
+    indices = np.stack([corners, corners + 1, corners + size + 1,
+                        corners + 1, corners + size + 2, corners + size + 1], axis=1).ravel()
+    return vertex_array(positions, normals, tangents, positions[:, :2].copy(), colors), indices
+
+
+def measure(label, encode, decode, data, check):
+    start = time.perf_counter()
+    encoded = encode(data)
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = decode(encoded)
+    decode_seconds = time.perf_counter() - start
+    print(label + ": " + str(data.nbytes) + " -> " + str(len(encoded)) + " bytes, ratio " +
+          "{:.2f}".format(data.nbytes / len(encoded)) + ", encode " +
+          "{:.1f}".format(data.nbytes / encode_seconds / 1e6) + " MB/s, decode " +
+          "{:.1f}".format(data.nbytes / decode_seconds / 1e6) + " MB/s, round trip " +
+          ("ok" if check(decoded) else "FAILED"))
+
+
+def same_triangles(indices, decoded):
+    """The index codec may rotate triangles, compare them with their smallest index first."""
+    def canonical(triangles):
+        triangles = triangles.reshape(-1, 3)
+        first = np.argmin(triangles, axis=1)
+        rows = np.arange(len(triangles))
+        return np.stack([triangles[rows, (first + k) % 3] for k in range(3)], axis=1)
+    return np.array_equal(canonical(indices), canonical(decoded))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the EXT_meshopt_compression codecs.")
+    parser.add_argument("--size", type=int, default=150, help="quads per side of the synthetic grid")
+    parser.add_argument("--quantize", action="store_true", help="encode KHR_mesh_quantization vertices")
+    args = parser.parse_args()
+
+    vertex_data, indices = grid_shape(args.size)
+    vertex_data, indices, stats = optimize_mesh(vertex_data, indices)
+    if args.quantize:
+        vertex_data = quantize_vertices(vertex_data)[0]
+    stride = vertex_data.itemsize
+    indices = indices.astype(np.uint16 if len(vertex_data) <= 65535 else np.uint32)
+    vertex_bytes = vertex_data.view(np.uint8).reshape(len(vertex_data), stride)
+
+    measure("vertices", lambda data: meshopt.encode_vertex_buffer(data, stride),
+            lambda encoded: meshopt.decode_vertex_buffer(encoded, len(vertex_data), stride), vertex_bytes,
+            lambda decoded: np.array_equal(decoded, vertex_bytes))
+    measure("indices", meshopt.encode_index_buffer,
+            lambda encoded: meshopt.decode_index_buffer(encoded, len(indices)), indices,
+            lambda decoded: same_triangles(indices, decoded))
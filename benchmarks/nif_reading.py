@@ -0,0 +1,78 @@
+"""Full pyffi reading against nif_reader.read_geometry, which skips the blocks conversion doesn't use.
+
+    python benchmarks/nif_reading.py <folder with nif files> [--limit N]
+
+Every NIF below the folder (up to --limit files) is read twice, once with pyffi's Data.read
+and once with read_geometry. Prints the time and the peak memory allocated by each reader,
+as measured by tracemalloc, and how many blocks the lazy reader decoded.
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyffi.formats.nif import NifFormat
+
+import nif_reader
+
+
+def read_full(stream):
+    data = NifFormat.Data()
+    data.read(stream)
+    return data
+
+
+def measure(read, path):
+    """Seconds and peak traced bytes of one read, the result is dropped before returning."""
+    with open(path, "rb") as stream:
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = read(stream)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def nif_files(folder, limit):
+    count = 0
+    for dirpath, dirs, files in os.walk(folder):
+        for file in sorted(files):
+            if file.lower().endswith(".nif"):
+                yield os.path.join(dirpath, file)
+                count += 1
+                if count >= limit:
+                    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark lazy NIF block reading.")
+    parser.add_argument("folder", help="folder with nif files")
+    parser.add_argument("--limit", type=int, default=100, help="the maximum number of nif files to read")
+    args = parser.parse_args()
+
+    full_total = 0.0
+    lazy_total = 0.0
+    full_peak = 0
+    lazy_peak = 0
+    for path in nif_files(args.folder, args.limit):
+        try:
+            full_seconds, full_bytes, data = measure(read_full, path)
+            lazy_seconds, lazy_bytes, (data, stats) = measure(nif_reader.read_geometry, path)
+        except Exception as err:
+            print("skipping " + os.path.basename(path) + ": " + str(err))
+            continue
+        full_total += full_seconds
+        lazy_total += lazy_seconds
+        full_peak = max(full_peak, full_bytes)
+        lazy_peak = max(lazy_peak, lazy_bytes)
+        print(os.path.basename(path) + ": " + nif_reader.format_stats(stats) + ", full " +
+              "{:.1f}".format(full_seconds * 1000) + " ms " + "{:.1f}".format(full_bytes / 2 ** 20) + " MB, lazy " +
+              "{:.1f}".format(lazy_seconds * 1000) + " ms " + "{:.1f}".format(lazy_bytes / 2 ** 20) + " MB")
+
+    print("total: full " + "{:.2f}".format(full_total) + "s, lazy " + "{:.2f}".format(lazy_total) + "s, " +
+          "{:.1f}".format(full_total / lazy_total if lazy_total else 0.0) + "x faster, largest peak " +
+          "{:.1f}".format(full_peak / 2 ** 20) + " MB -> " + "{:.1f}".format(lazy_peak / 2 ** 20) + " MB")
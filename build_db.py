@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+# bump when the converter output changes in a way that should invalidate previous builds
+BUILD_FORMAT_VERSION = 1
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    """Content hash of a file, read in chunks so large textures don't have to fit in memory."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def options_key(options):
+    """Stable string for the conversion options that influence the output files."""
+    options = dict(options)
+    options["format"] = BUILD_FORMAT_VERSION
+    return json.dumps(options, sort_keys=True, separators=(",", ":"))
+
+
+class BuildDatabase:
+    """Records what every input was built from and what it produced.
+
+    Each row holds the input's content hash, the options used, the outputs written and,
+    for NIF files, the hashes of the textures the mesh referenced. A row is committed as
+    soon as its job finishes, so an interrupted batch resumes from where it stopped.
+
+    wal turns on SQLite's write-ahead log, which is faster but needs shared memory between
+    the connections, so it is only for databases that a single machine uses."""
+
+    path = ""
+    connection = None
+
+    def __init__(self, path, wal=False):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # the journal mode is stored in the file, a database used with wal before is switched back
+        self.connection.execute("PRAGMA journal_mode=" + ("WAL" if wal else "DELETE"))
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS builds ("
+            "path TEXT PRIMARY KEY, kind TEXT, size INTEGER, mtime REAL, hash TEXT, options TEXT, "
+            "outputs TEXT, dependencies TEXT, status TEXT, seconds REAL, updated REAL)")
+        self.connection.commit()
+        self.rows = {}
+        for row in self.connection.execute(
+                "SELECT path, kind, size, mtime, hash, options, outputs, dependencies, status, seconds FROM builds"):
+            self.rows[row[0]] = {
+                "kind": row[1],
+                "size": row[2],
+                "mtime": row[3],
+                "hash": row[4],
+                "options": row[5],
+                "outputs": json.loads(row[6]) if row[6] else [],
+                "dependencies": json.loads(row[7]) if row[7] else {},
+                "status": row[8],
+                "seconds": row[9],
+            }
+
+    def get(self, path):
+        return self.rows.get(path)
+
+    def known_hash(self, entry):
+        """Recorded hash of a manifest entry if its size and mtime are unchanged, without reading the file."""
+        row = self.rows.get(entry.path)
+        if row is not None and row["hash"] and row["size"] == entry.size and row["mtime"] == entry.mtime:
+            return row["hash"]
+        return None
+
+    def hash_for(self, entry, abspath):
+        """Hash of a manifest entry, reusing the recorded one when size and mtime are unchanged.
+        Returns None when the file was deleted or can't be read since the scan."""
+        content_hash = self.known_hash(entry)
+        if content_hash is not None:
+            return content_hash
+        try:
+            return file_hash(abspath)
+        except OSError:
+            return None
+
+    def outdated_reason(self, path, content_hash, options, dependency_hash=None):
+        """Why an input has to be (re)built, or None if its recorded build is still valid.
+
+        dependency_hash is called with each recorded dependency path and returns its current
+        hash, or None if the dependency no longer exists."""
+        row = self.rows.get(path)
+        if row is None:
+            return "new"
+        if row["status"] != "ok":
+            return "previous build failed"
+        if row["hash"] != content_hash:
+            return "source changed"
+        if row["options"] != options:
+            return "options changed"
+        for output in row["outputs"]:
+            if not os.path.isfile(output):
+                return "output missing"
+        if dependency_hash is not None:
+            for dependency, recorded_hash in row["dependencies"].items():
+                if dependency_hash(dependency) != recorded_hash:
+                    return "texture " + dependency + " changed"
+        return None
+
+    def record(self, entry, content_hash, options, outputs, dependencies=None, status="ok", seconds=0.0):
+        row = {
+            "kind": entry.kind,
+            "size": entry.size,
+            "mtime": entry.mtime,
+            "hash": content_hash,
+            "options": options,
+            "outputs": list(outputs),
+            "dependencies": {} if dependencies is None else dict(dependencies),
+            "status": status,
+            "seconds": seconds,
+        }
+        self.write_row(entry.path, row)
+        self.connection.commit()
+
+    def write_row(self, path, row):
+        self.rows[path] = row
+        self.connection.execute(
+            "INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, row["kind"], row["size"], row["mtime"], row["hash"], row["options"],
+             json.dumps(row["outputs"]), json.dumps(row["dependencies"]), row["status"], row["seconds"],
+             time.time()))
+
+    def merge(self, other):
+        """Copy every row of another build database into this one, in a single transaction."""
+        for path, row in other.rows.items():
+            self.write_row(path, row)
+        self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
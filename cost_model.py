@@ -0,0 +1,72 @@
+import math
+
+# used until a previous run has recorded enough timings to fit the rate
+DEFAULT_SECONDS_PER_MB = 0.5
+MIN_SAMPLES = 10
+
+
+class CostEstimator:
+    """Predicts how many seconds a conversion job takes.
+
+    A file that was converted before and hasn't changed size is predicted to take as long
+    as it took last time. Every other file is predicted from its size, with the seconds per
+    byte fitted to the successful builds of that kind in the build database. Predictions
+    are compared with the actual times as jobs finish, so the estimator can be tuned."""
+
+    def __init__(self, build_db=None, kind="nif"):
+        self.build_db = build_db
+        self.kind = kind
+        self.seconds_per_byte = DEFAULT_SECONDS_PER_MB / (1 << 20)
+        self.samples = 0
+        self.predicted = {}
+        self.observed = []
+
+        if build_db is not None:
+            rows = [row for row in build_db.rows.values()
+                    if row["kind"] == kind and row["status"] == "ok" and row["seconds"] and row["size"]]
+            if len(rows) >= MIN_SAMPLES:
+                self.samples = len(rows)
+                self.seconds_per_byte = sum(row["seconds"] for row in rows) / sum(row["size"] for row in rows)
+
+    def estimate(self, entry):
+        if self.build_db is not None:
+            row = self.build_db.get(entry.path)
+            if row is not None and row["status"] == "ok" and row["seconds"] and row["size"] == entry.size:
+                return row["seconds"]
+        return entry.size * self.seconds_per_byte
+
+    def order(self, entries):
+        """Entries sorted longest predicted job first, ties by path so the order is stable."""
+        for entry in entries:
+            self.predicted[entry.path] = self.estimate(entry)
+        return sorted(entries, key=lambda entry: (-self.predicted[entry.path], entry.path))
+
+    def observe(self, entry, seconds):
+        predicted = self.predicted.get(entry.path)
+        if predicted is None:
+            predicted = self.predicted[entry.path] = self.estimate(entry)
+        self.observed.append((predicted, seconds))
+        return predicted
+
+    def error(self):
+        """Mean absolute error and correlation between predicted and actual job times."""
+        if not self.observed:
+            return 0.0, 0.0
+        count = len(self.observed)
+        mean_error = sum(abs(predicted - actual) for predicted, actual in self.observed) / count
+        mean_predicted = sum(predicted for predicted, actual in self.observed) / count
+        mean_actual = sum(actual for predicted, actual in self.observed) / count
+        covariance = sum((predicted - mean_predicted) * (actual - mean_actual) for predicted, actual in self.observed)
+        spread = math.sqrt(sum((predicted - mean_predicted) ** 2 for predicted, actual in self.observed) *
+                           sum((actual - mean_actual) ** 2 for predicted, actual in self.observed))
+        return mean_error, covariance / spread if spread > 0 else 0.0
+
+    def summary(self):
+        predicted = sum(predicted for predicted, actual in self.observed)
+        actual = sum(actual for predicted, actual in self.observed)
+        mean_error, correlation = self.error()
+        source = ("fitted from " + str(self.samples) + " previous builds" if self.samples else "default rate")
+        return ("predicted " + "{:.1f}".format(predicted) + "s of work, actual " + "{:.1f}".format(actual) +
+                "s, mean error " + "{:.2f}".format(mean_error) + "s per job, correlation " +
+                "{:.2f}".format(correlation) + " (" + "{:.2f}".format(self.seconds_per_byte * (1 << 20)) +
+                " s/MB, " + source + ")")
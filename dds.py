@@ -0,0 +1,380 @@
+import sys
+import zlib
+import struct
+
+import numpy as np
+
+DDS_MAGIC = b"DDS "
+DDS_HEADER_SIZE = 124
+DX10_HEADER_SIZE = 20
+
+# pixel format flags
+DDPF_ALPHAPIXELS = 0x1
+DDPF_ALPHA = 0x2
+DDPF_FOURCC = 0x4
+DDPF_RGB = 0x40
+DDPF_LUMINANCE = 0x20000
+
+# block compressed formats, by fourcc and by DXGI format for files with a DX10 header
+BLOCK_FORMAT_BY_FOURCC = {
+    b"DXT1": "BC1",
+    b"DXT2": "BC2",
+    b"DXT3": "BC2",
+    b"DXT4": "BC3",
+    b"DXT5": "BC3",
+    b"ATI1": "BC4",
+    b"BC4U": "BC4",
+    b"BC4S": "BC4S",
+    b"ATI2": "BC5",
+    b"BC5U": "BC5",
+    b"BC5S": "BC5S",
+}
+
+BLOCK_FORMAT_BY_DXGI = {
+    70: "BC1", 71: "BC1", 72: "BC1",
+    73: "BC2", 74: "BC2", 75: "BC2",
+    76: "BC3", 77: "BC3", 78: "BC3",
+    79: "BC4", 80: "BC4", 81: "BC4S",
+    82: "BC5", 83: "BC5", 84: "BC5S",
+}
+
+BLOCK_SIZE_BY_FORMAT = {
+    "BC1": 8,
+    "BC2": 16,
+    "BC3": 16,
+    "BC4": 8,
+    "BC4S": 8,
+    "BC5": 16,
+    "BC5S": 16,
+}
+
+# uncompressed DXGI formats as (bit count, r mask, g mask, b mask, a mask, luminance)
+MASKS_BY_DXGI = {
+    27: (32, 0x000000ff, 0x0000ff00, 0x00ff0000, 0xff000000, False),
+    28: (32, 0x000000ff, 0x0000ff00, 0x00ff0000, 0xff000000, False),
+    29: (32, 0x000000ff, 0x0000ff00, 0x00ff0000, 0xff000000, False),
+    49: (16, 0x00ff, 0xff00, 0, 0, False),
+    61: (8, 0xff, 0, 0, 0, True),
+    65: (8, 0, 0, 0, 0xff, False),
+    87: (32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0xff000000, False),
+    88: (32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0, False),
+    90: (32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0xff000000, False),
+    91: (32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0xff000000, False),
+    92: (32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0, False),
+    93: (32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0, False),
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPE_BY_CHANNELS = {
+    1: 0,  # greyscale
+    2: 4,  # greyscale + alpha
+    3: 2,  # rgb
+    4: 6,  # rgba
+}
+
+
+class DDSError(Exception):
+    pass
+
+
+def unpack_565(colors):
+    """Expand packed RGB565 values to an (..., 3) array of 8 bit channels."""
+    colors = colors.astype(np.uint16)
+    r = (colors >> 11) & 31
+    g = (colors >> 5) & 63
+    b = colors & 31
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], axis=-1)
+
+
+def decode_color_blocks(blocks, punchthrough):
+    """Decode the 8 byte BC1 style colour part of every block to (n, 16, 4) RGBA.
+    punchthrough enables the 3 colour + transparent mode that only BC1 has."""
+    count = len(blocks)
+    c0 = blocks[:, 0].astype(np.uint16) | (blocks[:, 1].astype(np.uint16) << 8)
+    c1 = blocks[:, 2].astype(np.uint16) | (blocks[:, 3].astype(np.uint16) << 8)
+    p0 = unpack_565(c0).astype(np.int32)
+    p1 = unpack_565(c1).astype(np.int32)
+
+    four_colors = c0 > c1 if punchthrough else np.ones(count, dtype=bool)
+    four = four_colors[:, None]
+
+    palette = np.empty((count, 4, 4), dtype=np.uint8)
+    palette[:, 0, :3] = p0
+    palette[:, 1, :3] = p1
+    palette[:, 2, :3] = np.where(four, (2 * p0 + p1) // 3, (p0 + p1) // 2)
+    palette[:, 3, :3] = np.where(four, (p0 + 2 * p1) // 3, 0)
+    palette[:, :, 3] = 255
+    palette[:, 3, 3] = np.where(four_colors, 255, 0)
+
+    bits = np.ascontiguousarray(blocks[:, 4:8]).view("<u4").reshape(count, 1)
+    indices = (bits >> (2 * np.arange(16, dtype=np.uint32))) & 3
+    return palette[np.arange(count)[:, None], indices]
+
+
+def decode_explicit_alpha_blocks(blocks):
+    """Decode BC2 4 bit explicit alpha to (n, 16) 8 bit values."""
+    bits = np.ascontiguousarray(blocks[:, :8]).view("<u8").reshape(len(blocks), 1)
+    alpha = (bits >> (4 * np.arange(16, dtype=np.uint64))) & 15
+    return (alpha * 17).astype(np.uint8)
+
+
+def decode_interpolated_alpha_blocks(blocks, signed=False):
+    """Decode 8 byte BC3 alpha / BC4 blocks to (n, 16) values.
+    Unsigned blocks give 0..255, signed blocks give -127..127."""
+    count = len(blocks)
+    endpoints = blocks[:, :2].view(np.int8) if signed else blocks[:, :2]
+    a0 = endpoints[:, 0].astype(np.int32)[:, None]
+    a1 = endpoints[:, 1].astype(np.int32)[:, None]
+    if signed:
+        # -128 and -127 both mean -1.0
+        a0 = np.maximum(a0, -127)
+        a1 = np.maximum(a1, -127)
+
+    steps = np.arange(1, 7, dtype=np.int32)[None, :]
+    eight = (a0 > a1)
+    palette = np.empty((count, 8), dtype=np.int32)
+    palette[:, 0:1] = a0
+    palette[:, 1:2] = a1
+    eight_values = ((7 - steps) * a0 + steps * a1) // 7
+    six_values = ((5 - steps[:, :4]) * a0 + steps[:, :4] * a1) // 5
+    palette[:, 2:8] = eight_values
+    palette[:, 2:6] = np.where(eight, eight_values[:, :4], six_values)
+    palette[:, 6:7] = np.where(eight, eight_values[:, 4:5], -127 if signed else 0)
+    palette[:, 7:8] = np.where(eight, eight_values[:, 5:6], 127 if signed else 255)
+
+    packed = np.zeros((count, 8), dtype=np.uint8)
+    packed[:, :6] = blocks[:, 2:8]
+    bits = packed.view("<u8").reshape(count, 1)
+    indices = ((bits >> (3 * np.arange(16, dtype=np.uint64))) & 7).astype(np.intp)
+    return palette[np.arange(count)[:, None], indices]
+
+
+def snorm_to_unorm(values):
+    """Map signed -127..127 channel values to 0..255."""
+    return np.clip(np.round((values.astype(np.float32) + 127.0) * (255.0 / 254.0)), 0, 255).astype(np.uint8)
+
+
+def blocks_to_image(pixels, width, height):
+    """Rearrange (n, 16, c) block pixels into an (height, width, c) image."""
+    blocks_wide = (width + 3) // 4
+    blocks_high = (height + 3) // 4
+    channels = pixels.shape[-1]
+    image = pixels.reshape(blocks_high, blocks_wide, 4, 4, channels).transpose(0, 2, 1, 3, 4)
+    image = image.reshape(blocks_high * 4, blocks_wide * 4, channels)
+    return np.ascontiguousarray(image[:height, :width])
+
+
+def mask_channel(pixels, mask):
+    """Extract the bits selected by mask and scale them to 8 bits."""
+    shift = (mask & -mask).bit_length() - 1
+    maximum = mask >> shift
+    values = (pixels & np.uint32(mask)) >> np.uint32(shift)
+    if maximum == 255:
+        return values.astype(np.uint8)
+    return ((values.astype(np.uint32) * 255 + maximum // 2) // maximum).astype(np.uint8)
+
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+def filter_png_rows(pixels, chunk_rows=16):
+    """Apply PNG filtering with a per row choice between None, Sub, Up, Average and Paeth,
+    picking the filter with the smallest sum of absolute differences like libpng does.
+    Rows are filtered with numpy in small chunks that stay in cache."""
+    height, width, channels = pixels.shape
+    rows = pixels.reshape(height, width * channels)
+    filtered = np.empty((height, width * channels + 1), dtype=np.uint8)
+    for start in range(0, height, chunk_rows):
+        end = min(height, start + chunk_rows)
+        current = rows[start:end]
+        if start:
+            up = rows[start - 1:end - 1]
+        else:
+            up = np.concatenate([np.zeros_like(rows[:1]), rows[:end - 1]])
+        left = np.zeros_like(current)
+        left[:, channels:] = current[:, :-channels]
+        up_left = np.zeros_like(current)
+        up_left[:, channels:] = up[:, :-channels]
+
+        # paeth predictor, the distances need a wider type than the uint8 filter arithmetic
+        left_wide = left.astype(np.int16)
+        up_wide = up.astype(np.int16)
+        up_left_wide = up_left.astype(np.int16)
+        distance_left = np.abs(up_wide - up_left_wide)
+        distance_up = np.abs(left_wide - up_left_wide)
+        distance_up_left = np.abs(left_wide + up_wide - 2 * up_left_wide)
+        paeth = np.where((distance_left <= distance_up) & (distance_left <= distance_up_left), left,
+                         np.where(distance_up <= distance_up_left, up, up_left))
+
+        # uint8 arithmetic wraps modulo 256, which is exactly what the filters are defined as
+        candidates = np.stack([
+            current,
+            current - left,
+            current - up,
+            current - ((left >> 1) + (up >> 1) + (left & up & 1)),
+            current - paeth,
+        ])
+        # score each filtered row by the magnitude of its bytes read as signed values
+        scores = np.minimum(candidates, 0 - candidates).sum(axis=2, dtype=np.uint32)
+        choice = np.argmin(scores, axis=0)
+        filtered[start:end, 0] = choice
+        filtered[start:end, 1:] = candidates[choice, np.arange(end - start)]
+    return filtered
+
+
+def write_png(path, pixels, compression=6):
+    """Write an (height, width, channels) uint8 array as an 8 bit PNG."""
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, None]
+    height, width, channels = pixels.shape
+    header = struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPE_BY_CHANNELS[channels], 0, 0, 0)
+    data = zlib.compress(filter_png_rows(pixels).tobytes(), compression)
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        f.write(png_chunk(b"IHDR", header))
+        f.write(png_chunk(b"IDAT", data))
+        f.write(png_chunk(b"IEND", b""))
+
+
+class DDSFile:
+    """Reader for the DDS textures shipped with Skyrim.
+
+    Decodes the top mip level of BC1 to BC5 (DXT1/3/5, ATI1/2) and uncompressed mask
+    based formats with vectorised numpy block decoding. Cube maps and texture arrays
+    decode to their first face."""
+
+    width = 0
+    height = 0
+    format = ""
+    data = None
+
+    def __init__(self, path=None, data=None):
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        self.path = path
+        self.parse(data)
+
+    def parse(self, data):
+        if len(data) < 4 + DDS_HEADER_SIZE or data[:4] != DDS_MAGIC:
+            raise DDSError("not a DDS file")
+        header = struct.unpack_from("<31I", data, 4)
+        self.height = header[2]
+        self.width = header[3]
+        pf_flags, fourcc = header[19], data[84:88]
+        bit_count, r_mask, g_mask, b_mask, a_mask = header[21:26]
+        offset = 4 + DDS_HEADER_SIZE
+
+        self.masks = None
+        if pf_flags & DDPF_FOURCC and fourcc == b"DX10":
+            dxgi_format = struct.unpack_from("<I", data, offset)[0]
+            offset += DX10_HEADER_SIZE
+            if dxgi_format in BLOCK_FORMAT_BY_DXGI:
+                self.format = BLOCK_FORMAT_BY_DXGI[dxgi_format]
+            elif dxgi_format in MASKS_BY_DXGI:
+                self.format = "DXGI" + str(dxgi_format)
+                self.masks = MASKS_BY_DXGI[dxgi_format]
+            else:
+                raise DDSError("unsupported DXGI format " + str(dxgi_format))
+        elif pf_flags & DDPF_FOURCC:
+            if fourcc not in BLOCK_FORMAT_BY_FOURCC:
+                raise DDSError("unsupported fourcc " + repr(fourcc))
+            self.format = BLOCK_FORMAT_BY_FOURCC[fourcc]
+        elif pf_flags & (DDPF_RGB | DDPF_LUMINANCE | DDPF_ALPHA):
+            if not pf_flags & (DDPF_ALPHAPIXELS | DDPF_ALPHA):
+                a_mask = 0
+            self.format = "RGB" if pf_flags & DDPF_RGB else ("L" if pf_flags & DDPF_LUMINANCE else "A")
+            self.masks = (bit_count, r_mask, g_mask, b_mask, a_mask, bool(pf_flags & DDPF_LUMINANCE))
+        else:
+            raise DDSError("unsupported pixel format flags " + hex(pf_flags))
+
+        self.data = memoryview(data)[offset:]
+
+    def decode(self):
+        """Decode the top mip level to an (height, width, channels) uint8 array."""
+        if self.masks is not None:
+            return self.decode_uncompressed()
+
+        block_count = ((self.width + 3) // 4) * ((self.height + 3) // 4)
+        block_size = BLOCK_SIZE_BY_FORMAT[self.format]
+        if len(self.data) < block_count * block_size:
+            raise DDSError("truncated " + self.format + " data")
+        blocks = np.frombuffer(self.data, dtype=np.uint8, count=block_count * block_size).reshape(block_count,
+                                                                                                  block_size)
+        if self.format == "BC1":
+            pixels = decode_color_blocks(blocks, True)
+        elif self.format == "BC2":
+            pixels = decode_color_blocks(blocks[:, 8:], False)
+            pixels[:, :, 3] = decode_explicit_alpha_blocks(blocks)
+        elif self.format == "BC3":
+            pixels = decode_color_blocks(blocks[:, 8:], False)
+            pixels[:, :, 3] = decode_interpolated_alpha_blocks(blocks)
+        elif self.format in ("BC4", "BC4S"):
+            values = decode_interpolated_alpha_blocks(blocks, self.format == "BC4S")
+            values = snorm_to_unorm(values) if self.format == "BC4S" else values.astype(np.uint8)
+            pixels = values[:, :, None]
+        else:
+            signed = self.format == "BC5S"
+            x = decode_interpolated_alpha_blocks(blocks[:, :8], signed)
+            y = decode_interpolated_alpha_blocks(blocks[:, 8:], signed)
+            pixels = self.normal_from_xy(x, y, signed)
+        return blocks_to_image(pixels, self.width, self.height)
+
+    def normal_from_xy(self, x, y, signed):
+        """BC5 textures are tangent space normal maps, rebuild the blue channel from red and green."""
+        if signed:
+            fx = x.astype(np.float32) / 127.0
+            fy = y.astype(np.float32) / 127.0
+            r, g = snorm_to_unorm(x), snorm_to_unorm(y)
+        else:
+            fx = x.astype(np.float32) / 127.5 - 1.0
+            fy = y.astype(np.float32) / 127.5 - 1.0
+            r, g = x.astype(np.uint8), y.astype(np.uint8)
+        fz = np.sqrt(np.clip(1.0 - fx * fx - fy * fy, 0.0, 1.0))
+        b = np.clip(np.round((fz + 1.0) * 127.5), 0, 255).astype(np.uint8)
+        return np.stack([r, g, b], axis=-1)
+
+    def decode_uncompressed(self):
+        bit_count, r_mask, g_mask, b_mask, a_mask, luminance = self.masks
+        pixel_size = bit_count // 8
+        if pixel_size not in (1, 2, 3, 4):
+            raise DDSError("unsupported bit count " + str(bit_count))
+        count = self.width * self.height
+        if len(self.data) < count * pixel_size:
+            raise DDSError("truncated " + self.format + " data")
+        raw = np.frombuffer(self.data, dtype=np.uint8, count=count * pixel_size).reshape(count, pixel_size)
+
+        pixels = np.zeros(count, dtype=np.uint32)
+        for byte in range(pixel_size):
+            pixels |= raw[:, byte].astype(np.uint32) << np.uint32(8 * byte)
+
+        channels = []
+        if luminance:
+            # some writers put the luminance mask in the top byte, the value is always in the low bits
+            if r_mask >> bit_count:
+                r_mask = (1 << bit_count) - 1
+            channels.append(mask_channel(pixels, r_mask))
+        elif r_mask or g_mask or b_mask:
+            for mask in (r_mask, g_mask, b_mask):
+                channels.append(mask_channel(pixels, mask) if mask else np.zeros(count, dtype=np.uint8))
+        elif a_mask:
+            # alpha only texture, keep it visible as white with alpha
+            channels.append(np.full(count, 255, dtype=np.uint8))
+        if a_mask:
+            channels.append(mask_channel(pixels, a_mask))
+        return np.stack(channels, axis=-1).reshape(self.height, self.width, len(channels))
+
+    def save_png(self, path, compression=6):
+        write_png(path, self.decode(), compression)
+
+
+def convert_dds_to_png(dds_path, png_path, compression=6):
+    DDSFile(dds_path).save_png(png_path, compression)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python dds.py <input.dds> <output.png>")
+        sys.exit(1)
+    convert_dds_to_png(sys.argv[1], sys.argv[2])
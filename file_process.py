@@ -11,9 +11,17 @@ import numpy as np
 from colorama import Fore, Back, Style
 from wand import image
 from gltf_builder import GLTFFile
+from geometry import extract_geometry, sanitize_normals, vertex_array, bake_transforms
+from mesh_optimizer import optimize_mesh, optimize_vertex_cache, format_stats
+import meshopt
+import nif_reader
+import simplifier
+from texture_store import TextureStore
+from geometry_cache import GeometryCache
+from build_db import file_hash
 import argparse
 import subprocess as sp
-import math
+import time
 
 parser = argparse.ArgumentParser(description='Process a single NIF file.')
 parser.add_argument('Path',
@@ -38,8 +46,39 @@ parser.add_argument('OutFolder',
 
 parser.add_argument("-u","--unrealmode",action="store_true",help="Pipes the alpha state into the metalness parameter of the material as many Unreal GLTF importers dont support different types of transparency")
 
-args = parser.parse_args()
-print(args)
+parser.add_argument("--optimize",
+                       action="store_true",
+                       help='weld identical vertices and reorder triangles and vertices for the GPU vertex cache')
+
+parser.add_argument("--quantize",
+                       action="store_true",
+                       help='write 16 and 8 bit vertex attributes with KHR_mesh_quantization instead of 32 bit floats')
+
+parser.add_argument("--compress",
+                       action="store_true",
+                       help='compress vertex and index data with EXT_meshopt_compression')
+
+parser.add_argument("--lod",
+                       type=simplifier.parse_ratios,
+                       nargs="?",
+                       const=simplifier.DEFAULT_LOD_RATIOS,
+                       help='add MSFT_lod levels with these triangle ratios, 0.5,0.25,0.125 without a value')
+
+parser.add_argument("--gpu-instancing",
+                       action="store_true",
+                       help='draw shapes that repeat the same mesh with one EXT_mesh_gpu_instancing node')
+
+parser.add_argument("--geometry-cache",
+                       action="store_true",
+                       help='keep the extracted shapes in cache/geometry in the output folder and reuse them for unchanged NIF files')
+
+parser.add_argument("--flatten",
+                       action="store_true",
+                       help='bake shape transforms into the vertices and merge shapes with the same material into one mesh')
+
+parser.add_argument("--glb",
+                       action="store_true",
+                       help='write one binary .glb file instead of a .gltf and a .bin file')
 
 class NIFFile:
     filename = ""
@@ -60,13 +99,51 @@ class NIFFile:
 
     in_folder = ""
     out_folder = ""
+    unrealmode = False
+
+    # texture paths referenced by the converted shapes, relative to the texture root
+    texture_dependencies = None
+    texture_store = None
+
+    # vertices whose normal was zero or NaN in the source file
+    repaired_normals = 0
+    # vertices whose normal wasn't unit length, usually a packing error rather than a broken asset
+    rescaled_normals = 0
+
+    # weld and reorder shapes for the vertex cache, with the ACMR/ATVR of every optimised shape
+    optimize = False
+    optimize_stats = None
+    quantize = False
+    compress = False
+    compression_stats = None
+    lod = None
+    lod_stats = None
+    gpu_instancing = False
+    instanced_shapes = 0
+    # whether the shapes came from the geometry cache instead of the NIF
+    geometry_cached = False
+    # bake shape transforms into the vertices and merge shapes with the same material
+    flatten = False
+    flatten_stats = None
+    # write .glb files instead of .gltf and .bin
+    glb = False
+
+    def discard_gltf(self):
+        if self.gltf is not None:
+            self.gltf.discard()
+            self.gltf = None
 
     def save_gltf(self):
         self.gltf.save()
-        #glb = GLTF2().load(self.gltf_path)
-        #glb.convert_images(ImageFormat.DATAURI)  # convert images to data URIs.
-        #glb.convert_buffers(BufferFormat.BINARYBLOB)  # convert buffers to GLB blob
-        #glb.save_binary(self.gltf_path.replace(".gltf", ".glb"))
+        # None when the file has no geometry and so no .bin file
+        self.bin_path = self.gltf.bin_path
+        self.instanced_shapes += self.gltf.instanced_shapes
+        if self.gltf.instanced_shapes:
+            print(Fore.WHITE + "Shared meshes with " + str(self.gltf.instanced_shapes) + " repeated shapes in " +
+                  self.filename)
+        if self.compress:
+            self.compression_stats = self.gltf.compression_stats
+            print(Fore.WHITE + "Compressed " + self.filename + ": " + meshopt.format_stats(self.compression_stats))
         print(Back.GREEN + Fore.BLACK + "FILE PROCESSED: " + os.path.abspath(self.gltf_path))
 
     def set_parents(self, n_block):
@@ -87,6 +164,8 @@ class NIFFile:
         return v / norm
 
     def read_geometry_object(self, n_block, parent):
+        """Shape record of a geometry block, everything convert_shape needs without pyffi:
+        the extracted arrays, the final transform, texture paths and alpha flags."""
         ni_name = n_block.name.decode()
 
         # shortcut for mesh geometry data
@@ -109,143 +188,18 @@ class NIFFile:
 
             print(transform_matrix)
 
-            vertices = n_tri_data.vertices
-
-            normals = n_tri_data.normals
-            tangents = n_tri_data.tangents
-            uvs = n_tri_data.uv_sets
-            vertex_colors = n_tri_data.vertex_colors
-
-            # vertex_colors = np.array([(color.r, color.g, color.b, 1.0) for color in vertex_colors], dtype=tuple)
+            # bulk extraction straight into contiguous arrays, no per vertex python objects
+            vertices, normals, tangents, uvs, vertex_colors, triangles = extract_geometry(n_tri_data)
 
+            # texture paths relative to the texture root, resolved against the texture store on conversion
+            texture_paths = None
             try:
-                uvs = np.array([uv.as_list() for uv in uvs.get_item(0)])
-            except:
-                print(Fore.YELLOW + "No UV data present" + Fore.WHITE)
-
-            print(str(len(vertices)) + " before")
-            # buffer vertices
-            np_verts = []
-            for idx, vertex in enumerate(vertices):
-                np_verts.append(vertex.as_tuple())
-            #while (length % 3 != 0 or length % 4 != 0):
-            while (len(np_verts) % 12 != 0):
-                np_verts.append(np_verts[len(np_verts) - 1])
-            #while length % 3 != 0:
-            #    np_verts.append(np_verts[0])
-            np_verts = np.array(np_verts, dtype=tuple)
-            vertices = np_verts
-            print(str(len(np_verts)) + " after")
-
-            # buffer tris
-            print(str(len(n_tri_data.get_triangles())) + " before")
-            np_tris = []
-            for idx, tri in enumerate(n_tri_data.get_triangles()):
-                np_tris.append(tri[0])
-                np_tris.append(tri[1])
-                np_tris.append(tri[2])
-            #while length < len(vertices):
-            #    np_tris.append(np_tris[0])
-            #    length += 1
-            #while (length % 3 != 0 or length % 4 != 0):
-            while (len(np_tris) % 12 != 0):
-                np_tris.append(0)
-            np_tris = np.array(np_tris, dtype=np.uint16)
-            triangles = np_tris
-            print(str(len(np_tris)) + " after")
-
-            # buffer normals
-            np_normals = []
-            for idx, norm in enumerate(normals):
-                v = np.array([norm.x, norm.y, norm.z])
-                #sum = 0
-                #for f in v:
-                #    sum += f * f
-                #if abs(math.sqrt(sum) - 1) <= 0.1:
-                #    vu = np.array([0.0, 0.0, 1.0])
-                #else:
-                vu = v
-
-                np_normals.append(tuple((vu[0], vu[1], vu[2])))
-            while len(np_normals) < len(vertices):
-                np_normals.append(np_normals[0])
-            np_normals = np.array(np_normals, dtype=tuple)
-            normals = np_normals
-
-            # buffer tangents
-            np_tangents = []
-            for idx, tangent in enumerate(tangents):
-                np_tangents.append(tangent.as_tuple() + (1.0,))
-            while len(np_tangents) < len(vertices):
-                np_tangents.append(np_tangents[0])
-            np_tangents = np.array(np_tangents, dtype=tuple)
-            tangents = np_tangents
-
-            # buffer uvs
-            np_uvs = []
-            for idx, uv in enumerate(uvs):
-                np_uvs.append(uv)
-            while len(np_uvs) < len(vertices):
-                np_uvs.append(np_uvs[0])
-            #np_uvs = np.array(np_uvs, dtype=tuple)
-            uvs = np_uvs
-
-            # buffer vertex colors
-            np_vertcolors = []
-            length = 0
-            for idx, col in enumerate(vertex_colors):
-                length += 1
-                np_vertcolors.append((col.r, col.g, col.b, 1.0))
-            while len(np_vertcolors) < len(vertices):
-                np_vertcolors.append([1.0, 1.0, 1.0, 1.0])
-            np_vertcolors = np.array(np_vertcolors, dtype=tuple)
-            vertex_colors = np_vertcolors
-
-            # assemble into a gltf structure
-            vertex_data = np.ones(len(vertices), dtype=[
-                ("position", np.float32, 3),
-                ("normal", np.float32, 3),
-                ("tangent", np.float32, 4),
-                ("texCoord0", np.float32, 2),
-                ("color", np.float32, 4),
-            ])
-
-
-            # get textures for object
-            textures = []
-            imagemagicks = []
-            try:
+                texture_paths = []
                 for texture in n_block.bs_properties[0].texture_set.textures:
                     if texture.decode("utf-8") != "" and texture is not None:
-                        texture_file = os.path.normpath(os.path.join(self.texture_root, texture.decode("utf-8")))
-                        out_texture_file = os.path.join(os.path.abspath(self.out_folder), os.path.relpath(texture_file.replace(".dds", ".png").lower(), self.in_folder))
-
-
-                        # convert and copy textures to PNGs by the GLTF file
-                        # image = pyvips.Image.new_from_file(texture_file, access='sequential')
-                        # image.write_to_file(out_texture_file)
-                        # im = Image.open(texture_file)
-                        # im.save(out_texture_file, "PNG")
-                        #startupinfo = sp.STARTUPINFO()
-                        #startupinfo.dwFlags |= sp.STARTF_USESHOWWINDOW
-                        #imagemagick = sp.Popen(['imagemagick/convert.exe', texture_file, out_texture_file], startupinfo=startupinfo).pid
-                        #imagemagick = sp.Popen(['vips/vips.exe', "affine", texture_file, out_texture_file, ' 1 0 0 1'], startupinfo=startupinfo).pid
-                        #imagemagicks.append(imagemagick)
-                        #with image.Image(filename=texture_file) as img:
-                        #    img.compression = "no"
-                        #    img.save(filename=out_texture_file)
-
-                        #out_path = os.path.relpath(os.path.abspath(out_texture_file.replace("textures\\", "")), os.path.abspath(self.gltf_path))
-                        #textures.append(out_path[6:len(out_path)].replace("\\", "/"))
-                        textures.append(out_texture_file.replace("\\", "/"))
-                print(textures)
-                #while len(imagemagicks) > 0:
-                #    for p in imagemagicks:
-                #        if not psutil.pid_exists(p):
-                #            print(Fore.GREEN + "PID: [" + str(p) + "] Finished texture job")
-                #            imagemagicks.remove(p)
+                        texture_paths.append(texture.decode("utf-8").replace("\\", "/").strip("/").lower())
             except:
-                print(Fore.YELLOW + "No texture data present" + Fore.WHITE)
+                texture_paths = None
 
             # alpha flags
             alpha_threshold = 128
@@ -272,45 +226,149 @@ class NIFFile:
                 alpha_test = False
                 alpha_blend = False
 
-            print("printing lengths:")
-            print(len(vertices))
-            print(len(triangles))
-            print(len(normals))
-            print(len(tangents))
-            print(len(uvs))
-            print(len(vertex_colors))
-
-            #try:
-            vertex_data["position"] = vertices
-            vertex_data["normal"] = normals
-            vertex_data["tangent"] = tangents
-            vertex_data["texCoord0"] = uvs
-            vertex_data["color"] = vertex_colors
-            #except:
-            #    print("Could not load one or more attributes")
-
-            for idx, normal in enumerate(vertex_data['normal']):
-                vu = np.array([0.0, 0.0, 1.0])
-                sum = 0
-                for f in normal:
-                    sum += f * f
-                if not abs(math.sqrt(sum) - 1) <= 0.1:
-                    vu = normal
-                vertex_data['normal'][idx] = vu
-
-            self.gltf.numpy_to_gltf(vertex_data,
-                                    triangles,
-                                    transform_matrix,
-                                    textures,
-                                    alpha_threshold,
-                                    alpha_blend,
-                                    alpha_test,
-                                    glossiness,
-                                    ni_name, args.unrealmode)
+            return {
+                "name": ni_name,
+                "transform": [list(row) for row in transform_matrix],
+                "has_uv": bool(len(n_tri_data.uv_sets)),
+                "textures": texture_paths,
+                "alpha_threshold": alpha_threshold,
+                "alpha_blend": alpha_blend,
+                "alpha_test": alpha_test,
+                "glossiness": glossiness,
+                "positions": vertices,
+                "normals": normals,
+                "tangents": tangents,
+                "texcoords": uvs,
+                "colors": vertex_colors,
+                "indices": triangles,
+            }
         else:
             print(Fore.YELLOW + f"Skipping, no shape data found {ni_name}")
+            return None
 
-    def read_branch(self, n_block, parent):
+    def convert_shape(self, shape):
+        """Add a shape record to the current GLTF file."""
+        vertex_data, triangles, textures = self.shape_arrays(shape)
+        self.add_shape(shape["name"], vertex_data, triangles, mathutils.Matrix(shape["transform"]), textures, shape)
+
+    def shape_arrays(self, shape):
+        """Vertex array, triangles and texture uris of a shape record."""
+        vertices, normals, tangents, uvs, vertex_colors, triangles = (
+            shape["positions"], shape["normals"], shape["tangents"], shape["texcoords"], shape["colors"],
+            shape["indices"])
+        if not shape["has_uv"]:
+            print(Fore.YELLOW + "No UV data present" + Fore.WHITE)
+
+        normals, repaired, rescaled = sanitize_normals(np.array(normals))
+        if repaired:
+            print(Fore.YELLOW + "Replaced " + str(repaired) + " of " + str(len(normals)) + " zero or NaN normals" +
+                  Fore.WHITE)
+        self.repaired_normals += repaired
+        self.rescaled_normals += rescaled
+
+        # assemble into a gltf structure
+        vertex_data = vertex_array(vertices, normals, tangents, uvs, vertex_colors)
+
+        # get textures for object
+        textures = []
+        if shape["textures"] is None:
+            print(Fore.YELLOW + "No texture data present" + Fore.WHITE)
+        for texture_path in shape["textures"] or []:
+            texture_file = os.path.normpath(os.path.join(self.texture_root, *texture_path.split("/")))
+            self.texture_dependencies.add(texture_path)
+            # reference the shared, content addressed copy through a relative uri
+            content_hash = self.texture_store.hash_for(texture_path, texture_file)
+            if content_hash is not None:
+                textures.append(self.texture_store.uri(content_hash, self.gltf_path))
+            else:
+                print(Fore.YELLOW + "Texture " + texture_path + " not found" + Fore.WHITE)
+                missing_file = os.path.join(os.path.abspath(self.out_folder), *texture_path.replace(".dds", ".png").split("/"))
+                textures.append(os.path.relpath(missing_file, os.path.dirname(os.path.abspath(self.gltf_path))).replace("\\", "/"))
+        print(textures)
+
+        print("printing lengths:")
+        print(len(vertices))
+        print(len(triangles))
+        print(len(normals))
+        print(len(tangents))
+        print(len(uvs))
+        print(len(vertex_colors))
+        return vertex_data, triangles, textures
+
+    def add_shape(self, ni_name, vertex_data, triangles, transform_matrix, textures, material):
+        """Optimise a shape and its LOD levels and add it to the GLTF file, the alpha and gloss
+        settings are taken from the material shape record."""
+        if self.optimize:
+            vertex_data, triangles, stats = optimize_mesh(vertex_data, triangles)
+            if stats is not None:
+                print(Fore.WHITE + "Optimised " + ni_name + ": " + format_stats(stats))
+                self.optimize_stats.append(stats)
+
+        lods = None
+        if self.lod:
+            start = time.perf_counter()
+            lods = simplifier.simplify_lods(vertex_data, triangles, self.lod)
+            if self.optimize:
+                lods = [(ratio, optimize_vertex_cache(indices, len(vertex_data)), error)
+                        for ratio, indices, error in lods]
+            stats = {"triangles": [len(triangles) // 3] + [len(indices) // 3 for ratio, indices, error in lods],
+                     "errors": [error for ratio, indices, error in lods],
+                     "seconds": time.perf_counter() - start}
+            print(Fore.WHITE + "LODs for " + ni_name + ": " + simplifier.format_stats(stats))
+            self.lod_stats.append(stats)
+
+        self.gltf.numpy_to_gltf(vertex_data,
+                                triangles,
+                                transform_matrix,
+                                textures,
+                                material["alpha_threshold"],
+                                material["alpha_blend"],
+                                material["alpha_test"],
+                                material["glossiness"],
+                                ni_name, self.unrealmode, lods)
+
+    def convert_flattened(self, shapes):
+        """Add the shape records of a root as one mesh per material.
+
+        The shape transforms are baked into the vertices, so every mesh is a node at the root
+        of the scene without a transform. Triangles of mirrored shapes are flipped to keep
+        them facing outwards."""
+        groups = {}
+        for shape in shapes:
+            vertex_data, triangles, textures = self.shape_arrays(shape)
+            key = (tuple(textures), shape["alpha_threshold"], shape["alpha_blend"], shape["alpha_test"],
+                   shape["glossiness"])
+            groups.setdefault(key, []).append((shape, vertex_data, triangles, textures))
+        members = [member for group in groups.values() for member in group]
+        if not members:
+            return
+
+        # all shapes of the root at once, in group order so every group is one slice
+        vertex_data = np.concatenate([member[1] for member in members])
+        determinants = bake_transforms(vertex_data, [member[0]["transform"] for member in members],
+                                       [len(member[1]) for member in members])
+
+        start = 0
+        shape_index = 0
+        for group in groups.values():
+            triangles = []
+            count = 0
+            for shape, shape_vertices, shape_triangles, textures in group:
+                shape_triangles = np.asarray(shape_triangles, dtype=np.uint32).reshape(-1, 3)
+                if determinants[shape_index] < 0:
+                    shape_triangles = shape_triangles[:, [0, 2, 1]]
+                triangles.append(shape_triangles.ravel() + count)
+                count += len(shape_vertices)
+                shape_index += 1
+            name = group[0][0]["name"] if len(group) == 1 else group[0][0]["name"] + " (" + str(len(group)) + " shapes)"
+            self.add_shape(name, vertex_data[start:start + count], np.concatenate(triangles).astype(np.uint32),
+                           mathutils.Matrix(), group[0][3], group[0][0])
+            start += count
+        self.flatten_stats["shapes"] += len(members)
+        self.flatten_stats["meshes"] += len(groups)
+        print(Fore.WHITE + "Flattened " + str(len(members)) + " shapes into " + str(len(groups)) + " meshes")
+
+    def read_branch(self, n_block, parent, shapes):
 
         print(f"Importing data for block '{n_block.name.decode()}'")
 
@@ -319,20 +377,25 @@ class NIFFile:
             return None
 
         if isinstance(n_block, NifFormat.NiTriBasedGeom):
-            return self.read_geometry_object(n_block, parent)
+            shape = self.read_geometry_object(n_block, parent)
+            if shape is not None:
+                shapes.append(shape)
+            return None
         else:
             self.transform_offset @= mathutils.Matrix(n_block.get_transform().as_list()).transposed()
 
         # find children
         b_children = []
         if hasattr(n_block, 'children'):
-            n_children = [child for child in n_block.children]
+            # children that weren't read are empty links
+            n_children = [child for child in n_block.children if child]
             for n_child in n_children:
-                self.read_branch(n_child, n_block)
+                self.read_branch(n_child, n_block, shapes)
             print("Resetting working transform")
             self.transform_offset = mathutils.Matrix()
 
     def read_root(self, root_block):
+        """Root record of a root block, its name and the records of its shapes."""
 
         # divinity 2: handle CStreamableAssetData
         if isinstance(root_block, NifFormat.CStreamableAssetData):
@@ -347,19 +410,11 @@ class NIFFile:
         # import this root block
         print(
             Back.BLUE + Fore.BLACK + Style.BRIGHT + f"PROCESSING ROOT BLOCK: {root_block.get_global_display()}" + Style.RESET_ALL)
-        self.filename = root_block.get_global_display().replace(".nif", "")
-        self.gltf_path = os.path.normpath(os.path.join(self.gltf_path, self.filename, self.filename + ".gltf"))
-        self.bin_path = os.path.abspath(os.path.normpath(os.path.join(self.bin_path, self.filename, self.filename + ".bin"))).replace("\\", "/")
-
-        # generate output folder structure
-        if not os.path.exists(os.path.dirname(self.gltf_path)):
-            os.makedirs(os.path.dirname(self.gltf_path))
-
-        self.gltf = GLTFFile(root_block.get_global_display(), self.gltf_path, self.bin_path)
+        root = {"name": root_block.get_global_display(), "shapes": []}
 
         if isinstance(root_block, (NifFormat.NiNode, NifFormat.NiTriBasedGeom)):
             root_block.__annotations__ = "root_of_file"
-            self.read_branch(root_block, root_block)
+            self.read_branch(root_block, root_block, root["shapes"])
         elif isinstance(root_block, NifFormat.NiCamera):
             print('Skipped NiCamera root')
 
@@ -368,24 +423,119 @@ class NIFFile:
 
         else:
             print(f"Skipped unsupported root block type '{root_block.__class__}' (corrupted nif?).")
+        return root
 
-    def __init__(self, texture_root, filepath, in_folder, out_folder):
-        data = NifFormat.Data()
+    def read_nif(self, filepath):
+        """Root records of all roots of a NIF file, only the blocks geometry needs are decoded."""
         with open(filepath, "rb") as nif_stream:
             print("Reading %s" % os.path.basename(filepath))
-            data.read(nif_stream)
+            data, stats = nif_reader.read_geometry(nif_stream)
+        print(Fore.WHITE + "Read " + os.path.basename(filepath) + ": " + nif_reader.format_stats(stats))
+
+        roots = []
+        for block in data.roots:
+            root = block
+            self.transform_offset.translation += mathutils.Matrix(root.get_transform().as_list()).transposed().translation
+            roots.append(self.read_root(root))
+        return roots
+
+    def convert_root(self, root):
+        """Create the GLTF file of a root record and add its shapes."""
+        self.filename = root["name"].replace(".nif", "")
+        self.gltf_path = os.path.normpath(os.path.join(self.gltf_path, self.filename,
+                                                       self.filename + (".glb" if self.glb else ".gltf")))
+        # GLB files hold the binary buffer themselves
+        if self.glb:
+            self.bin_path = None
+        else:
+            self.bin_path = os.path.abspath(os.path.normpath(os.path.join(self.bin_path, self.filename, self.filename + ".bin"))).replace("\\", "/")
+
+        # generate output folder structure
+        if not os.path.exists(os.path.dirname(self.gltf_path)):
+            os.makedirs(os.path.dirname(self.gltf_path))
+
+        # only the last root is saved, the files of earlier ones are dropped
+        self.discard_gltf()
+        self.gltf = GLTFFile(root["name"], self.gltf_path, self.bin_path, self.quantize, self.compress,
+                             self.gpu_instancing, self.glb)
+        if self.flatten:
+            self.convert_flattened(root["shapes"])
+        else:
+            # the GLTF file writes every shape straight away, drop the records as they are converted
+            shapes = root["shapes"]
+            while shapes:
+                self.convert_shape(shapes.pop(0))
+
+    def __init__(self, texture_root, filepath, in_folder, out_folder, unrealmode=False, texture_store=None,
+                 optimize=False, quantize=False, compress=False, lod=None, gpu_instancing=False,
+                 geometry_cache=False, flatten=False, glb=False, content_hash=None):
+        # per instance state, a pool worker converts many files with the same interpreter
+        self.gltf_indices = []
+        self.gltf_buffers = []
+        self.transform_offset = mathutils.Matrix()
+        self.unrealmode = unrealmode
+        self.texture_dependencies = set()
+        self.repaired_normals = 0
+        self.rescaled_normals = 0
+        self.optimize = optimize
+        self.optimize_stats = []
+        self.quantize = quantize
+        self.compress = compress
+        self.lod = lod
+        self.lod_stats = []
+        self.gpu_instancing = gpu_instancing
+        self.instanced_shapes = 0
+        self.geometry_cached = False
+        self.flatten = flatten
+        self.flatten_stats = {"shapes": 0, "meshes": 0}
+        self.glb = glb
+        self.texture_store = TextureStore(out_folder) if texture_store is None else texture_store
 
         base_path = os.path.join(out_folder, os.path.relpath(os.path.dirname(filepath), in_folder))
         self.gltf_path = base_path
         self.bin_path = base_path
         self.in_folder = in_folder
         self.out_folder = out_folder
-
         self.texture_root = texture_root
-        for block in data.roots:
-            root = block
-            self.transform_offset.translation += mathutils.Matrix(root.get_transform().as_list()).transposed().translation
-            self.read_root(root)
 
-niffile = NIFFile(args.TexRoot, args.Path, args.InFolder, args.OutFolder)
-niffile.save_gltf()
\ No newline at end of file
+        # the extracted shapes don't depend on the output options, re-exports read them from the cache
+        roots = None
+        if geometry_cache:
+            cache = GeometryCache(out_folder)
+            content_hash = file_hash(filepath) if content_hash is None else content_hash
+            roots = cache.load(content_hash)
+            self.geometry_cached = roots is not None
+            if self.geometry_cached:
+                print("Read %s from the geometry cache" % os.path.basename(filepath))
+        if roots is None:
+            roots = self.read_nif(filepath)
+            if geometry_cache:
+                cache.save(content_hash, roots)
+
+        try:
+            for root in roots:
+                self.convert_root(root)
+        except Exception:
+            self.discard_gltf()
+            raise
+
+
+def convert_nif(filepath, texture_root, in_folder, out_folder, unrealmode=False, texture_store=None, **options):
+    """Convert a single NIF file to GLTF and return the processed NIFFile.
+    Further keyword options are passed on to NIFFile."""
+    niffile = NIFFile(texture_root, filepath, in_folder, out_folder, unrealmode, texture_store, **options)
+    try:
+        niffile.save_gltf()
+    except Exception:
+        niffile.discard_gltf()
+        raise
+    return niffile
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print(args)
+    convert_nif(args.Path, args.TexRoot, args.InFolder, args.OutFolder, args.unrealmode, TextureStore.load(args.OutFolder),
+                optimize=args.optimize, quantize=args.quantize, compress=args.compress,
+                lod=args.lod, gpu_instancing=args.gpu_instancing, geometry_cache=args.geometry_cache,
+                flatten=args.flatten, glb=args.glb)
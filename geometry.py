@@ -0,0 +1,166 @@
+import operator
+import itertools
+
+import numpy as np
+
+# default vertex attributes for shapes that don't store them
+DEFAULT_NORMAL = (0.0, 0.0, 1.0)
+DEFAULT_TANGENT = (1.0, 0.0, 0.0, 1.0)
+DEFAULT_TEXCOORD = (0.0, 0.0)
+DEFAULT_COLOR = (1.0, 1.0, 1.0, 1.0)
+
+
+def field_getter(fields, sample):
+    """attrgetter for basic fields of a pyffi struct.
+
+    pyffi keeps each basic field in a value holder named _<field>_value_ behind a generated
+    property. Reading the holders directly skips the property call and is about ten times
+    faster, the public properties are used when a pyffi version lays them out differently."""
+    getter = operator.attrgetter(*("_" + field + "_value_._value" for field in fields))
+    try:
+        getter(sample)
+    except AttributeError:
+        getter = operator.attrgetter(*fields)
+    return getter
+
+
+def struct_array(structs, fields, dtype=np.float32):
+    """(N, len(fields)) array of basic fields from a pyffi array of structs (N >= 0, fields >= 2)."""
+    count = len(structs)
+    if count == 0:
+        return np.zeros((0, len(fields)), dtype=dtype)
+    # list.__iter__ skips the generator pyffi wraps around its arrays
+    getter = field_getter(fields, list.__getitem__(structs, 0))
+    values = itertools.chain.from_iterable(map(getter, list.__iter__(structs)))
+    return np.fromiter(values, dtype=dtype, count=count * len(fields)).reshape(count, len(fields))
+
+
+def basic_array(values, dtype):
+    """1D array from a pyffi array of basic values, such as a triangle strip."""
+    count = len(values)
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    if hasattr(list.__getitem__(values, 0), "_value"):
+        return np.fromiter(map(operator.attrgetter("_value"), list.__iter__(values)), dtype=dtype, count=count)
+    return np.fromiter(values, dtype=dtype, count=count)
+
+
+def strips_to_triangles(strips):
+    """Triangle list for a set of triangle strips, winding and degenerate handling as in
+    pyffi.utils.tristrip.triangulate. Returns a flat uint32 index array."""
+    result = []
+    for strip in strips:
+        strip = np.asarray(strip, dtype=np.uint32)
+        if len(strip) < 3:
+            continue
+        t0, t1, t2 = strip[:-2], strip[1:-1], strip[2:]
+        # every second triangle of a strip is flipped to keep the winding consistent
+        odd = (np.arange(len(t0)) & 1).astype(bool)
+        triangles = np.stack([t0, np.where(odd, t2, t1), np.where(odd, t1, t2)], axis=1)
+        keep = (t0 != t1) & (t1 != t2) & (t2 != t0)
+        result.append(triangles[keep].ravel())
+    if not result:
+        return np.zeros(0, dtype=np.uint32)
+    return np.concatenate(result)
+
+
+def triangle_indices(data):
+    """Flat uint32 triangle index array of a NiTriShapeData or NiTriStripsData block."""
+    if hasattr(data, "points"):
+        return strips_to_triangles([basic_array(strip, np.uint32) for strip in data.points])
+    if hasattr(data, "triangles"):
+        return struct_array(data.triangles, ("v_1", "v_2", "v_3"), np.uint32).ravel()
+    return np.fromiter(itertools.chain.from_iterable(data.get_triangles()), dtype=np.uint32)
+
+
+def attribute_array(structs, fields, count, default):
+    """Attribute array with count rows, or the default for every vertex if the shape has none."""
+    if len(structs) == count and count > 0:
+        return struct_array(structs, fields)
+    return np.tile(np.array(default, dtype=np.float32), (count, 1))
+
+
+def extract_geometry(data):
+    """Vertex attributes and triangle indices of a pyffi geometry data block as contiguous arrays.
+
+    Returns (positions, normals, tangents, texcoords, colors, indices). Attributes are float32
+    with 3, 3, 4, 2 and 4 columns, missing ones are filled with defaults, and indices are a
+    flat uint32 array."""
+    positions = struct_array(data.vertices, ("x", "y", "z"))
+    count = len(positions)
+
+    normals = attribute_array(data.normals, ("x", "y", "z"), count, DEFAULT_NORMAL)
+
+    tangents = np.empty((count, 4), dtype=np.float32)
+    tangents[:, 3] = 1.0
+    tangents[:, :3] = attribute_array(data.tangents, ("x", "y", "z"), count, DEFAULT_TANGENT[:3])
+
+    texcoords = attribute_array(data.uv_sets[0] if len(data.uv_sets) else [], ("u", "v"), count,
+                                DEFAULT_TEXCOORD)
+
+    # the alpha of skyrim vertex colours isn't used as opacity
+    colors = attribute_array(data.vertex_colors, ("r", "g", "b", "a"), count, DEFAULT_COLOR)
+    colors[:, 3] = 1.0
+
+    return positions, normals, tangents, texcoords, colors, triangle_indices(data)
+
+
+def sanitize_normals(normals, tolerance=1e-3):
+    """Normalise an (N, 3) normal array in place and count the vertices that needed it.
+
+    Zero length normals and normals with NaN or infinite components are broken and replaced
+    by the default normal. Normals whose length is off by more than tolerance are rescaled to
+    unit length, which packed normals of otherwise fine files often need, so they are counted
+    separately. Returns (normals, broken, rescaled)."""
+    lengths = np.sqrt(np.einsum("ij,ij->i", normals, normals))
+    broken = ~np.isfinite(lengths) | (lengths < 1e-6)
+    rescale = ~broken & (np.abs(lengths - 1.0) > tolerance)
+    normals[rescale] /= lengths[rescale, None]
+    normals[broken] = DEFAULT_NORMAL
+    return normals, int(np.count_nonzero(broken)), int(np.count_nonzero(rescale))
+
+
+def vertex_array(positions, normals, tangents, texcoords, colors):
+    """Interleaved structured vertex array in the layout GLTFFile.numpy_to_gltf expects."""
+    vertex_data = np.empty(len(positions), dtype=[
+        ("position", np.float32, 3),
+        ("normal", np.float32, 3),
+        ("tangent", np.float32, 4),
+        ("texCoord0", np.float32, 2),
+        ("color", np.float32, 4),
+    ])
+    vertex_data["position"] = positions
+    vertex_data["normal"] = normals
+    vertex_data["tangent"] = tangents
+    vertex_data["texCoord0"] = texcoords
+    vertex_data["color"] = colors
+    return vertex_data
+
+
+def bake_transforms(vertex_data, matrices, counts):
+    """Apply the transforms of several shapes to their vertices in one batched multiply.
+
+    vertex_data holds the vertices of the shapes one after the other, counts[i] of them for
+    the 4x4 column vector matrix matrices[i]. Positions get the full transform, tangents its
+    linear part and normals the inverse transpose of it, both are normalised again. Changed
+    in place, returns the determinant of every linear part: shapes with a negative one are
+    mirrored and need their triangles flipped, their tangent handedness is flipped here."""
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    linear = matrices[:, :3, :3]
+    determinants = np.linalg.det(linear)
+    # shapes scaled to nothing keep their normals, there is no plane left to be normal to
+    invertible = np.abs(determinants) > 1e-12
+    normal_matrices = np.repeat(np.eye(3)[None], len(matrices), axis=0)
+    normal_matrices[invertible] = np.linalg.inv(linear[invertible]).transpose(0, 2, 1)
+
+    shape_of_vertex = np.repeat(np.arange(len(matrices)), counts)
+    positions = vertex_data["position"].astype(np.float64)
+    vertex_data["position"] = (np.einsum("nij,nj->ni", linear[shape_of_vertex], positions) +
+                               matrices[shape_of_vertex, :3, 3])
+    for field, field_matrices in (("normal", normal_matrices), ("tangent", linear)):
+        directions = np.einsum("nij,nj->ni", field_matrices[shape_of_vertex],
+                               vertex_data[field][:, :3].astype(np.float64))
+        lengths = np.sqrt(np.einsum("ij,ij->i", directions, directions))
+        vertex_data[field][:, :3] = directions / np.maximum(lengths, 1e-30)[:, None]
+    vertex_data["tangent"][:, 3] *= np.where(determinants < 0, -1.0, 1.0)[shape_of_vertex]
+    return determinants
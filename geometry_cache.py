@@ -0,0 +1,73 @@
+import os
+import json
+import socket
+
+import numpy as np
+from colorama import Fore
+
+CACHE_FOLDER = "cache/geometry"
+
+# bump when the cached records change, files written by other versions are read as misses
+CACHE_VERSION = 1
+
+# numpy arrays of a shape record, everything else is stored as json
+SHAPE_ARRAYS = ("positions", "normals", "tangents", "texcoords", "colors", "indices")
+
+# other processes and shards may write the same entry into a shared output folder
+PARTIAL_SUFFIX = "." + socket.gethostname() + "-" + str(os.getpid()) + ".partial"
+
+
+class GeometryCache:
+    """Shape data extracted from NIF files, keyed by the content hash of the NIF.
+
+    Every NIF is stored as <out>/cache/geometry/<ab>/<hash>.npz holding the vertex and index
+    arrays of its shapes and, as json, their names, transforms, texture paths and alpha
+    flags. Re-exporting an unchanged NIF with different output options reads this instead
+    of parsing the NIF with pyffi."""
+
+    folder = ""
+
+    def __init__(self, out_folder):
+        self.folder = os.path.join(out_folder, *CACHE_FOLDER.split("/"))
+
+    def path(self, content_hash):
+        return os.path.join(self.folder, content_hash[:2], content_hash + ".npz")
+
+    def load(self, content_hash):
+        """The root records saved for a NIF, or None if there are none for this version."""
+        path = self.path(content_hash)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data["meta"]))
+                if meta.get("version") != CACHE_VERSION:
+                    return None
+                for root_index, root in enumerate(meta["roots"]):
+                    for shape_index, shape in enumerate(root["shapes"]):
+                        for name in SHAPE_ARRAYS:
+                            shape[name] = data[str(root_index) + "/" + str(shape_index) + "/" + name]
+        except (OSError, ValueError, KeyError) as err:
+            print(Fore.YELLOW + "Ignoring unreadable geometry cache entry " + path + ": " + str(err) + Fore.WHITE)
+            return None
+        return meta["roots"]
+
+    def save(self, content_hash, roots):
+        path = self.path(content_hash)
+        arrays = {}
+        meta_roots = []
+        for root_index, root in enumerate(roots):
+            shapes = []
+            for shape_index, shape in enumerate(root["shapes"]):
+                for name in SHAPE_ARRAYS:
+                    arrays[str(root_index) + "/" + str(shape_index) + "/" + name] = shape[name]
+                shapes.append({key: value for key, value in shape.items() if key not in SHAPE_ARRAYS})
+            meta_roots.append(dict(root, shapes=shapes))
+        meta = json.dumps({"version": CACHE_VERSION, "roots": meta_roots})
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + PARTIAL_SUFFIX
+        # written next to the final name and renamed once complete, readers never see partial files
+        with open(partial, "wb") as f:
+            np.savez(f, meta=np.array(meta), **arrays)
+        os.replace(partial, path)
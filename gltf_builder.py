@@ -1,11 +1,19 @@
+import io
 import os
 import sys
 import json
+import shutil
+import tempfile
+import time
+import struct
+import hashlib
 
 import numpy as np
 
 from pygltf import gltf2 as gltf
 
+import meshopt
+
 ATTRIBUTE_BY_NAME = {
     "position": gltf.Attribute.POSITION,
     "normal": gltf.Attribute.NORMAL,
@@ -25,6 +33,10 @@ COMPONENT_TYPE_BY_DTYPE = {
     np.float32: gltf.ComponentType.FLOAT,
 }
 
+# glTF requires every bufferView and accessor to start on a multiple of its component size,
+# aligning everything to 4 bytes covers all component types
+BUFFER_ALIGNMENT = 4
+
 ACCESSOR_TYPE_BY_SHAPE = {
     (): gltf.AccessorType.SCALAR,
     (1,): gltf.AccessorType.SCALAR,
@@ -37,9 +49,113 @@ ACCESSOR_TYPE_BY_SHAPE = {
     (4, 4): gltf.AccessorType.MAT4,
 }
 
+# KHR_mesh_quantization vertex layout, 24 bytes per vertex instead of 64. glTF wants every
+# attribute of an interleaved vertex to start on a 4 byte boundary, hence the gaps
+QUANTIZED_VERTEX = np.dtype({
+    "names": ["position", "normal", "tangent", "texCoord0", "color"],
+    "formats": [(np.int16, 3), (np.int8, 3), (np.int8, 4), (np.uint16, 2), (np.uint8, 4)],
+    "offsets": [0, 8, 12, 16, 20],
+    "itemsize": 24,
+})
+
+# attributes stored as normalized integers, mapped back to [-1, 1] or [0, 1] by the GPU
+NORMALIZED_ATTRIBUTES = ("normal", "tangent", "texCoord0", "color")
+
+# zero bytes the alignment padding is sliced from, so padding doesn't allocate anything
+PADDING = memoryview(bytes(BUFFER_ALIGNMENT))
+
+# most buffers one gathered write takes, POSIX guarantees at least 16 and Linux allows 1024
+WRITEV_BATCH = 512
+
+# binary chunks of GLB files are kept in memory up to this size before they go to a temporary file
+SPOOL_SIZE = 16 * 2 ** 20
+# .bin files are written under this suffix and renamed on save, so no half written file looks finished
+PARTIAL_SUFFIX = ".partial"
+
+# GLB container, a 12 byte header followed by chunks that each start with their length and type
+GLB_MAGIC = 0x46546C67
+GLB_VERSION = 2
+GLB_CHUNK_JSON = 0x4E4F534A
+GLB_CHUNK_BIN = 0x004E4942
+
+# MSFT_screencoverage of the source mesh, LOD levels are shown down to their triangle ratio times this
+# and the last one is never culled
+LOD_SCREEN_COVERAGE = 0.5
+
+
+def quantize_unit(values, bits, signed):
+    """Round floats in [-1, 1] (signed) or [0, 1] to normalized integers of the given size."""
+    scale = (1 << (bits - 1)) - 1 if signed else (1 << bits) - 1
+    low = -scale if signed else 0
+    return np.clip(np.rint(values * scale), low, scale)
+
+
+def quantize_vertices(vertex_data):
+    """Quantize a float32 vertex array into the QUANTIZED_VERTEX layout.
+
+    Positions are mapped per axis onto int16 between the bounding box corners and UVs onto
+    uint16 between their minimum and maximum. Returns (vertices, position_offset,
+    position_scale, uv_offset, uv_scale), the dequantization is value * scale + offset.
+
+    Error bounds: positions are off by at most (max - min) / 131068 per axis, normals and
+    tangent directions by at most 0.5 / 127 (0.0039) per component, UVs by at most
+    (max - min) / 131070 and colours by at most 0.5 / 255."""
+    quantized = np.zeros(len(vertex_data), dtype=QUANTIZED_VERTEX)
+    positions = vertex_data["position"].astype(np.float64)
+    low = positions.min(axis=0) if len(positions) else np.zeros(3)
+    high = positions.max(axis=0) if len(positions) else np.zeros(3)
+    position_offset = (low + high) / 2
+    position_scale = np.where(high > low, (high - low) / 2, 1.0) / 32767
+    quantized["position"] = np.clip(np.rint((positions - position_offset) / position_scale), -32767, 32767)
+
+    quantized["normal"] = quantize_unit(vertex_data["normal"], 8, True)
+    quantized["tangent"] = quantize_unit(vertex_data["tangent"], 8, True)
+    quantized["color"] = quantize_unit(vertex_data["color"], 8, False)
+
+    uvs = vertex_data["texCoord0"].astype(np.float64)
+    uv_offset = np.zeros(2)
+    uv_scale = np.ones(2)
+    if len(uvs) and (uvs.min() < 0 or uvs.max() > 1):
+        # tiling UVs leave [0, 1], store them relative to their range and undo it with KHR_texture_transform
+        uv_offset = uvs.min(axis=0)
+        uv_scale = np.where(uvs.max(axis=0) > uv_offset, uvs.max(axis=0) - uv_offset, 1.0)
+    quantized["texCoord0"] = quantize_unit((uvs - uv_offset) / uv_scale, 16, False)
+    return quantized, position_offset, position_scale, uv_offset, uv_scale
+
+
+def byte_view(buffer):
+    """Flat uint8 memoryview of an array or bytes-like object, only arrays that aren't
+    contiguous are copied."""
+    if isinstance(buffer, np.ndarray):
+        return memoryview(np.ascontiguousarray(buffer).reshape(-1).view(np.uint8))
+    return memoryview(buffer).cast("B")
+
+
+def write_buffers(f, buffers):
+    """Write a list of arrays and padding to a binary file without copying them.
+
+    Unbuffered files get gathered os.writev calls where the platform has them, which keep
+    going after partial writes. Other file objects are written one view at a time."""
+    views = [view for view in map(byte_view, buffers) if view.nbytes]
+    if not hasattr(os, "writev") or not isinstance(f, io.RawIOBase):
+        for view in views:
+            while view.nbytes:
+                view = view[f.write(view):]
+        return
+    fd = f.fileno()
+    while views:
+        written = os.writev(fd, views[:WRITEV_BATCH])
+        while views and written >= views[0].nbytes:
+            written -= views.pop(0).nbytes
+        if written:
+            views[0] = views[0][written:]
+
+
 class GLTFFile:
     document = None
-    buffers = []
+    # where the binary buffer is written as shapes are added: the .bin file, or a spooled
+    # temporary file that becomes the binary chunk of a GLB file
+    binary = None
     gltf_path = ""
     bin_path = ""
     filename = ""
@@ -47,6 +163,31 @@ class GLTFFile:
     offset = 0
     buffer = None
 
+    # nodes listed in the scene, the others are children of these
+    root_nodes = None
+    # write KHR_mesh_quantization attributes instead of float32
+    quantize = False
+    # write bufferViews with EXT_meshopt_compression, the uncompressed layout lives in fallback_buffer
+    compress = False
+    fallback_buffer = None
+    compressed_offset = 0
+    # bytes before and after compression and the seconds spent encoding
+    compression_stats = None
+
+    # shapes waiting for their nodes, these are added on save so repeated meshes can be instanced
+    instances = None
+    # accessors by geometry_key and meshes by geometry and material, for shapes that repeat
+    geometries = None
+    meshes = None
+    # materials by their parameters and textures by image uri, so each is written once
+    materials = None
+    textures = None
+    instanced_shapes = 0
+    # draw shapes that share a mesh with one EXT_mesh_gpu_instancing node
+    gpu_instancing = False
+    # write one .glb file with the json and the binary buffer instead of a .gltf and a .bin
+    glb = False
+
     def from_np_type(self, dtype, shape):
         accessorType = ACCESSOR_TYPE_BY_SHAPE.get(shape)
         componentType = COMPONENT_TYPE_BY_DTYPE.get(dtype.type)
@@ -62,7 +203,10 @@ class GLTFFile:
             return dtype, shape
 
 
-    def generate_structured_array_accessors(self, data, buffer_views, offset=None, count=None, name=None):
+    def generate_structured_array_accessors(self, data, buffer_views, offset=None, count=None, name=None,
+                                            normalized=(), interleaved=False):
+        """Accessors for every field. With interleaved the fields share one bufferView and each
+        accessor starts at its field offset."""
         name = "{key}" if name is None else name
         count = len(data) if count is None else count
         result = {}
@@ -70,8 +214,9 @@ class GLTFFile:
             dtype, delta = value
             dtype, shape = self.subtype(dtype)
             accessorType, componentType = self.from_np_type(dtype, shape)
-            accessor = gltf.Accessor(buffer_views[key], offset, count, accessorType, componentType,
-                                     name=name.format(key=key))
+            accessor = gltf.Accessor(buffer_views[key], (offset or 0) + delta if interleaved else offset, count,
+                                     accessorType, componentType,
+                                     name=name.format(key=key), normalized=key in normalized)
             attribute = ATTRIBUTE_BY_NAME.get(key)
             if attribute == gltf.Attribute.POSITION:
                 accessor.max = np.amax(data[key], axis=0).tolist()
@@ -111,6 +256,46 @@ class GLTFFile:
         return result
 
 
+    def compress_buffer_view(self, buffer_view, data, mode, count, stride):
+        """Move a bufferView into the fallback buffer and store its data compressed in the main buffer."""
+        start = time.perf_counter()
+        if mode == "TRIANGLES":
+            encoded = meshopt.encode_index_buffer(data)
+        else:
+            encoded = meshopt.encode_vertex_buffer(data, stride)
+        self.compression_stats["seconds"] += time.perf_counter() - start
+        self.compression_stats["bytes"] += data.nbytes
+        self.compression_stats["compressed_bytes"] += len(encoded)
+
+        padding = -self.compressed_offset % BUFFER_ALIGNMENT
+        if padding:
+            write_buffers(self.binary, [PADDING[:padding]])
+            self.compressed_offset += padding
+        buffer_view.buffer = self.fallback_buffer
+        buffer_view.extensions = {"EXT_meshopt_compression": {
+            "buffer": 0,
+            "byteOffset": self.compressed_offset,
+            "byteLength": len(encoded),
+            "byteStride": stride,
+            "count": count,
+            "mode": mode,
+        }}
+        write_buffers(self.binary, [encoded])
+        self.compressed_offset += len(encoded)
+
+    def index_dtype(self, vertex_count):
+        """Smallest index type for a mesh, the largest value of each type is reserved by glTF."""
+        return np.uint16 if vertex_count <= np.iinfo(np.uint16).max else np.uint32
+
+    def align(self, alignment=BUFFER_ALIGNMENT):
+        """Pad the binary buffer with zero bytes so the next bufferView starts aligned.
+        Compressed files only track the offset, the padding is in the fallback layout."""
+        padding = -self.offset % alignment
+        if padding:
+            if not self.compress:
+                write_buffers(self.binary, [PADDING[:padding]])
+            self.offset += padding
+
     def byteLength(self, buffers):
         return sum(map(lambda buffer: buffer.nbytes, buffers))
 
@@ -135,8 +320,121 @@ class GLTFFile:
         else:
             return in_val
 
-    def numpy_to_gltf(self, vertex_data, index_data, transform_matrix, textures, alpha_threshold, alpha_blend, alpha_test, glossiness, mesh_name, unrealmode):
-        mesh = gltf.Mesh([], name=mesh_name)
+    def texture_info(self, texture, uv_transform):
+        if uv_transform is None:
+            return gltf.TextureInfo(index=texture)
+        self.document.use_extension("KHR_texture_transform", required=True)
+        return gltf.TextureInfo(index=texture, extensions={"KHR_texture_transform": uv_transform})
+
+    def geometry_key(self, vertex_data, index_data, lods):
+        """Digest of the arrays of a shape, shapes with the same digest share their accessors."""
+        digest = hashlib.sha1()
+        for array in [vertex_data, np.asarray(index_data, dtype=np.uint32)] + [
+                np.asarray(lod_indices, dtype=np.uint32) for ratio, lod_indices, error in lods or []]:
+            digest.update(str(len(array)).encode() + b":")
+            digest.update(np.ascontiguousarray(array).view(np.uint8))
+        return digest.hexdigest()
+
+    def numpy_to_gltf(self, vertex_data, index_data, transform_matrix, textures, alpha_threshold, alpha_blend, alpha_test, glossiness, mesh_name, unrealmode, lods=None):
+        """Add a shape. Shapes that repeat the arrays of an earlier shape reuse its accessors, and
+        its mesh as well if the material is the same too."""
+        geometry_key = self.geometry_key(vertex_data, index_data, lods)
+        material_key = (tuple(textures), alpha_threshold, alpha_blend, alpha_test, glossiness, unrealmode)
+        meshes = self.meshes.get((geometry_key, material_key))
+        if meshes is None:
+            geometry = self.geometries.get(geometry_key)
+            if geometry is None:
+                geometry = self.add_geometry(vertex_data, index_data, mesh_name, lods)
+                self.geometries[geometry_key] = geometry
+            mesh_material = self.material(textures, alpha_threshold, alpha_blend, alpha_test, glossiness,
+                                          unrealmode, geometry["uv_transform"])
+            meshes = self.add_meshes(geometry, mesh_material, mesh_name)
+            self.meshes[(geometry_key, material_key)] = meshes
+        else:
+            self.instanced_shapes += 1
+            print("Instancing " + meshes["mesh"].name + " for " + mesh_name)
+
+        loc, rot, sca = transform_matrix.decompose()
+        self.instances.append({"name": mesh_name, "meshes": meshes, "translation": [loc.x, loc.y, loc.z],
+                               "rotation": [rot.x, rot.y, rot.z, rot.w], "scale": [sca.x, sca.y, sca.z]})
+
+    def add_geometry(self, vertex_data, index_data, mesh_name, lods):
+        """Write the vertex and index arrays of a shape and its LOD levels and add their accessors."""
+        dequantize = None
+        uv_transform = None
+        normalized = ()
+        if self.quantize:
+            vertex_data, position_offset, position_scale, uv_offset, uv_scale = quantize_vertices(vertex_data)
+            dequantize = {"translation": position_offset.tolist(), "scale": position_scale.tolist()}
+            if uv_offset.any() or (uv_scale != 1).any():
+                uv_transform = {"offset": uv_offset.tolist(), "scale": uv_scale.tolist()}
+            normalized = NORMALIZED_ATTRIBUTES
+            self.document.use_extension("KHR_mesh_quantization", required=True)
+
+        index_dtype = self.index_dtype(len(vertex_data))
+
+        # compressed files keep the uncompressed offsets for the fallback buffer but write the encoded data
+        self.align()
+        vertex_offset = self.offset
+        if not self.compress:
+            write_buffers(self.binary, [vertex_data])
+        self.offset += vertex_data.nbytes
+
+        if self.compress:
+            # one interleaved bufferView per vertex block, the codec compresses whole vertices
+            vertex_buffer_view = gltf.BufferView(self.buffer, vertex_offset, vertex_data.nbytes, vertex_data.itemsize,
+                                                 gltf.BufferTarget.ARRAY_BUFFER, name=mesh_name + "Vertex Buffer View")
+            self.compress_buffer_view(vertex_buffer_view, vertex_data, "ATTRIBUTES", len(vertex_data), vertex_data.itemsize)
+            vertex_buffer_views = {key: vertex_buffer_view for key in vertex_data.dtype.names}
+            vertex_accessors = self.generate_structured_array_accessors(vertex_data, vertex_buffer_views,
+                                                                        name=mesh_name + "{key} Accessor",
+                                                                        normalized=normalized, interleaved=True)
+            self.document.add_buffer_view(vertex_buffer_view)
+        else:
+            vertex_buffer_views = self.generate_structured_array_buffer_views(vertex_data, self.buffer, gltf.BufferTarget.ARRAY_BUFFER,
+                                                                         offset=vertex_offset, name=mesh_name + "{key} Buffer View")
+            vertex_accessors = self.generate_structured_array_accessors(vertex_data, vertex_buffer_views,
+                                                                        name=mesh_name + "{key} Accessor",
+                                                                        normalized=normalized)
+            self.document.add_buffer_views(vertex_buffer_views.values())
+        self.document.add_accessors(vertex_accessors.values())
+
+        index_accessor = self.add_array(np.ascontiguousarray(index_data, dtype=index_dtype),
+                                        gltf.BufferTarget.ELEMENT_ARRAY_BUFFER, mesh_name + "Index", "TRIANGLES")
+
+        # LOD levels reuse the vertices and only add an index buffer each
+        lod_accessors = []
+        for level, (ratio, lod_indices, error) in enumerate(lods or [], 1):
+            lod_name = mesh_name + " LOD" + str(level)
+            lod_accessors.append((lod_name, ratio, self.add_array(np.ascontiguousarray(lod_indices, dtype=index_dtype),
+                                                                  gltf.BufferTarget.ELEMENT_ARRAY_BUFFER,
+                                                                  lod_name + "Index", "TRIANGLES")))
+        return {"vertex_accessors": vertex_accessors, "index_accessor": index_accessor, "lods": lod_accessors,
+                "dequantize": dequantize, "uv_transform": uv_transform}
+
+    def image_texture(self, uri):
+        """Texture for an image uri, every image and texture is added once."""
+        texture = self.textures.get(uri)
+        if texture is None:
+            image = gltf.Image(uri=uri)
+            self.document.add_image(image)
+            texture = gltf.Texture(source=image, sampler=self.document.samplers[0])
+            self.document.add_texture(texture)
+            self.textures[uri] = texture
+        return texture
+
+    def material(self, textures, alpha_threshold, alpha_blend, alpha_test, glossiness, unrealmode, uv_transform):
+        """Material for a texture set and alpha flags, shapes with the same parameters share one."""
+        key = (tuple(textures[:3]), alpha_threshold, alpha_blend, alpha_test, glossiness, unrealmode,
+               json.dumps(uv_transform, sort_keys=True))
+        mesh_material = self.materials.get(key)
+        if mesh_material is None:
+            mesh_material = self.add_material(textures, alpha_threshold, alpha_blend, alpha_test, glossiness,
+                                              unrealmode, uv_transform)
+            self.materials[key] = mesh_material
+        return mesh_material
+
+    def add_material(self, textures, alpha_threshold, alpha_blend, alpha_test, glossiness, unrealmode, uv_transform):
         mesh_material = gltf.Material()
         mesh_material.emissiveFactor = [3.0, 3.0, 3.0]
         alpha_enabled = 0.001
@@ -154,11 +452,8 @@ class GLTFFile:
         print(alpha_enabled)
 
         if len(textures) > 0:
-            diffuse = gltf.Image(uri=textures[0])
-            self.document.add_image(diffuse)
-            diffuse_tex = gltf.Texture(source=diffuse, sampler=self.document.samplers[0])
-            self.document.add_texture(diffuse_tex)
-            diffuse_tex_info = gltf.TextureInfo(index=diffuse_tex)
+            diffuse_tex = self.image_texture(textures[0])
+            diffuse_tex_info = self.texture_info(diffuse_tex, uv_transform)
 
             pbr = None
 
@@ -168,78 +463,229 @@ class GLTFFile:
                 pbr = gltf.PBRMetallicRoughness(baseColorTexture=diffuse_tex_info, roughnessFactor=self.normalize_factor(glossiness), metallicFactor=0.00001)
             mesh_material.pbrMetallicRoughness = pbr
         if len(textures) > 1:
-            normmap = gltf.Image(uri=textures[1])
-            self.document.add_image(normmap)
-            normmap_tex = gltf.Texture(source=normmap, sampler=self.document.samplers[0])
-            self.document.add_texture(normmap_tex)
-            diffuse_tex_info = gltf.TextureInfo(index=normmap_tex)
+            normmap_tex = self.image_texture(textures[1])
+            diffuse_tex_info = self.texture_info(normmap_tex, uv_transform)
 
             mesh_material.normalTexture = diffuse_tex_info
         if len(textures) > 2:
-            emissive = gltf.Image(uri=textures[2])
-            self.document.add_image(emissive)
-            emissive_tex = gltf.Texture(source=emissive, sampler=self.document.samplers[0])
-            self.document.add_texture(emissive_tex)
-            diffuse_tex_info = gltf.TextureInfo(index=emissive_tex)
+            emissive_tex = self.image_texture(textures[2])
+            diffuse_tex_info = self.texture_info(emissive_tex, uv_transform)
 
             mesh_material.emissiveTexture = diffuse_tex_info
-        if len(textures) > 3:
-            height = gltf.Image(uri=textures[3])
 
         self.document.add_material(mesh_material)
+        return mesh_material
 
-        self.buffers.append(vertex_data)
-        self.buffers.append(index_data)
-
-        self.buffer = gltf.Buffer(self.byteLength(self.buffers), uri=self.bin_path, name="Default Buffer")
-
-        vertex_buffer_views = self.generate_structured_array_buffer_views(vertex_data, self.buffer, gltf.BufferTarget.ARRAY_BUFFER,
-                                                                     offset=self.offset, name=mesh_name + "{key} Buffer View")
-
-        self.offset += vertex_data.nbytes
-        print(self.offset)
-        index_buffer_view = self.generate_array_buffer_view(index_data, self.buffer, gltf.BufferTarget.ELEMENT_ARRAY_BUFFER,
-                                                       offset=self.offset, name=mesh_name + "Index Buffer View")
-
-        self.offset += index_data.nbytes
-        print(self.offset)
-
-        vertex_accessors = self.generate_structured_array_accessors(vertex_data, vertex_buffer_views, name=mesh_name + "{key} Accessor")
-        index_accessor = self.generate_array_accessor(index_data, index_buffer_view, name=mesh_name + "Index Accessor")
-
-        primitive = gltf.Primitive(vertex_accessors, index_accessor, mesh_material, gltf.PrimitiveMode.TRIANGLES)
-
-        self.document.add_buffer_views(vertex_buffer_views.values())
-        self.document.add_buffer_view(index_buffer_view)
-
-        self.document.add_accessors(vertex_accessors.values())
-        self.document.add_accessor(index_accessor)
-
-        mesh.primitives.append(primitive)
+    def add_meshes(self, geometry, mesh_material, mesh_name):
+        """Mesh of a shape and of each of its LOD levels with one material."""
+        mesh = gltf.Mesh([gltf.Primitive(geometry["vertex_accessors"], geometry["index_accessor"], mesh_material,
+                                         gltf.PrimitiveMode.TRIANGLES)], name=mesh_name)
         self.document.add_mesh(mesh)
-        loc, rot, sca = transform_matrix.decompose()
-        loc = [loc.x, loc.y, loc.z]
-        rot = [rot.x, rot.y, rot.z, rot.w]
-        sca = [sca.x, sca.y, sca.z]
-
-        self.document.add_node(gltf.Node(name=mesh_name, mesh=mesh, translation=loc, rotation=rot, scale=sca))
+        lod_meshes = []
+        for lod_name, ratio, lod_accessor in geometry["lods"]:
+            lod_mesh = gltf.Mesh([gltf.Primitive(geometry["vertex_accessors"], lod_accessor, mesh_material,
+                                                 gltf.PrimitiveMode.TRIANGLES)], name=lod_name)
+            self.document.add_mesh(lod_mesh)
+            lod_meshes.append((lod_name, ratio, lod_mesh))
+        return {"mesh": mesh, "lods": lod_meshes, "dequantize": geometry["dequantize"]}
+
+    def add_array(self, data, target, name, mode="ATTRIBUTES"):
+        """Write an array and add its bufferView and accessor, returns the accessor.
+        Compressed files encode it with the attribute or the triangle (index) codec."""
+        self.align()
+        offset = self.offset
+        if not self.compress:
+            write_buffers(self.binary, [data])
+        self.offset += data.nbytes
+
+        buffer_view = self.generate_array_buffer_view(data, self.buffer, target, offset=offset,
+                                                      name=name + " Buffer View")
+        if self.compress:
+            # from the dtype, an empty array still has the stride of its elements
+            stride = data.itemsize * (data.shape[1] if data.ndim > 1 else 1)
+            self.compress_buffer_view(buffer_view, data, mode, len(data), stride)
+        accessor = self.generate_array_accessor(data, buffer_view, name=name + " Accessor")
+        self.document.add_buffer_view(buffer_view)
+        self.document.add_accessor(accessor)
+        return accessor
+
+    def add_shape_node(self, instance):
+        """Node for one shape, with MSFT_lod nodes for its LOD levels."""
+        meshes = instance["meshes"]
+        transform = (instance["translation"], instance["rotation"], instance["scale"])
+        lod_nodes = [self.add_mesh_node(lod_mesh, instance["name"] + " LOD" + str(level), *transform,
+                                        meshes["dequantize"])
+                     for level, (lod_name, ratio, lod_mesh) in enumerate(meshes["lods"], 1)]
+        node = self.add_mesh_node(meshes["mesh"], instance["name"], *transform, meshes["dequantize"])
+        self.add_lod_extension(node, lod_nodes, meshes["lods"])
+        return node
+
+    def add_lod_extension(self, node, lod_nodes, lods):
+        if not lod_nodes:
+            return
+        # LOD nodes replace the node as a whole and aren't in the scene themselves
+        self.document.use_extension("MSFT_lod")
+        node.extensions = dict(node.extensions or {}, MSFT_lod={"ids": [lod_node.key for lod_node in lod_nodes]})
+        coverage = [LOD_SCREEN_COVERAGE * ratio for lod_name, ratio, lod_mesh in lods]
+        node.extras = {"MSFT_screencoverage": [LOD_SCREEN_COVERAGE] + coverage[:-1] + [0.0]}
+
+    def add_instanced_node(self, instances):
+        """One node drawing all shapes that share a mesh with EXT_mesh_gpu_instancing.
+
+        The dequantization of quantized meshes is folded into the instance transforms, the
+        instance transform is applied after it: translation t + R(s * dt) and scale s * ds."""
+        meshes = instances[0]["meshes"]
+        name = instances[0]["name"]
+        translation = np.array([instance["translation"] for instance in instances], dtype=np.float64)
+        rotation = np.array([instance["rotation"] for instance in instances], dtype=np.float64)
+        scale = np.array([instance["scale"] for instance in instances], dtype=np.float64)
+        if meshes["dequantize"] is not None:
+            offset = scale * np.array(meshes["dequantize"]["translation"])
+            # rotate the offsets by the unit quaternions (x, y, z, w)
+            axis = rotation[:, :3]
+            turned = 2 * np.cross(axis, offset)
+            translation += offset + rotation[:, 3:] * turned + np.cross(axis, turned)
+            scale = scale * np.array(meshes["dequantize"]["scale"])
+
+        self.document.use_extension("EXT_mesh_gpu_instancing", required=True)
+        attributes = {}
+        for attribute, values in (("TRANSLATION", translation), ("ROTATION", rotation), ("SCALE", scale)):
+            accessor = self.add_array(np.ascontiguousarray(values, dtype=np.float32), None,
+                                      name + " Instance " + attribute.title())
+            attributes[attribute] = accessor.key
+        extensions = {"EXT_mesh_gpu_instancing": {"attributes": attributes}}
+
+        lod_nodes = []
+        for lod_name, ratio, lod_mesh in meshes["lods"]:
+            lod_node = gltf.Node(name=lod_name, mesh=lod_mesh, extensions=extensions)
+            self.document.add_node(lod_node)
+            lod_nodes.append(lod_node)
+        node = gltf.Node(name=name, mesh=meshes["mesh"], extensions=extensions)
+        self.document.add_node(node)
+        self.add_lod_extension(node, lod_nodes, meshes["lods"])
+        return node
+
+    def add_nodes(self):
+        """Scene nodes for all shapes. With gpu_instancing the shapes that share a mesh are drawn by
+        one node, they are all siblings at the root of the scene."""
+        groups = {}
+        for instance in self.instances:
+            groups.setdefault(id(instance["meshes"]), []).append(instance)
+        for instance in self.instances:
+            group = groups[id(instance["meshes"])]
+            if not self.gpu_instancing or len(group) == 1:
+                self.root_nodes.append(self.add_shape_node(instance))
+            elif instance is group[0]:
+                self.root_nodes.append(self.add_instanced_node(group))
+
+    def add_mesh_node(self, mesh, name, loc, rot, sca, dequantize):
+        """Node with the shape transform for a mesh, quantized meshes get a child that dequantizes them."""
+        if dequantize is None:
+            node = gltf.Node(name=name, mesh=mesh, translation=loc, rotation=rot, scale=sca)
+        else:
+            # the shape transform stays on the node, the child maps the int16 positions back to model units
+            mesh_node = gltf.Node(name=name + " Dequantize", mesh=mesh, **dequantize)
+            self.document.add_node(mesh_node)
+            node = gltf.Node(name=name, children=[mesh_node], translation=loc, rotation=rot, scale=sca)
+        self.document.add_node(node)
+        return node
 
 
     def save(self):
-        self.document.add_buffer(self.buffer)
-        self.document.add_scene(gltf.Scene(name=self.filename, nodes=self.document.nodes))
+        self.add_nodes()
+        if self.compress:
+            self.fallback_buffer.byteLength = self.offset
+            self.buffer.byteLength = self.compressed_offset
+        else:
+            self.buffer.byteLength = self.offset
+        # glTF buffers can't be empty, a file without geometry has none and no .bin file
+        if self.offset > 0:
+            self.document.add_buffer(self.buffer)
+            if self.compress:
+                self.document.add_buffer(self.fallback_buffer)
+        self.document.add_scene(gltf.Scene(name=self.filename, nodes=self.root_nodes))
         data = self.document.togltf()
+        if self.glb:
+            self.write_glb(data)
+            return
         with open(self.gltf_path, 'w') as f:
             json.dump(data, f, indent=2)
 
-        with open(self.bin_path, 'wb') as f:
-            for buffer in self.buffers:
-                f.write(buffer.tobytes())
-
-    def __init__(self, name, gltf_path, bin_path):
+        if self.offset == 0:
+            self.discard()
+            # a .bin file left from a previous conversion with geometry
+            if os.path.isfile(self.bin_path):
+                os.remove(self.bin_path)
+            self.bin_path = None
+            return
+        # the shapes are in the .bin file already
+        self.binary.close()
+        os.replace(self.bin_path + PARTIAL_SUFFIX, self.bin_path)
+
+    def discard(self):
+        """Close the binary buffer and remove the .partial file of a GLTF file that won't be saved."""
+        self.binary.close()
+        if not self.glb and os.path.isfile(self.bin_path + PARTIAL_SUFFIX):
+            os.remove(self.bin_path + PARTIAL_SUFFIX)
+
+    def write_glb(self, data):
+        """Write the document and the binary buffer as one GLB file in a single pass.
+
+        Chunk lengths are known from the buffer offsets, so the header and the json are written
+        first and the spooled binary data is copied after them in chunks."""
+        json_chunk = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        # the json chunk is padded with spaces and the binary chunk with zeros to 4 bytes
+        json_chunk += b" " * (-len(json_chunk) % 4)
+        binary_length = self.buffer.byteLength
+        binary_padding = -binary_length % 4
+        total_length = 12 + 8 + len(json_chunk) + (8 + binary_length + binary_padding if binary_length else 0)
+
+        with open(self.gltf_path, 'wb') as f:
+            f.write(struct.pack("<III", GLB_MAGIC, GLB_VERSION, total_length))
+            f.write(struct.pack("<II", len(json_chunk), GLB_CHUNK_JSON))
+            f.write(json_chunk)
+            if binary_length:
+                f.write(struct.pack("<II", binary_length + binary_padding, GLB_CHUNK_BIN))
+                self.binary.seek(0)
+                shutil.copyfileobj(self.binary, f, 2 ** 20)
+                f.write(PADDING[:binary_padding])
+        self.binary.close()
+
+    def __init__(self, name, gltf_path, bin_path, quantize=False, compress=False, gpu_instancing=False, glb=False):
         self.document = gltf.Document()
+        self.root_nodes = []
+        self.instances = []
+        self.geometries = {}
+        self.meshes = {}
+        self.materials = {}
+        self.textures = {}
+        self.instanced_shapes = 0
+        self.quantize = quantize
+        self.compress = compress
+        self.gpu_instancing = gpu_instancing
+        self.glb = glb
         self.offset = 0
+        self.compressed_offset = 0
+        self.compression_stats = {"bytes": 0, "compressed_bytes": 0, "seconds": 0.0}
         self.document.add_sampler(gltf.Sampler())
         self.filename = name
         self.gltf_path = gltf_path
         self.bin_path = bin_path
+        # the binary chunk of a GLB file is its first buffer, without a uri. A .bin file is referenced
+        # relative to the .gltf file so the output folder can be moved
+        uri = None
+        if not glb:
+            uri = os.path.relpath(os.path.abspath(self.bin_path), os.path.dirname(os.path.abspath(self.gltf_path)))
+            uri = uri.replace("\\", "/")
+        self.buffer = gltf.Buffer(0, uri=uri, name="Default Buffer")
+        if compress:
+            # decoders fill this buffer, it has no data of its own
+            self.fallback_buffer = gltf.Buffer(0, name="Fallback Buffer",
+                                               extensions={"EXT_meshopt_compression": {"fallback": True}})
+            self.document.use_extension("EXT_meshopt_compression", required=True)
+        # shapes are written as they are added, memory holds one shape at a time instead of the whole file
+        if glb:
+            # the binary chunk comes after the json, which is only known on save
+            self.binary = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        else:
+            self.binary = open(self.bin_path + PARTIAL_SUFFIX, 'wb', buffering=0)
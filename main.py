@@ -1,10 +1,18 @@
 import os
+import time
 from colorama import init
-import subprocess as sp
-import psutil
 import argparse
 from colorama import Fore, Back, Style
-init()
+from worker_pool import WorkerPool
+from scheduler import JobScheduler
+from manifest import Manifest
+from build_db import BuildDatabase, options_key
+from texture_store import TextureStore
+from texture_stage import TextureStage
+from cost_model import CostEstimator
+from shard import parse_shard, shard_folder, partition, estimated_cost, save_report
+import meshopt
+import simplifier
 
 parser = argparse.ArgumentParser(description='Process lots of NIF files at once.')
 parser.add_argument('InFolder',
@@ -22,125 +30,334 @@ parser.add_argument('MaxProcesses',
                        type=int,
                        help='the maximum number of processes allowed to be running at a time')
 
-args = parser.parse_args()
-print(args)
+parser.add_argument("-u","--unrealmode",action="store_true",help="Pipes the alpha state into the metalness parameter of the material as many Unreal GLTF importers dont support different types of transparency")
 
-DETACHED_PROCESS = 0x00000008
+parser.add_argument("--optimize",
+                       action="store_true",
+                       help='weld identical vertices and reorder triangles and vertices for the GPU vertex cache')
 
-MAX_MESH_JOBS = args.MaxProcesses
-MAX_TEXTURE_JOBS = args.MaxProcesses * 2
+parser.add_argument("--quantize",
+                       action="store_true",
+                       help='write 16 and 8 bit vertex attributes with KHR_mesh_quantization instead of 32 bit floats')
 
+parser.add_argument("--compress",
+                       action="store_true",
+                       help='compress vertex and index data with EXT_meshopt_compression')
+
+parser.add_argument("--lod",
+                       type=simplifier.parse_ratios,
+                       nargs="?",
+                       const=simplifier.DEFAULT_LOD_RATIOS,
+                       help='add MSFT_lod levels with these triangle ratios, 0.5,0.25,0.125 without a value')
+
+parser.add_argument("--gpu-instancing",
+                       action="store_true",
+                       help='draw shapes that repeat the same mesh with one EXT_mesh_gpu_instancing node')
+
+parser.add_argument("--geometry-cache",
+                       action="store_true",
+                       help='keep the extracted shapes in cache/geometry in the output folder and reuse them for unchanged NIF files')
+
+parser.add_argument("--flatten",
+                       action="store_true",
+                       help='bake shape transforms into the vertices and merge shapes with the same material into one mesh')
+
+parser.add_argument("--glb",
+                       action="store_true",
+                       help='write one binary .glb file instead of a .gltf and a .bin file')
+
+parser.add_argument("--manifest",
+                       type=str,
+                       help='where to write the input manifest (defaults to manifest.json in the output folder)')
+
+parser.add_argument("--reuse-manifest",
+                       action="store_true",
+                       help='load the manifest from a previous run instead of scanning the input folder again')
+
+parser.add_argument("--build-db",
+                       type=str,
+                       help='the build database used to skip unchanged files (defaults to build.db in the output folder)')
+
+parser.add_argument("--rebuild",
+                       action="store_true",
+                       help='convert every file again, even if the build database says it is up to date')
+
+parser.add_argument("--texture-converter",
+                       choices=["native", "vips"],
+                       default="native",
+                       help='convert DDS files with the built in numpy decoder (default) or the bundled windows vips.exe')
+
+parser.add_argument("--texture-workers",
+                       type=int,
+                       help='the number of texture conversion workers (defaults to twice maxproc)')
+
+parser.add_argument("--referenced-textures",
+                       action="store_true",
+                       help="convert meshes first and then only the textures they reference")
+
+parser.add_argument("--texture-pool",
+                       choices=["thread", "process"],
+                       default="thread",
+                       help='run texture conversion on threads (default) or on a pool of processes')
+
+parser.add_argument("--shard",
+                       type=parse_shard,
+                       help='convert only part K of N of the batch, for example 2/4, merge the shards with shard.py afterwards')
+
+
+def execute(args):
+    MAX_MESH_JOBS = args.MaxProcesses
+    MAX_TEXTURE_JOBS = args.texture_workers if args.texture_workers else args.MaxProcesses * 2
 
-def execute():
     print(Fore.LIGHTGREEN_EX +
           "Welcome to DekuTree's NIF to GLTF batch conversion utility.")
     print("Please wait while NIF files are converted!")
 
-    mesh_process_count = 0
-    texture_process_count = 0
-    mesh_pids = []
-    texture_pids = []
-
     in_folder = args.InFolder
     out_folder = args.OutFolder
 
     # debug
-    mesh_root = os.path.join(in_folder, "meshes")
-    #mesh_root = os.path.join(in_folder, "meshes", "architecture", "whiterun", "wrbuildings")
-    #mesh_root = os.path.join(in_folder, "meshes")
+    mesh_prefix = "meshes"
+    #mesh_prefix = "meshes/architecture/whiterun/wrbuildings"
 
-    #mesh_root = os.path.join(in_folder, "meshes")
     texture_root = os.path.join(in_folder)
 
-    print(Fore.YELLOW + "Scanning directories for DDS files!")
-    current_dds_count = 0
-    max_dds_files = 0
-    for dirpath, dirs, files in os.walk(mesh_root):
-        for file in files:
-            if "actors" not in dirpath and "animobjects" not in dirpath:
-                if ".nif" in file:
-                    max_dds_files += 1
+    # a shard keeps its manifest, build database, texture index and report in its own folder,
+    # everything else is written to the shared output folder
+    state_folder = shard_folder(out_folder, args.shard) if args.shard else out_folder
+    start = time.perf_counter()
+
+    # one scan of the input tree, every later stage runs from the manifest
+    manifest_path = args.manifest if args.manifest else os.path.join(state_folder, "manifest.json")
+    manifest = Manifest.load_or_scan(manifest_path, in_folder, args.reuse_manifest)
+    nif_entries = manifest.files("nif", mesh_prefix)
+    dds_entries = manifest.files("dds", "textures")
+
+    if args.shard:
+        # every machine computes the same split from the same manifest, no coordination needed
+        shard_index, shard_count = args.shard
+        nif_entries = partition(nif_entries, shard_count)[shard_index - 1]
+        if not args.referenced_textures:
+            dds_entries = partition(dds_entries, shard_count)[shard_index - 1]
+        print(Fore.YELLOW + "Shard " + str(shard_index) + "/" + str(shard_count) + ": converting " +
+              str(len(nif_entries)) + " NIF files, " + "{:.1f}".format(
+                  sum(estimated_cost(entry) for entry in nif_entries) / (1 << 20)) + " MB")
+
+    max_dds_files = len(dds_entries)
     print("Done: Found " + str(max_dds_files) + " DDS files!")
 
-    print(Fore.YELLOW + "Scanning directories for NIF files!")
     current_nif_count = 0
-    max_nif_files = 0
-    for dirpath, dirs, files in os.walk(mesh_root):
-        for file in files:
-            if "actors" not in dirpath and "animobjects" not in dirpath:
-                if ".nif" in file:
-                    max_nif_files += 1
+    max_nif_files = len(nif_entries)
     print("Done: Found " + str(max_nif_files) + " NIF files!")
 
-    print("Converting textures")
-    for dirpath, dirs, files in os.walk(os.path.join(texture_root, "textures")):
-        for file in files:
-            if "actors" not in dirpath and "animobjects" not in dirpath:
-                if ".dds" in file:
-                    startupinfo = sp.STARTUPINFO()
-                    startupinfo.dwFlags |= sp.STARTF_USESHOWWINDOW
-                    output_path = os.path.join(out_folder, os.path.relpath(
-                        os.path.join(dirpath, file).replace(".dds", ".png"), in_folder))
-
-                    if not os.path.isfile(output_path):
-                        # generate output folder structure
-                        if not os.path.exists(os.path.dirname(output_path)):
-                            os.makedirs(os.path.dirname(output_path))
-
-                        vips = sp.Popen(['vips/vips.exe', "affine", os.path.join(
-                            dirpath, file), output_path, ' 1 0 0 1'], startupinfo=startupinfo).pid
-
-                        texture_process_count += 1
-                        current_dds_count += 1
-                        print(Fore.BLUE + "PID: [" + str(vips) + "] Starting job for " + str(file) + " - " + str(
-                            current_dds_count) + " out of " + str(max_dds_files) + " DDS files.")
-                        texture_pids.append([vips, file, current_dds_count])
-
-                        if texture_process_count > MAX_TEXTURE_JOBS:
-                            print(
-                                Fore.YELLOW + "Reached max job count, waiting for some to finish before starting more.")
-                            while len(texture_pids) > 0:
-                                for p, f, i in texture_pids:
-                                    if not psutil.pid_exists(p):
-                                        print(Fore.GREEN + "PID: [" + str(p) + "] Finished job for " + str(
-                                            f) + " - " + str(i) + " out of " + str(max_dds_files) + " DDS files.")
-                                        texture_pids.remove([p, f, i])
-                                        texture_process_count -= 1
-
-    for dirpath, dirs, files in os.walk(mesh_root):
-        for file in files:
-            if "actors" not in dirpath and "animobjects" not in dirpath:
-                os_path = file
-                split = (os_path.split(os.sep))[-5:]
-                rejoin = os.path.join(*split).replace(os.sep, "/")
-
-                # import all root blocks
-                pid = sp.Popen(["venv/scripts/pythonw", "file_process.py", os.path.join(
-                    dirpath, file), texture_root, in_folder, out_folder], creationflags=DETACHED_PROCESS).pid
-                #pid = sp.Popen(["C:/Program Files/Blender Foundation/Blender 2.91/blender.exe", "--background", "--python", "file_process.py", os.path.join(
-                #    dirpath, file), texture_root, in_folder, out_folder], creationflags=DETACHED_PROCESS).pid
-                mesh_process_count += 1
-                current_nif_count += 1
-                print(Fore.BLUE + "PID: [" + str(pid) + "] Starting job for " + str(file) + " - " + str(
-                    current_nif_count) + " out of " + str(max_nif_files) + " NIF files.")
-                mesh_pids.append([pid, file, current_nif_count])
-
-                if mesh_process_count > MAX_MESH_JOBS:
-                    print(
-                        Fore.YELLOW + "Reached max job count, waiting for some to finish before starting more.")
-                    while len(mesh_pids) > 0:
-                        for p, f, i in mesh_pids:
-                            if not psutil.pid_exists(p):
-                                print(Fore.GREEN + "PID: [" + str(p) + "] Finished job for " + str(
-                                    f) + " - " + str(i) + " out of " + str(max_dds_files) + " NIF files.")
-                                mesh_pids.remove([p, f, i])
-                                mesh_process_count -= 1
+    # the build database lets a re-run skip everything whose sources, options and outputs are unchanged
+    # shards share the output folder across machines, where the WAL's shared memory doesn't work
+    build_db = BuildDatabase(args.build_db if args.build_db else os.path.join(state_folder, "build.db"),
+                             wal=not args.shard)
+    texture_options = options_key({"converter": args.texture_converter})
+    convert_options = {"optimize": args.optimize, "quantize": args.quantize, "compress": args.compress,
+                       "lod": args.lod, "gpu_instancing": args.gpu_instancing,
+                       "geometry_cache": args.geometry_cache, "flatten": args.flatten,
+                       "glb": args.glb}
+    # options left at their default don't change the key, so builds from before they existed stay valid,
+    # and the geometry cache only changes how the output is made
+    mesh_options = options_key(dict({key: value for key, value in convert_options.items()
+                                     if value and key != "geometry_cache"}, unrealmode=args.unrealmode))
+
+    dds_by_path = {entry.path.lower(): entry for entry in manifest.files("dds", excluded=())}
+    texture_hashes = {}
+
+    def texture_hash(path):
+        """Current hash of a texture referenced by a NIF, or None if it doesn't exist or can't be read."""
+        if path not in texture_hashes:
+            entry = dds_by_path.get(path)
+            texture_hashes[path] = None if entry is None else build_db.hash_for(entry, manifest.abspath(entry))
+        return texture_hashes[path]
+
+    texture_store = TextureStore(out_folder, index_path=os.path.join(state_folder, "index.json")
+                                 if args.shard else None)
+    report_results = []
+    report_textures = []
+
+    def convert_textures(entries):
+        """Convert entries into the texture store and record them in the build database."""
+        # every unique DDS is converted once into the content addressed store, keyed by its hash.
+        # hashing feeds a bounded queue so it never runs far ahead of the conversion threads
+        current_dds_count = 0
+        texture_stage = TextureStage(texture_store, MAX_TEXTURE_JOBS, args.texture_converter,
+                                     args.texture_pool == "process")
+        report_textures.extend(entry.path for entry in entries)
+        # large textures first, they take the longest to decode
+        entries = sorted(entries, key=lambda entry: (-entry.size, entry.path))
+        for result in texture_stage.run(entries, lambda entry: texture_hash(entry.path.lower()), manifest.abspath,
+                                        args.rebuild):
+            current_dds_count += 1
+            report_results.append({"path": result["job"]["entry"].path, "kind": "dds", "status": result["status"],
+                                   "seconds": result["seconds"], "error": result["error"]})
+            if result["status"] == "ok":
+                print(Fore.GREEN + "Finished job for " + os.path.basename(result["job"]["entry"].path) + " in " +
+                      "{:.2f}".format(result["seconds"]) + "s - " + str(current_dds_count) +
+                      " DDS files converted. (" + texture_stage.status() + ")")
+            else:
+                print(Fore.RED + "Failed job for " + os.path.basename(result["job"]["entry"].path) + " - " +
+                      result["error"])
+        texture_store.save_index()
+        print(Fore.YELLOW + "Textures done: " + texture_stage.summary())
+
+        # remember texture hashes so the next run only rehashes files whose size or mtime changed
+        for entry in entries:
+            content_hash = texture_hash(entry.path.lower())
+            row = build_db.get(entry.path)
+            status = "ok" if content_hash is not None and texture_store.has(content_hash) else "error"
+            if row is None or row["hash"] != content_hash or row["mtime"] != entry.mtime or row["status"] != status:
+                # textures that went missing since the scan have no hash and nothing in the store
+                build_db.record(entry, content_hash, texture_options,
+                                [texture_store.path(content_hash)] if content_hash is not None else [],
+                                status=status)
+
+    if args.referenced_textures:
+        # textures are converted after the meshes, once we know which ones they use. Hashes that
+        # the build database still trusts are handed to the workers so they don't reread those files
+        for entry in dds_entries:
+            content_hash = build_db.known_hash(entry)
+            if content_hash is not None:
+                texture_store.index[entry.path.lower()] = content_hash
+    else:
+        print("Converting textures")
+        convert_textures(dds_entries)
+
+    # timings of the previous run predict how long each NIF takes, before this run records new ones
+    mesh_costs = CostEstimator(build_db, "nif")
+
+    # only NIFs that are new, changed, failed last time or whose textures changed are converted again
+    nif_by_path = {}
+    referenced_textures = set()
+    for entry in nif_entries:
+        row = build_db.get(entry.path)
+        if not args.rebuild and row is not None:
+            # None for a NIF that went missing since the scan, it's converted again and fails there
+            content_hash = build_db.hash_for(entry, manifest.abspath(entry))
+            if build_db.outdated_reason(entry.path, content_hash, mesh_options, texture_hash) is None:
+                referenced_textures.update(row["dependencies"])
+                continue
+        nif_by_path[manifest.abspath(entry)] = entry
+    print(Fore.YELLOW + str(max_nif_files - len(nif_by_path)) + " NIF files are up to date, converting " +
+          str(len(nif_by_path)))
+    max_nif_files = len(nif_by_path)
+
+    # meshes are converted by long lived workers that import the conversion stack once,
+    # the scheduler keeps exactly one job per worker in flight and refills a slot as soon as it frees up
+    print(Fore.YELLOW + "Starting " + str(MAX_MESH_JOBS) + " conversion workers")
+    failed_nifs = []
+    with WorkerPool(MAX_MESH_JOBS, texture_root, in_folder, out_folder, args.unrealmode,
+                    texture_store.index, convert_options) as pool:
+        mesh_scheduler = JobScheduler(pool, MAX_MESH_JOBS, "NIF")
+        # longest jobs first, so the run doesn't end with one huge mesh converting on its own
+        mesh_scheduler.add_all(manifest.abspath(entry) for entry in mesh_costs.order(nif_by_path.values()))
+
+        def finish_nif(path, result):
+            nonlocal current_nif_count
+            current_nif_count += 1
+            for texture, content_hash in result["texture_hashes"].items():
+                texture_hashes.setdefault(texture, content_hash if texture in dds_by_path else None)
+            referenced_textures.update(result["textures"])
+            dependencies = {texture: texture_hash(texture) for texture in result["textures"]}
+            build_db.record(nif_by_path[path], result["hash"], mesh_options, result["outputs"], dependencies,
+                            result["status"], result["seconds"])
+            predicted = mesh_costs.observe(nif_by_path[path], result["seconds"])
+            report_results.append({"path": nif_by_path[path].path, "kind": "nif", "status": result["status"],
+                                   "seconds": result["seconds"], "predicted": predicted,
+                                   "repaired_normals": result["repaired_normals"],
+                                   "rescaled_normals": result["rescaled_normals"], "optimize": result["optimize"],
+                                   "compress": result["compress"], "lod": result["lod"],
+                                   "instanced": result["instanced"], "geometry_cached": result["geometry_cached"],
+                                   "flatten": result["flatten"],
+                                   "error": result.get("error", "")})
+            if result["status"] == "ok":
+                print(Fore.GREEN + "Worker: [" + str(result["worker"]) + "] Finished job for " +
+                      os.path.basename(path) + " in " + "{:.2f}".format(result["seconds"]) + "s - " +
+                      str(current_nif_count) + " out of " + str(max_nif_files) + " NIF files. (" +
+                      mesh_scheduler.status() + ")")
+            else:
+                failed_nifs.append(result)
+                print(Fore.RED + "Worker: [" + str(result["worker"]) + "] Failed job for " +
+                      os.path.basename(path) + " - " + result["error"])
+
         try:
-            print("")
-        except Exception as err:
-            print(
-                "Warning: read failed due corrupt file,"
-                " corrupt format description, or bug. Error: " + str(err))
+            for path, result in mesh_scheduler.run():
+                finish_nif(path, result)
+        except RuntimeError as err:
+            # no worker is left, the jobs the pool failed are reported like any other failure
+            print(Fore.RED + "Stopping the mesh conversion: " + str(err))
+            while pool.failed:
+                result = pool.failed.pop(0)
+                finish_nif(result["path"], result)
+        print(Fore.YELLOW + "Meshes done: " + mesh_scheduler.summary())
+        print(Fore.YELLOW + "Cost estimate: " + mesh_costs.summary())
+        shapes = [stats for result in report_results for stats in result.get("optimize", [])]
+        if shapes:
+            triangles_before = sum(stats["triangles_before"] for stats in shapes)
+            triangles_after = sum(stats["triangles_after"] for stats in shapes)
+            print(Fore.YELLOW + "Optimised " + str(len(shapes)) + " shapes: " +
+                  str(sum(stats["vertices_before"] for stats in shapes)) + " -> " +
+                  str(sum(stats["vertices_after"] for stats in shapes)) + " vertices, ACMR " + "{:.3f}".format(
+                      sum(stats["acmr_before"] * stats["triangles_before"] for stats in shapes) / triangles_before) +
+                  " -> " + "{:.3f}".format(
+                      sum(stats["acmr_after"] * stats["triangles_after"] for stats in shapes) / triangles_after))
+        compressed = [result["compress"] for result in report_results if result.get("compress")]
+        if compressed:
+            print(Fore.YELLOW + "Compressed " + str(len(compressed)) + " NIF files: " + meshopt.format_stats(
+                {key: sum(stats[key] for stats in compressed) for key in ("bytes", "compressed_bytes", "seconds")}))
+        lod_shapes = [stats for result in report_results for stats in result.get("lod", [])]
+        if lod_shapes:
+            print(Fore.YELLOW + "LODs for " + str(len(lod_shapes)) + " shapes: " +
+                  str(sum(len(stats["triangles"]) - 1 for stats in lod_shapes)) + " levels in " +
+                  "{:.1f}".format(sum(stats["seconds"] for stats in lod_shapes)) + "s")
+        if args.geometry_cache:
+            print(Fore.YELLOW + "Geometry cache: " + str(sum(1 for result in report_results if result.get("geometry_cached"))) +
+                  " of " + str(len(report_results)) + " NIF files read from the cache")
+        instanced = sum(result.get("instanced", 0) for result in report_results)
+        if instanced:
+            print(Fore.YELLOW + "Shared meshes with " + str(instanced) + " repeated shapes")
+        flattened = [result["flatten"] for result in report_results if result.get("flatten")]
+        if flattened:
+            print(Fore.YELLOW + "Flattened " + str(sum(stats["shapes"] for stats in flattened)) + " shapes into " +
+                  str(sum(stats["meshes"] for stats in flattened)) + " meshes")
+        broken_normals = [result for result in report_results if result.get("repaired_normals")]
+        if broken_normals:
+            print(Fore.YELLOW + str(len(broken_normals)) + " NIF files had zero or NaN normals, " +
+                  str(sum(result["repaired_normals"] for result in broken_normals)) +
+                  " vertices repaired, see report.json")
+        rescaled_normals = sum(result.get("rescaled_normals", 0) for result in report_results)
+        if rescaled_normals:
+            print(Fore.YELLOW + "Rescaled " + str(rescaled_normals) + " normals that weren't unit length")
+
+    if args.referenced_textures:
+        referenced_entries = [dds_by_path[texture] for texture in sorted(referenced_textures)
+                              if texture in dds_by_path]
+        print("Converting textures: " + str(len(referenced_entries)) + " of " + str(max_dds_files) +
+              " DDS files are referenced by the selected NIF files")
+        convert_textures(referenced_entries)
+    build_db.close()
+
+    save_report(os.path.join(state_folder, "report.json"), {
+        "shard": args.shard,
+        "mesh_prefix": mesh_prefix,
+        "nif": [entry.path for entry in nif_entries],
+        "dds": report_textures,
+        "estimated_cost": sum(estimated_cost(entry) for entry in nif_entries),
+        "seconds": time.perf_counter() - start,
+        "results": report_results,
+    })
+
+    if failed_nifs:
+        print(Fore.YELLOW + str(len(failed_nifs)) + " NIF files failed to convert:")
+        for result in failed_nifs:
+            print(Fore.YELLOW + "    " + result["path"] + ": " + result["error"])
 
 
-execute()
+if __name__ == "__main__":
+    init()
+    args = parser.parse_args()
+    print(args)
+    execute(args)
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import collections
+
+from colorama import Fore
+
+MANIFEST_VERSION = 1
+
+KIND_BY_EXTENSION = {
+    ".nif": "nif",
+    ".dds": "dds",
+}
+
+# folders that are skipped by the batch conversion (animated and rigged meshes aren't supported yet)
+EXCLUDED_FOLDERS = ("actors", "animobjects")
+
+ManifestEntry = collections.namedtuple("ManifestEntry", ["path", "size", "mtime", "kind"])
+
+
+class Manifest:
+    """Listing of every NIF and DDS file below an input folder.
+
+    Paths are stored relative to the input folder with forward slashes, so a manifest
+    can be reused by a later run without walking the directory tree again."""
+
+    root = ""
+    entries = None
+
+    def __init__(self, root, entries=None):
+        self.root = root
+        self.entries = [] if entries is None else entries
+
+    @classmethod
+    def scan(cls, root, folders=("meshes", "textures")):
+        """Walk the given top level folders once and record every file of a known kind."""
+        manifest = cls(root)
+        for folder in folders:
+            top = os.path.join(root, folder)
+            if os.path.isdir(top):
+                manifest.scan_folder(top, folder)
+        manifest.entries.sort(key=lambda entry: entry.path)
+        return manifest
+
+    def scan_folder(self, path, relpath):
+        stack = [(path, relpath)]
+        while stack:
+            path, relpath = stack.pop()
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    entry_relpath = relpath + "/" + dir_entry.name
+                    if dir_entry.is_dir():
+                        stack.append((dir_entry.path, entry_relpath))
+                        continue
+                    kind = KIND_BY_EXTENSION.get(os.path.splitext(dir_entry.name)[1].lower())
+                    if kind is None:
+                        continue
+                    stat = dir_entry.stat()
+                    self.entries.append(ManifestEntry(entry_relpath, stat.st_size, stat.st_mtime, kind))
+
+    def save(self, path):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        data = {
+            "version": MANIFEST_VERSION,
+            "root": os.path.abspath(self.root),
+            "created": time.time(),
+            "entries": [list(entry) for entry in self.entries],
+        }
+        # write next to the target and swap, so an interrupted save never leaves a truncated manifest
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, root=None):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError("unsupported manifest version " + str(data.get("version")) + " in " + path)
+        root = data["root"] if root is None else root
+        return cls(root, [ManifestEntry(*entry) for entry in data["entries"]])
+
+    @classmethod
+    def load_or_scan(cls, path, root, reuse=False):
+        if reuse and os.path.isfile(path):
+            print(Fore.YELLOW + "Reusing manifest " + path)
+            return cls.load(path, root)
+
+        print(Fore.YELLOW + "Scanning " + root + " for NIF and DDS files!")
+        manifest = cls.scan(root)
+        manifest.save(path)
+        return manifest
+
+    def abspath(self, entry):
+        return os.path.join(self.root, *entry.path.split("/"))
+
+    def files(self, kind, prefix=None, excluded=EXCLUDED_FOLDERS):
+        """Entries of one kind, optionally below a relative folder prefix, minus excluded folders."""
+        prefix = None if prefix is None else prefix.replace("\\", "/").strip("/").lower() + "/"
+        result = []
+        for entry in self.entries:
+            if entry.kind != kind:
+                continue
+            lowered = entry.path.lower()
+            if prefix is not None and not lowered.startswith(prefix):
+                continue
+            if any(folder in excluded for folder in lowered.split("/")[:-1]):
+                continue
+            result.append(entry)
+        return result
+
+    def count(self, kind):
+        return sum(1 for entry in self.entries if entry.kind == kind)
@@ -0,0 +1,189 @@
+import numpy as np
+
+# vertex cache size the triangle order is optimised for and measured with, typical for GPUs
+CACHE_SIZE = 16
+
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def vertex_words(vertex_data):
+    """Vertices as rows of 32 bit words, with -0.0 folded into 0.0 so equal values compare equal."""
+    canonical = vertex_data.copy()
+    for name in canonical.dtype.names:
+        if canonical.dtype[name].base.kind == "f":
+            canonical[name] += 0.0
+    return canonical.view(np.uint32).reshape(len(canonical), -1)
+
+
+def vertex_hashes(words):
+    """64 bit FNV-1a hash of every row, computed one column at a time over all rows."""
+    hashes = np.full(len(words), FNV_OFFSET, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in words.T:
+            hashes ^= column.astype(np.uint64)
+            hashes *= FNV_PRIME
+    return hashes
+
+
+def weld_groups(vertex_data):
+    """Group vertices whose attributes are bitwise identical.
+
+    Vertices are grouped by hash and every group is checked against its first vertex, a
+    hash collision falls back to grouping by the full vertex. Returns (first, inverse) as
+    np.unique does, the first vertex of every group and the group of every vertex."""
+    words = vertex_words(vertex_data)
+    keys, first, inverse = np.unique(vertex_hashes(words), return_index=True, return_inverse=True)
+    if not np.array_equal(words, words[first[inverse]]):
+        rows = np.ascontiguousarray(words).view(np.dtype((np.void, words.shape[1] * 4))).ravel()
+        keys, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return first, inverse.ravel()
+
+
+def weld_vertices(vertex_data, indices):
+    """Merge vertices whose attributes are bitwise identical.
+
+    Welded vertices keep the order of their first occurrence and triangles that collapse to
+    a line or point are dropped. Returns (vertex_data, indices)."""
+    if len(vertex_data) == 0:
+        return vertex_data, indices
+    first, inverse = weld_groups(vertex_data)
+
+    # number the groups by where they first appear
+    order = np.argsort(first)
+    rank = np.empty(len(first), dtype=np.uint32)
+    rank[order] = np.arange(len(first), dtype=np.uint32)
+    remap = rank[inverse]
+
+    triangles = remap[indices].reshape(-1, 3)
+    keep = ((triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) &
+            (triangles[:, 2] != triangles[:, 0]))
+    return vertex_data[first[order]], triangles[keep].ravel()
+
+
+def cache_misses(indices, cache_size=CACHE_SIZE):
+    """Number of vertex shader invocations for an index buffer on a FIFO post-transform cache."""
+    stamps = {}
+    time = 0
+    for index in indices.tolist():
+        stamp = stamps.get(index)
+        # a vertex stays in the cache for cache_size misses after it was loaded
+        if stamp is None or time - stamp >= cache_size:
+            stamps[index] = time
+            time += 1
+    return time
+
+
+def optimize_vertex_cache(indices, vertex_count, cache_size=CACHE_SIZE):
+    """Reorder triangles for post-transform cache locality with Tipsify
+    (Sander, Nehab and Barczak, Fast Triangle Reordering for Vertex Locality and Reduced Overdraw, 2007).
+
+    Triangles are emitted as fans around one vertex at a time. The next fan vertex is picked
+    among the vertices just used, preferring ones that will still be in the cache after
+    their remaining triangles are emitted."""
+    triangles = indices.reshape(-1, 3)
+    triangle_count = len(triangles)
+    if triangle_count == 0:
+        return indices
+
+    # triangles using each vertex, in compressed rows built with numpy
+    corners = triangles.ravel()
+    order = np.argsort(corners, kind="stable")
+    adjacency = (order // 3).tolist()
+    live = np.bincount(corners, minlength=vertex_count)
+    offsets = np.concatenate([[0], np.cumsum(live)]).tolist()
+    live = live.tolist()
+    triangle_list = triangles.tolist()
+
+    stamps = [-cache_size - 1] * vertex_count
+    emitted = [False] * triangle_count
+    dead_ends = []
+    output = []
+    time = cache_size + 1
+    cursor = 0
+    fan = int(corners[0])
+
+    while fan >= 0:
+        candidates = []
+        for triangle in adjacency[offsets[fan]:offsets[fan + 1]]:
+            if emitted[triangle]:
+                continue
+            emitted[triangle] = True
+            for vertex in triangle_list[triangle]:
+                output.append(vertex)
+                dead_ends.append(vertex)
+                candidates.append(vertex)
+                live[vertex] -= 1
+                if time - stamps[vertex] > cache_size:
+                    stamps[vertex] = time
+                    time += 1
+
+        # next fan vertex among the ones just used
+        fan = -1
+        best = -1
+        for vertex in candidates:
+            if live[vertex] > 0:
+                priority = 0
+                if time - stamps[vertex] + 2 * live[vertex] <= cache_size:
+                    priority = time - stamps[vertex]
+                if priority > best:
+                    best = priority
+                    fan = vertex
+
+        if fan < 0:
+            # dead end, go back to a recently used vertex or to the next one with triangles left
+            while dead_ends:
+                vertex = dead_ends.pop()
+                if live[vertex] > 0:
+                    fan = vertex
+                    break
+            while fan < 0 and cursor < vertex_count:
+                if live[cursor] > 0:
+                    fan = cursor
+                cursor += 1
+
+    return np.array(output, dtype=indices.dtype)
+
+
+def optimize_vertex_fetch(vertex_data, indices):
+    """Renumber vertices in the order the index buffer first uses them, dropping unused ones."""
+    used, first = np.unique(indices, return_index=True)
+    order = used[np.argsort(first)]
+    remap = np.zeros(len(vertex_data), dtype=np.uint32)
+    remap[order] = np.arange(len(order), dtype=np.uint32)
+    return vertex_data[order], remap[indices]
+
+
+def cache_stats(indices, vertex_count, cache_size=CACHE_SIZE):
+    """ACMR (vertex shader invocations per triangle) and ATVR (invocations per vertex)."""
+    triangle_count = len(indices) // 3
+    if triangle_count == 0 or vertex_count == 0:
+        return 0.0, 0.0
+    misses = cache_misses(indices, cache_size)
+    return misses / triangle_count, misses / vertex_count
+
+
+def optimize_mesh(vertex_data, indices, cache_size=CACHE_SIZE):
+    """Weld identical vertices, reorder triangles for the vertex cache and vertices for fetch
+    locality. Returns (vertex_data, indices, stats) where stats holds the vertex and
+    triangle counts and the ACMR and ATVR before and after."""
+    indices = np.asarray(indices, dtype=np.uint32)
+    if len(indices) == 0:
+        return vertex_data, indices, None
+    stats = {"vertices_before": len(vertex_data), "triangles_before": len(indices) // 3}
+    stats["acmr_before"], stats["atvr_before"] = cache_stats(indices, len(vertex_data), cache_size)
+
+    vertex_data, indices = weld_vertices(vertex_data, indices)
+    indices = optimize_vertex_cache(indices, len(vertex_data), cache_size)
+    vertex_data, indices = optimize_vertex_fetch(vertex_data, indices)
+
+    stats["vertices_after"] = len(vertex_data)
+    stats["triangles_after"] = len(indices) // 3
+    stats["acmr_after"], stats["atvr_after"] = cache_stats(indices, len(vertex_data), cache_size)
+    return vertex_data, indices, stats
+
+
+def format_stats(stats):
+    return (str(stats["vertices_before"]) + " -> " + str(stats["vertices_after"]) + " vertices, ACMR " +
+            "{:.3f}".format(stats["acmr_before"]) + " -> " + "{:.3f}".format(stats["acmr_after"]) + ", ATVR " +
+            "{:.3f}".format(stats["atvr_before"]) + " -> " + "{:.3f}".format(stats["atvr_after"]))
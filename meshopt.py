@@ -0,0 +1,430 @@
+"""Encoder and decoder for the EXT_meshopt_compression bitstreams, written with numpy.
+
+Implements the vertex codec (mode ATTRIBUTES, version 0) and the index codec (mode TRIANGLES,
+version 1) as specified in
+https://github.com/KhronosGroup/glTF/tree/main/extensions/2.0/Vendor/EXT_meshopt_compression
+The decoders exist so the encoders can be checked with round trips, viewers decode the
+streams themselves.
+"""
+import numpy as np
+
+VERTEX_HEADER = 0xa0
+INDEX_HEADER = 0xe0
+INDEX_VERSION = 1
+
+GROUP_SIZE = 16
+VERTEX_BLOCK_BYTES = 8192
+VERTEX_BLOCK_MAX_ELEMENTS = 256
+TAIL_MIN_SIZE = 32
+
+# codeaux values for triangles whose b and c come from the vertex fifo or are new, the same
+# table the reference encoder uses. It is stored at the end of the index stream.
+CODEAUX_TABLE = bytes([0x00, 0x76, 0x87, 0x56, 0x67, 0x78, 0xa9, 0x86, 0x65, 0x89, 0x68, 0x98, 0x01, 0x69, 0, 0])
+
+# rotations that move the matched edge or the next new vertex to the front of a triangle
+TRIANGLE_ORDER = ((0, 1, 2), (1, 2, 0), (2, 0, 1))
+
+
+class MeshoptError(Exception):
+    pass
+
+
+def vertex_block_size(stride):
+    return min((VERTEX_BLOCK_BYTES // stride) & ~(GROUP_SIZE - 1), VERTEX_BLOCK_MAX_ELEMENTS)
+
+
+def zigzag8(values):
+    return ((values << 1) ^ np.where(values & 0x80, 0xff, 0)).astype(np.uint8)
+
+
+def unzigzag8(values):
+    return ((values >> 1) ^ (-(values & 1).astype(np.int16)).astype(np.uint8)).astype(np.uint8)
+
+
+def pack_groups(groups, bits):
+    """Pack (G, 16) byte groups at 2 or 4 bits per value. Values that don't fit are written as the
+    all ones sentinel and follow the packed bytes in full. Returns (G, 16) padded bytes and lengths."""
+    sentinel = (1 << bits) - 1
+    per_byte = 8 // bits
+    clipped = np.minimum(groups, sentinel).astype(np.uint8)
+    packed = np.zeros((len(groups), GROUP_SIZE // per_byte), dtype=np.uint8)
+    for slot in range(per_byte):
+        # the first value of each byte goes into the most significant bits
+        packed |= clipped[:, slot::per_byte] << (8 - bits * (slot + 1))
+
+    escaped = groups >= sentinel
+    extra = np.cumsum(escaped, axis=1) - 1
+    result = np.zeros((len(groups), GROUP_SIZE + packed.shape[1]), dtype=np.uint8)
+    result[:, :packed.shape[1]] = packed
+    rows, columns = np.nonzero(escaped)
+    result[rows, packed.shape[1] + extra[rows, columns]] = groups[rows, columns]
+    return result[:, :GROUP_SIZE], packed.shape[1] + escaped.sum(axis=1)
+
+
+def encode_groups(groups):
+    """Encode (G, 16) zigzagged deltas with the smallest of the four group encodings.
+    Returns the 2 bit mode of every group, (G, 16) padded encoded bytes and their lengths."""
+    count = len(groups)
+    two_bit, two_bit_length = pack_groups(groups, 2)
+    four_bit, four_bit_length = pack_groups(groups, 4)
+    lengths = np.stack([np.where(groups.any(axis=1), GROUP_SIZE + 1, 0), two_bit_length, four_bit_length,
+                        np.full(count, GROUP_SIZE)], axis=1)
+    # ties go to the raw encoding like the reference encoder, it measures that one first
+    modes = np.argmin(lengths[:, [3, 0, 1, 2]], axis=1)
+    modes = np.array([3, 0, 1, 2])[modes]
+    encoded = np.where((modes == 1)[:, None], two_bit, np.where((modes == 2)[:, None], four_bit, groups))
+    encoded[modes == 0] = 0
+    return modes, encoded.astype(np.uint8), lengths[np.arange(count), modes]
+
+
+def encode_vertex_buffer(data, stride):
+    """Encode count * stride bytes of vertex data with the attribute codec."""
+    if stride <= 0 or stride > 256 or stride % 4:
+        raise MeshoptError("vertex stride has to be a multiple of 4 up to 256, got " + str(stride))
+    view = memoryview(data)
+    # views with a zero in their shape can't be cast
+    if view.nbytes == 0:
+        return bytes([VERTEX_HEADER]) + bytes(max(TAIL_MIN_SIZE, stride))
+    elements = np.frombuffer(view.cast("B"), dtype=np.uint8).reshape(-1, stride)
+    count = len(elements)
+
+    # byte wise deltas against the previous element, the first one against itself (the baseline)
+    previous = np.concatenate([elements[:1], elements[:-1]])
+    deltas = zigzag8(elements - previous)
+
+    block_size = vertex_block_size(stride)
+    block_count = -(-count // block_size)
+    padded = np.zeros((block_count * block_size, stride), dtype=np.uint8)
+    padded[:count] = deltas
+    groups_per_block = block_size // GROUP_SIZE
+    # (block, byte, group, 16)
+    groups = padded.reshape(block_count, groups_per_block, GROUP_SIZE, stride).transpose(0, 3, 1, 2)
+    modes, encoded, lengths = encode_groups(groups.reshape(-1, GROUP_SIZE))
+    modes = modes.reshape(block_count, stride, groups_per_block)
+    encoded = encoded.reshape(block_count, stride, groups_per_block, GROUP_SIZE)
+    lengths = lengths.reshape(block_count, stride, groups_per_block)
+
+    # groups that hold elements, the last block is usually shorter
+    block_elements = np.minimum(block_size, count - np.arange(block_count) * block_size)
+    block_groups = -(-block_elements // GROUP_SIZE)
+    used = np.arange(groups_per_block)[None, :] < block_groups[:, None]
+    lengths = np.where(used[:, None, :], lengths, 0)
+
+    # 2 bit modes of four groups per header byte, first group in the least significant bits
+    header_modes = np.zeros((block_count, stride, -(-groups_per_block // 4) * 4), dtype=np.uint8)
+    header_modes[:, :, :groups_per_block] = np.where(used[:, None, :], modes, 0)
+    header_modes = header_modes.reshape(block_count, stride, -1, 4)
+    headers = (header_modes[..., 0] | (header_modes[..., 1] << 2) | (header_modes[..., 2] << 4) |
+               (header_modes[..., 3] << 6))
+    header_lengths = -(-block_groups // 4)
+
+    # every byte position of every block is its header followed by its groups, gather them with a mask
+    segments = np.concatenate([headers, encoded.reshape(block_count, stride, -1)], axis=2)
+    header_mask = np.arange(headers.shape[2])[None, :] < header_lengths[:, None]
+    group_mask = np.arange(GROUP_SIZE)[None, None, None, :] < lengths[..., None]
+    mask = np.concatenate([np.broadcast_to(header_mask[:, None, :], headers.shape),
+                           group_mask.reshape(block_count, stride, -1)], axis=2)
+
+    tail = bytes(max(TAIL_MIN_SIZE, stride) - stride) + elements[0].tobytes()
+    return bytes([VERTEX_HEADER]) + segments[mask].tobytes() + tail
+
+
+def decode_vertex_buffer(buffer, count, stride):
+    """Decode an attribute stream into a (count, stride) uint8 array."""
+    buffer = bytes(buffer)
+    if not buffer or buffer[0] != VERTEX_HEADER:
+        raise MeshoptError("not a version 0 vertex stream")
+    tail_size = max(TAIL_MIN_SIZE, stride)
+    if len(buffer) < 1 + tail_size:
+        raise MeshoptError("vertex stream is too short")
+    if count == 0:
+        return np.zeros((0, stride), dtype=np.uint8)
+    baseline = np.frombuffer(buffer[-stride:], dtype=np.uint8)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    position = 1
+    block_size = vertex_block_size(stride)
+    deltas = np.zeros((count, stride), dtype=np.uint8)
+    for start in range(0, count, block_size):
+        elements = min(block_size, count - start)
+        groups = -(-elements // GROUP_SIZE)
+        for byte in range(stride):
+            header = data[position:position + -(-groups // 4)]
+            position += len(header)
+            values = np.zeros(groups * GROUP_SIZE, dtype=np.uint8)
+            for group in range(groups):
+                mode = (int(header[group // 4]) >> ((group % 4) * 2)) & 3
+                values[group * GROUP_SIZE:(group + 1) * GROUP_SIZE], position = decode_group(data, position, mode)
+            deltas[start:start + elements, byte] = values[:elements]
+        if position > len(data) - tail_size:
+            raise MeshoptError("vertex stream is truncated")
+    # the deltas are relative to the previous element, a running sum undoes them (mod 256)
+    deltas = unzigzag8(deltas)
+    deltas[0] = (deltas[0] + baseline).astype(np.uint8)
+    return np.cumsum(deltas, axis=0, dtype=np.uint8)
+
+
+def decode_group(data, position, mode):
+    if mode == 0:
+        return np.zeros(GROUP_SIZE, dtype=np.uint8), position
+    if mode == 3:
+        return data[position:position + GROUP_SIZE], position + GROUP_SIZE
+    bits = 2 if mode == 1 else 4
+    per_byte = 8 // bits
+    packed = data[position:position + GROUP_SIZE // per_byte]
+    position += len(packed)
+    shifts = 8 - bits * (np.arange(per_byte) + 1)
+    values = ((packed[:, None] >> shifts[None, :]) & ((1 << bits) - 1)).ravel().astype(np.uint8)
+    escaped = np.nonzero(values == (1 << bits) - 1)[0]
+    values[escaped] = data[position:position + len(escaped)]
+    return values, position + len(escaped)
+
+
+def encode_vbyte(output, value):
+    while True:
+        if value > 127:
+            output.append((value & 127) | 128)
+            value >>= 7
+        else:
+            output.append(value)
+            return
+
+
+def encode_index(output, index, last):
+    delta = (index - last) & 0xffffffff
+    encode_vbyte(output, ((delta << 1) ^ (0xffffffff if delta & 0x80000000 else 0)) & 0xffffffff)
+
+
+def decode_index(data, position, last):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 127) << shift
+        shift += 7
+        if byte < 128:
+            break
+    delta = (value >> 1) ^ (0xffffffff if value & 1 else 0)
+    return (last + delta) & 0xffffffff, position
+
+
+def encode_index_buffer(indices):
+    """Encode a triangle list with the index codec. The triangles are expected in vertex cache
+    order, the codec predicts each triangle from an edge and a vertex FIFO of the ones before."""
+    indices = np.asarray(indices, dtype=np.uint32).ravel()
+    if len(indices) % 3:
+        raise MeshoptError("index count has to be a multiple of 3")
+    triangles = indices.reshape(-1, 3).tolist()
+    codes = bytearray()
+    data = bytearray()
+    edges = [(-1, -1)] * 16
+    edge_offset = 0
+    vertices = [-1] * 16
+    vertex_offset = 0
+    next_index = 0
+    last = 0
+    fec_max = 13
+
+    def find_edge(a, b, c):
+        for i in range(16):
+            e0, e1 = edges[(edge_offset - 1 - i) & 15]
+            if e0 == a and e1 == b:
+                return (i << 2) | 0
+            if e0 == b and e1 == c:
+                return (i << 2) | 1
+            if e0 == c and e1 == a:
+                return (i << 2) | 2
+        return -1
+
+    def find_vertex(v):
+        for i in range(16):
+            if vertices[(vertex_offset - 1 - i) & 15] == v:
+                return i
+        return -1
+
+    for triangle in triangles:
+        edge = find_edge(*triangle)
+        if edge >= 0 and (edge >> 2) < 15:
+            a, b, c = (triangle[i] for i in TRIANGLE_ORDER[edge & 3])
+            fc = find_vertex(c)
+            if 1 <= fc < fec_max:
+                fec = fc
+            elif c == next_index:
+                fec = 0
+                next_index += 1
+            else:
+                fec = 15
+                # strip like sequences step the last free index by one
+                if c + 1 == last:
+                    fec = 13
+                    last = c
+                elif c == last + 1:
+                    fec = 14
+                    last = c
+            codes.append(((edge >> 2) << 4) | fec)
+            if fec == 15:
+                encode_index(data, c, last)
+                last = c
+            if fec == 0 or fec >= fec_max:
+                vertices[vertex_offset] = c
+                vertex_offset = (vertex_offset + 1) & 15
+            edges[edge_offset] = (c, b)
+            edge_offset = (edge_offset + 1) & 15
+            edges[edge_offset] = (a, c)
+            edge_offset = (edge_offset + 1) & 15
+            continue
+
+        rotation = 1 if triangle[1] == next_index else 2 if triangle[2] == next_index else 0
+        a, b, c = (triangle[i] for i in TRIANGLE_ORDER[rotation])
+        reset = False
+        if a == 0 and b == 1 and c == 2 and next_index > 0:
+            # restart numbering, forget the fifo so later triangles can't refer to older vertices
+            reset = True
+            next_index = 0
+            vertices = [-1] * 16
+
+        fb = find_vertex(b)
+        fc = find_vertex(c)
+        if a == next_index:
+            fea = 0
+            next_index += 1
+        else:
+            fea = 15
+        if 0 <= fb < 14:
+            feb = fb + 1
+        elif b == next_index:
+            feb = 0
+            next_index += 1
+        else:
+            feb = 15
+        if 0 <= fc < 14:
+            fec = fc + 1
+        elif c == next_index:
+            fec = 0
+            next_index += 1
+        else:
+            fec = 15
+
+        codeaux = (feb << 4) | fec
+        table_index = CODEAUX_TABLE.find(bytes([codeaux]))
+        if fea == 0 and 0 <= table_index < 14 and not reset:
+            codes.append(0xf0 | table_index)
+        else:
+            codes.append(0xf0 | 14 | fea)
+            data.append(codeaux)
+
+        for vertex, fe in ((a, fea), (b, feb), (c, fec)):
+            if fe == 15:
+                encode_index(data, vertex, last)
+                last = vertex
+        for vertex, fe in ((a, fea), (b, feb), (c, fec)):
+            if fe == 0 or fe == 15:
+                vertices[vertex_offset] = vertex
+                vertex_offset = (vertex_offset + 1) & 15
+        for edge_pair in ((b, a), (c, b), (a, c)):
+            edges[edge_offset] = edge_pair
+            edge_offset = (edge_offset + 1) & 15
+
+    # the table doubles as the padding decoders rely on
+    return bytes([INDEX_HEADER | INDEX_VERSION]) + bytes(codes) + bytes(data) + CODEAUX_TABLE
+
+
+def decode_index_buffer(buffer, count):
+    """Decode a triangle stream into a uint32 index array of count indices."""
+    data = bytes(buffer)
+    if len(data) < 1 + count // 3 + 16 or data[0] != INDEX_HEADER | INDEX_VERSION:
+        raise MeshoptError("not a version 1 index stream")
+    codeaux_table = data[-16:]
+    codes = data[1:1 + count // 3]
+    position = 1 + count // 3
+    edges = [(0, 0)] * 16
+    edge_offset = 0
+    vertices = [0] * 16
+    vertex_offset = 0
+    next_index = 0
+    last = 0
+    output = []
+
+    def push_vertex(vertex, condition=True):
+        nonlocal vertex_offset
+        vertices[vertex_offset] = vertex
+        vertex_offset = (vertex_offset + condition) & 15
+
+    def push_edge(a, b):
+        nonlocal edge_offset
+        edges[edge_offset] = (a, b)
+        edge_offset = (edge_offset + 1) & 15
+
+    for code in codes:
+        if code < 0xf0:
+            a, b = edges[(edge_offset - 1 - (code >> 4)) & 15]
+            fec = code & 15
+            if fec < 13:
+                c = next_index if fec == 0 else vertices[(vertex_offset - 1 - fec) & 15]
+                next_index += fec == 0
+                push_vertex(c, fec == 0)
+            else:
+                if fec == 15:
+                    c, position = decode_index(data, position, last)
+                else:
+                    c = (last + (1 if fec == 14 else -1)) & 0xffffffff
+                last = c
+                push_vertex(c)
+            output += (a, b, c)
+            push_edge(c, b)
+            push_edge(a, c)
+            continue
+
+        if code < 0xfe:
+            codeaux = codeaux_table[code & 15]
+            fea = 0
+        else:
+            codeaux = data[position]
+            position += 1
+            fea = 0 if code == 0xfe else 15
+            if codeaux == 0:
+                next_index = 0
+        feb = codeaux >> 4
+        fec = codeaux & 15
+
+        if fea == 0:
+            a = next_index
+            next_index += 1
+        else:
+            a, position = decode_index(data, position, last)
+            last = a
+        if feb == 0:
+            b = next_index
+            next_index += 1
+        elif feb == 15:
+            b, position = decode_index(data, position, last)
+            last = b
+        else:
+            b = vertices[(vertex_offset - feb) & 15]
+        if fec == 0:
+            c = next_index
+            next_index += 1
+        elif fec == 15:
+            c, position = decode_index(data, position, last)
+            last = c
+        else:
+            c = vertices[(vertex_offset - fec) & 15]
+        output += (a, b, c)
+        push_vertex(a)
+        push_vertex(b, feb == 0 or feb == 15)
+        push_vertex(c, fec == 0 or fec == 15)
+        push_edge(b, a)
+        push_edge(c, b)
+        push_edge(a, c)
+
+    if position > len(data) - 16:
+        raise MeshoptError("index stream is truncated")
+    return np.array(output, dtype=np.uint32)
+
+
+def format_stats(stats):
+    """Compression ratio and encode throughput of a GLTFFile.compression_stats dict."""
+    ratio = stats["bytes"] / stats["compressed_bytes"] if stats["compressed_bytes"] else 0.0
+    throughput = stats["bytes"] / stats["seconds"] / 1e6 if stats["seconds"] else 0.0
+    return (str(stats["bytes"]) + " -> " + str(stats["compressed_bytes"]) + " bytes, ratio " +
+            "{:.2f}".format(ratio) + ", " + "{:.1f}".format(throughput) + " MB/s")
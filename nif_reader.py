@@ -0,0 +1,74 @@
+from pyffi.formats.nif import NifFormat
+
+# blocks NIFFile uses: the scene graph, triangle data, shader, alpha and other properties and
+# texture sets. Collision (bhk*), controllers, interpolators, extra data and skinning are skipped
+GEOMETRY_BLOCKS = tuple(getattr(NifFormat, name) for name in (
+    "NiAVObject", "NiTriBasedGeomData", "NiProperty", "BSShaderTextureSet", "CStreamableAssetData")
+    if hasattr(NifFormat, name))
+
+# the header lists the size of every block from this version on, older files are read in full
+BLOCK_SIZE_VERSION = 0x14020007
+
+
+def needed_block(block_type):
+    """Whether a block type from the header is one of GEOMETRY_BLOCKS, unknown types are not."""
+    # NiDataStream types carry their usage and access after a \x01
+    block_class = getattr(NifFormat, block_type.split("\x01")[0], None)
+    return block_class is not None and issubclass(block_class, GEOMETRY_BLOCKS)
+
+
+def read_geometry(stream):
+    """Read the blocks of a NIF file that geometry conversion needs into a NifFormat.Data.
+
+    The header gives the type and size of every block, blocks that aren't GEOMETRY_BLOCKS are
+    seeked past without being decoded and links to them read as empty. Files older than
+    BLOCK_SIZE_VERSION are read in full by pyffi. Returns (data, stats) with the number of
+    blocks, the number read and the bytes skipped."""
+    data = NifFormat.Data()
+    start = stream.tell()
+    data.inspect_version_only(stream)
+    if data.version < BLOCK_SIZE_VERSION:
+        stream.seek(start)
+        data.read(stream)
+        return data, {"blocks": len(data.blocks), "read": len(data.blocks), "skipped_bytes": 0}
+    data.header.read(stream, data=data)
+
+    # the same state pyffi's Data.read keeps, so blocks read and link themselves as usual
+    data.roots = []
+    data.blocks = []
+    data._link_stack = []
+    data._string_list = [string for string in data.header.strings]
+    data._block_dct = {}
+
+    header = data.header
+    offset = stream.tell()
+    skipped_bytes = 0
+    for index in range(header.num_blocks):
+        size = header.block_size[index]
+        block_type = header.block_types[header.block_type_index[index] & 0xfff].decode("ascii")
+        if needed_block(block_type):
+            stream.seek(offset)
+            block = getattr(NifFormat, block_type)()
+            block.read(stream, data)
+            data._block_dct[index] = block
+            data.blocks.append(block)
+        else:
+            skipped_bytes += size
+        offset += size
+
+    stream.seek(offset)
+    footer = NifFormat.Footer()
+    footer.read(stream, data)
+
+    # links are popped in the order they were read, links into skipped blocks become empty ones
+    data._link_stack = [index if index in data._block_dct else -1 for index in data._link_stack]
+    for block in data.blocks:
+        block.fix_links(data)
+    footer.fix_links(data)
+    data.roots = [root for root in footer.roots if root is not None]
+    return data, {"blocks": header.num_blocks, "read": len(data.blocks), "skipped_bytes": skipped_bytes}
+
+
+def format_stats(stats):
+    return ("read " + str(stats["read"]) + " of " + str(stats["blocks"]) + " blocks, skipped " +
+            "{:.1f}".format(stats["skipped_bytes"] / 1024) + " KB")
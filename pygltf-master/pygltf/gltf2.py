@@ -156,6 +156,8 @@ class Document(object):
         self.skins        = []
         self.textures     = []
         self.scene        = kwargs.get('scene', None)
+        self.extensionsUsed     = list(kwargs.get('extensionsUsed', []))
+        self.extensionsRequired = list(kwargs.get('extensionsRequired', []))
         
         self.add_accessors(kwargs.get('accessors', []))
         self.add_animations(kwargs.get('animations', []))
@@ -251,9 +253,19 @@ class Document(object):
         for value in values:
             self.add_texture(value)
     
+    def use_extension(self, name, required=False):
+        if name not in self.extensionsUsed:
+            self.extensionsUsed.append(name)
+        if required and name not in self.extensionsRequired:
+            self.extensionsRequired.append(name)
+
     def togltf(self):
         result = {}
         result["asset"] = self.asset
+        if self.extensionsUsed:
+            result["extensionsUsed"] = self.extensionsUsed
+        if self.extensionsRequired:
+            result["extensionsRequired"] = self.extensionsRequired
         if self.buffers:
             result["buffers"]     = [buffer.togltf()      for buffer      in self.buffers]
         if self.bufferViews:
@@ -294,7 +306,7 @@ class Accessor(Object):
         self.bufferView = bufferView
         self.byteOffset = byteOffset
         self.componentType = componentType
-        self.normalized = False
+        self.normalized = kwargs.get("normalized", False)
         self.count = count
         self.type = type
         self.max = kwargs.get("max")
@@ -308,6 +320,8 @@ class Accessor(Object):
         result["type"] = self.type.value
         if self.byteOffset is not None:
             result["byteOffset"] = self.byteOffset
+        if self.normalized:
+            result["normalized"] = True
         if self.max:
             result["max"] = self.max
         if self.min:
@@ -433,7 +447,7 @@ class BufferView(Object):
         self.target = target
     def togltf(self):
         result = super().togltf()
-        result["buffer"] = 0
+        result["buffer"] = self.buffer.key
         result["byteLength"] = self.byteLength
         if self.byteOffset is not None:
             result["byteOffset"] = self.byteOffset
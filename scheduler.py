@@ -0,0 +1,92 @@
+import time
+import collections
+
+
+class JobScheduler:
+    """Rolling scheduler that keeps exactly `slots` jobs running on a backend.
+
+    A backend needs submit(job) returning a job id and next_result() blocking until
+    any job finishes and returning a dict with that id under "job". As soon as one job
+    completes the next pending job is started, before the result is handed back."""
+
+    def __init__(self, backend, slots, label="jobs"):
+        self.backend = backend
+        self.slots = max(1, slots)
+        self.label = label
+
+        self.pending = collections.deque()
+        self.in_flight = {}
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        # when the last pending job was started, from there on slots only go idle
+        self.drained_at = None
+
+    @property
+    def queue_depth(self):
+        return len(self.pending)
+
+    @property
+    def running(self):
+        return len(self.in_flight)
+
+    def add(self, job):
+        self.pending.append(job)
+
+    def add_all(self, jobs):
+        self.pending.extend(jobs)
+
+    def fill(self):
+        while self.pending and len(self.in_flight) < self.slots:
+            job = self.pending.popleft()
+            job_id = self.backend.submit(job)
+            self.in_flight[job_id] = (job, time.perf_counter())
+            if not self.pending:
+                self.drained_at = time.perf_counter()
+
+    def run(self):
+        """Yield (job, result) pairs in completion order until every job is done."""
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+        self.drained_at = None
+        self.fill()
+        while self.in_flight:
+            result = self.backend.next_result()
+            job, started = self.in_flight.pop(result["job"])
+            self.busy_seconds += time.perf_counter() - started
+            self.completed += 1
+            self.fill()
+            yield job, result
+        self.finished_at = time.perf_counter()
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return end - self.started_at
+
+    def tail(self):
+        """Seconds between starting the last pending job and the end of the run."""
+        if self.drained_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return end - self.drained_at
+
+    def utilisation(self):
+        """Fraction of available slot time that was spent running jobs."""
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        now = time.perf_counter()
+        busy = self.busy_seconds + sum(now - started for job, started in self.in_flight.values())
+        return min(1.0, busy / (self.slots * elapsed))
+
+    def status(self):
+        return ("queue: " + str(self.queue_depth) + ", running: " + str(self.running) + "/" + str(self.slots) +
+                ", utilisation: " + "{:.0%}".format(self.utilisation()))
+
+    def summary(self):
+        return (str(self.completed) + " " + self.label + " jobs in " + "{:.1f}".format(self.elapsed()) + "s on " +
+                str(self.slots) + " slots, utilisation: " + "{:.0%}".format(self.utilisation()) + ", tail: " +
+                "{:.1f}".format(self.tail()) + "s")
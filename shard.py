@@ -0,0 +1,174 @@
+import os
+import re
+import json
+import heapq
+import argparse
+
+from colorama import init, Fore
+
+from manifest import Manifest
+from build_db import BuildDatabase
+from texture_store import TextureStore
+
+SHARD_FOLDER = "shards"
+REPORT_VERSION = 1
+
+SHARD_NAME = re.compile(r"^(\d+)-of-(\d+)$")
+
+
+def parse_shard(value):
+    """argparse type for --shard K/N, where K counts from 1 to N."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected K/N, for example 1/4, got " + repr(value))
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard " + value + " is out of range, K has to be between 1 and N")
+    return index, count
+
+
+def shard_folder(out_folder, shard):
+    """Folder holding the manifest, build database, texture index and report of one shard."""
+    return os.path.join(out_folder, SHARD_FOLDER, str(shard[0]) + "-of-" + str(shard[1]))
+
+
+def estimated_cost(entry):
+    # every file costs at least something, so shards also get a fair share of tiny files
+    return max(1, entry.size)
+
+
+def partition(entries, count, cost=estimated_cost):
+    """Split manifest entries into `count` lists of about equal estimated cost.
+
+    Entries are handed out largest first to the shard with the least work so far. Ties are
+    broken by path and shard number, so every machine computes the same split from the same
+    manifest without talking to the others."""
+    shards = [[] for _ in range(count)]
+    loads = [(0, index) for index in range(count)]
+    for entry in sorted(entries, key=lambda entry: (-cost(entry), entry.path)):
+        load, index = heapq.heappop(loads)
+        shards[index].append(entry)
+        heapq.heappush(loads, (load + cost(entry), index))
+    for shard in shards:
+        shard.sort(key=lambda entry: entry.path)
+    return shards
+
+
+def save_report(path, report):
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    report = dict(report)
+    report["version"] = REPORT_VERSION
+    with open(path + ".tmp", "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def load_report(path):
+    with open(path) as f:
+        report = json.load(f)
+    if report.get("version") != REPORT_VERSION:
+        raise ValueError("unsupported report version " + str(report.get("version")) + " in " + path)
+    return report
+
+
+def find_shards(out_folder):
+    """Shard folders below the output folder that have a finished report, by shard number."""
+    top = os.path.join(out_folder, SHARD_FOLDER)
+    shards = {}
+    if not os.path.isdir(top):
+        return shards
+    for name in sorted(os.listdir(top)):
+        match = SHARD_NAME.match(name)
+        if match and os.path.isfile(os.path.join(top, name, "report.json")):
+            shards[int(match.group(1)), int(match.group(2))] = os.path.join(top, name)
+    return shards
+
+
+def merge(out_folder):
+    """Combine the per shard manifests, build databases, texture indexes and reports of a
+    sharded batch into the files a single machine run would have written."""
+    shards = find_shards(out_folder)
+    if not shards:
+        raise ValueError("no shard reports found in " + os.path.join(out_folder, SHARD_FOLDER))
+    counts = sorted(set(count for index, count in shards))
+    if len(counts) != 1:
+        raise ValueError("shards of different splits found (" + ", ".join("N=" + str(c) for c in counts) +
+                         "), remove the stale shard folders first")
+    count = counts[0]
+    missing = [index for index in range(1, count + 1) if (index, count) not in shards]
+
+    manifest_entries = {}
+    root = None
+    texture_store = TextureStore(out_folder)
+    build_db = BuildDatabase(os.path.join(out_folder, "build.db"))
+    assigned = {}
+    merged = {"shards": count, "missing": missing, "per_shard": [], "results": []}
+    for shard, folder in sorted(shards.items()):
+        report = load_report(os.path.join(folder, "report.json"))
+        manifest = Manifest.load(os.path.join(folder, "manifest.json"))
+        root = manifest.root if root is None else root
+        for entry in manifest.entries:
+            known = manifest_entries.get(entry.path)
+            if known is None or entry.mtime > known.mtime:
+                manifest_entries[entry.path] = entry
+
+        # textures may legitimately be converted by several shards when they share them
+        for path in report["nif"]:
+            assigned.setdefault(path, []).append(shard[0])
+
+        shard_db = BuildDatabase(os.path.join(folder, "build.db"))
+        build_db.merge(shard_db)
+        shard_db.close()
+
+        shard_store = TextureStore.load(out_folder, os.path.join(folder, "index.json"))
+        texture_store.index.update(shard_store.index)
+
+        merged["results"] += report["results"]
+        merged["per_shard"].append({
+            "shard": shard[0],
+            "nif": len(report["nif"]),
+            "dds": len(report["dds"]),
+            "estimated_cost": report["estimated_cost"],
+            "seconds": report["seconds"],
+            "failed": sum(1 for result in report["results"] if result["status"] != "ok"),
+        })
+    build_db.close()
+    texture_store.save_index()
+    manifest = Manifest(root, sorted(manifest_entries.values(), key=lambda entry: entry.path))
+    manifest.save(os.path.join(out_folder, "manifest.json"))
+
+    merged["unassigned"] = [entry.path for entry in manifest.files("nif", report["mesh_prefix"])
+                            if entry.path not in assigned]
+
+    merged["duplicates"] = {path: shard_numbers for path, shard_numbers in sorted(assigned.items())
+                            if len(shard_numbers) > 1}
+    merged["failed"] = sorted(result["path"] for result in merged["results"] if result["status"] != "ok")
+    save_report(os.path.join(out_folder, "report.json"), merged)
+    return merged
+
+
+if __name__ == "__main__":
+    init()
+    parser = argparse.ArgumentParser(description='Merge the shards of a batch converted with --shard K/N.')
+    parser.add_argument('OutFolder',
+                           metavar='outfolder',
+                           type=str,
+                           help='the output folder shared by every shard')
+    args = parser.parse_args()
+
+    merged = merge(args.OutFolder)
+    for shard in merged["per_shard"]:
+        print(Fore.GREEN + "Shard " + str(shard["shard"]) + "/" + str(merged["shards"]) + ": " +
+              str(shard["nif"]) + " NIF and " + str(shard["dds"]) + " DDS files, " +
+              "{:.1f}".format(shard["estimated_cost"] / (1 << 20)) + " MB estimated, " +
+              "{:.1f}".format(shard["seconds"]) + "s, " + str(shard["failed"]) + " failed")
+    if merged["missing"]:
+        print(Fore.RED + "Missing shards: " + ", ".join(str(index) for index in merged["missing"]))
+    if merged["unassigned"]:
+        print(Fore.RED + str(len(merged["unassigned"])) + " NIF files were not converted by any shard")
+    if merged["duplicates"]:
+        print(Fore.RED + str(len(merged["duplicates"])) + " NIF files were converted by more than one shard, "
+              "the shards probably used different manifests")
+    print(Fore.YELLOW + "Merged " + str(len(merged["results"])) + " results, " + str(len(merged["failed"])) +
+          " failed, into " + os.path.join(args.OutFolder, "report.json"))
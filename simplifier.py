@@ -0,0 +1,229 @@
+import argparse
+
+import numpy as np
+
+from mesh_optimizer import weld_groups
+
+# default triangle ratios of the LOD levels below the source mesh
+DEFAULT_LOD_RATIOS = (0.5, 0.25, 0.125)
+# largest error a collapse may introduce, relative to the size of the shape
+DEFAULT_MAX_ERROR = 0.01
+# a level that keeps more than this share of the previous level's triangles isn't worth writing
+MIN_REDUCTION = 0.9
+# shapes with fewer triangles don't get LOD levels
+MIN_TRIANGLES = 64
+
+
+def parse_ratios(value):
+    """argparse type for a comma separated list of LOD ratios such as 0.5,0.25,0.125."""
+    try:
+        ratios = [float(ratio) for ratio in value.split(",") if ratio.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected comma separated ratios, for example 0.5,0.25, got " + repr(value))
+    if not ratios or any(not 0.0 < ratio < 1.0 for ratio in ratios):
+        raise argparse.ArgumentTypeError("LOD ratios have to be between 0 and 1, got " + repr(value))
+    return sorted(ratios, reverse=True)
+
+
+def triangle_quadrics(positions, triangles):
+    """Area weighted plane quadric of every triangle.
+
+    A quadric is stored as the 10 unique coefficients of the symmetric 4x4 matrix
+    [[n n^T, n d], [d n^T, d^2]] for the plane n . p + d = 0, followed by its weight."""
+    p0, p1, p2 = (positions[triangles[:, corner]] for corner in range(3))
+    normals = np.cross(p1 - p0, p2 - p0)
+    lengths = np.sqrt(np.einsum("ij,ij->i", normals, normals))
+    normals /= np.maximum(lengths, 1e-30)[:, None]
+    distances = -np.einsum("ij,ij->i", normals, p0)
+    x, y, z = normals.T
+    coefficients = np.stack([x * x, x * y, x * z, x * distances, y * y, y * z, y * distances, z * z, z * distances,
+                             distances * distances, np.ones(len(triangles))], axis=1)
+    return coefficients * (lengths / 2)[:, None]
+
+
+def vertex_quadrics(positions, triangles, vertex_count):
+    """Sum of the quadrics of the triangles around every vertex, as a (vertex_count, 11) array."""
+    quadrics = triangle_quadrics(positions, triangles)
+    result = np.zeros((vertex_count, quadrics.shape[1]))
+    for corner in range(3):
+        for column in range(quadrics.shape[1]):
+            result[:, column] += np.bincount(triangles[:, corner], weights=quadrics[:, column], minlength=vertex_count)
+    return result
+
+
+def quadric_error(quadrics, points):
+    """Mean squared distance of points to the planes of their quadrics."""
+    q = quadrics
+    x, y, z = points.T
+    error = (q[:, 0] * x * x + 2 * q[:, 1] * x * y + 2 * q[:, 2] * x * z + 2 * q[:, 3] * x + q[:, 4] * y * y +
+             2 * q[:, 5] * y * z + 2 * q[:, 6] * y + q[:, 7] * z * z + 2 * q[:, 8] * z + q[:, 9])
+    return np.abs(error) / np.maximum(q[:, 10], 1e-30)
+
+
+def locked_vertices(positions, triangles, vertex_count):
+    """Vertices the simplifier must not move.
+
+    These are vertices on open borders and on UV or normal seams, where one position is
+    split into several vertices. Both show up as edges used by only one triangle, and
+    positions shared by several vertices are locked as well for seams that end in a point."""
+    edges = np.sort(triangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1).astype(np.int64)
+    keys, counts = np.unique(edges[:, 0] * vertex_count + edges[:, 1], return_counts=True)
+    border = keys[counts != 2]
+    locked = np.zeros(vertex_count, dtype=bool)
+    locked[border // vertex_count] = True
+    locked[border % vertex_count] = True
+
+    used = np.unique(triangles)
+    rows = np.ascontiguousarray(positions[used].astype(np.float32)).view(np.dtype((np.void, 12))).ravel()
+    keys, inverse, counts = np.unique(rows, return_inverse=True, return_counts=True)
+    locked[used[counts[inverse.ravel()] > 1]] = True
+    return locked
+
+
+def collapse_candidates(positions, quadrics, locked, triangles, limit):
+    """Edge collapses that stay within the error limit, a collapse moves a source onto a target.
+    Returns (sources, targets) sorted by error."""
+    vertex_count = len(positions)
+    edges = triangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2).astype(np.int64)
+    keys = np.unique(np.concatenate([edges[:, 0] * vertex_count + edges[:, 1],
+                                     edges[:, 1] * vertex_count + edges[:, 0]]))
+    sources = keys // vertex_count
+    targets = keys % vertex_count
+    keep = ~locked[sources]
+    sources, targets = sources[keep], targets[keep]
+    errors = quadric_error(quadrics[sources] + quadrics[targets], positions[targets])
+    order = np.argsort(errors, kind="stable")
+    order = order[errors[order] <= limit]
+    return sources[order], targets[order]
+
+
+def flips(points, triangles, source, target):
+    """Whether moving source onto target turns any of the triangles around it over.
+    Triangles that contain the target disappear and aren't tested."""
+    tx, ty, tz = points[target]
+    for triangle in triangles:
+        if target in triangle:
+            continue
+        (ax, ay, az), (bx, by, bz), (cx, cy, cz) = (points[vertex] for vertex in triangle)
+        ux, uy, uz, vx, vy, vz = bx - ax, by - ay, bz - az, cx - ax, cy - ay, cz - az
+        before = (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+        if triangle[0] == source:
+            ax, ay, az = tx, ty, tz
+        elif triangle[1] == source:
+            bx, by, bz = tx, ty, tz
+        else:
+            cx, cy, cz = tx, ty, tz
+        ux, uy, uz, vx, vy, vz = bx - ax, by - ay, bz - az, cx - ax, cy - ay, cz - az
+        after = (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+        dot = before[0] * after[0] + before[1] * after[1] + before[2] * after[2]
+        # more than 60 degrees of rotation counts as a flip, small slivers fold over easily
+        if dot <= 0.5 * ((before[0] ** 2 + before[1] ** 2 + before[2] ** 2) *
+                         (after[0] ** 2 + after[1] ** 2 + after[2] ** 2)) ** 0.5:
+            return True
+    return False
+
+
+def collapse_pass(positions, quadrics, locked, triangles, target, limit, points):
+    """Collapse the cheapest edges until target triangles remain or no collapse is left.
+
+    Every collapse blocks the vertices around its source for the rest of the pass, so the
+    triangles a collapse is tested against can't change before it is applied. Returns the
+    new triangles, or None if nothing could be collapsed."""
+    vertex_count = len(positions)
+    sources, targets = collapse_candidates(positions, quadrics, locked, triangles, limit)
+    if len(sources) == 0:
+        return None
+
+    corners = triangles.ravel()
+    corner_order = (np.argsort(corners, kind="stable") // 3).tolist()
+    corner_offsets = np.concatenate([[0], np.cumsum(np.bincount(corners, minlength=vertex_count))]).tolist()
+    triangle_list = triangles.tolist()
+    blocked = [False] * vertex_count
+    removed = [False] * vertex_count
+    remap = np.arange(vertex_count)
+    collapsed_sources = []
+    collapsed_targets = []
+    needed = len(triangles) - target
+
+    for source, destination in zip(sources.tolist(), targets.tolist()):
+        if blocked[source] or removed[destination]:
+            continue
+        around = [triangle_list[triangle] for triangle in corner_order[corner_offsets[source]:corner_offsets[source + 1]]]
+        source_ring = set()
+        for triangle in around:
+            source_ring.update(triangle)
+        destination_ring = set()
+        for triangle in corner_order[corner_offsets[destination]:corner_offsets[destination + 1]]:
+            destination_ring.update(triangle_list[triangle])
+        shared = (source_ring & destination_ring) - {source, destination}
+        # link condition, more than the two opposite vertices in common would fold the surface
+        if len(shared) > 2 or flips(points, around, source, destination):
+            continue
+        for vertex in source_ring:
+            blocked[vertex] = True
+        removed[source] = True
+        remap[source] = destination
+        collapsed_sources.append(source)
+        collapsed_targets.append(destination)
+        needed -= sum(destination in triangle for triangle in around)
+        if needed <= 0:
+            break
+
+    if not collapsed_sources:
+        return None
+    quadrics[collapsed_targets] += quadrics[collapsed_sources]
+    triangles = remap[triangles]
+    keep = ((triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) &
+            (triangles[:, 2] != triangles[:, 0]))
+    return triangles[keep]
+
+
+def simplify_lods(vertex_data, indices, ratios=DEFAULT_LOD_RATIOS, max_error=DEFAULT_MAX_ERROR):
+    """Index buffers of LOD levels made by quadric error edge collapse
+    (Garland and Heckbert, Surface Simplification Using Quadric Error Metrics, 1997).
+
+    Every level targets ratio times the source triangle count and continues from the level
+    before it. Vertices collapse onto one of their neighbours, so the levels reuse the source
+    vertices unchanged, and vertices on borders and UV or normal seams are never moved.
+    A level stops early once every collapse would move the surface by more than max_error
+    times the size of the shape, and levels that barely reduce the previous one are dropped,
+    as are all levels of shapes with fewer than MIN_TRIANGLES triangles. Returns a list of (ratio, indices, error) for the levels that were kept."""
+    indices = np.asarray(indices, dtype=np.uint32)
+    if len(indices) < MIN_TRIANGLES * 3 or not ratios:
+        return []
+    first, inverse = weld_groups(vertex_data)
+    # simplify on welded vertices, bitwise duplicates would look like seams
+    triangles = first[inverse][indices].reshape(-1, 3).astype(np.int64)
+    triangles = triangles[(triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) &
+                          (triangles[:, 2] != triangles[:, 0])]
+
+    positions = vertex_data["position"].astype(np.float64)
+    vertex_count = len(positions)
+    extent = np.ptp(positions[np.unique(triangles)], axis=0).max() if len(triangles) else 0.0
+    limit = (max_error * extent) ** 2 if extent > 0 else 0.0
+    quadrics = vertex_quadrics(positions, triangles, vertex_count)
+    locked = locked_vertices(positions, triangles, vertex_count)
+    points = positions.tolist()
+
+    source_count = len(indices) // 3
+    levels = []
+    previous = len(triangles)
+    for ratio in sorted(ratios, reverse=True):
+        target = int(source_count * ratio)
+        while len(triangles) > target:
+            collapsed = collapse_pass(positions, quadrics, locked, triangles, target, limit, points)
+            if collapsed is None:
+                break
+            triangles = collapsed
+        if len(triangles) > previous * MIN_REDUCTION:
+            break
+        previous = len(triangles)
+        used = np.unique(triangles)
+        error = np.sqrt(quadric_error(quadrics[used], positions[used]).max()) / extent if extent > 0 else 0.0
+        levels.append((ratio, triangles.astype(np.uint32).ravel(), float(error)))
+    return levels
+
+
+def format_stats(stats):
+    return (" -> ".join(str(count) for count in stats["triangles"]) + " triangles in " +
+            "{:.1f}".format(stats["seconds"] * 1000) + " ms")
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import meshopt
+
+
+def test_vertex_buffer_round_trip():
+    data = np.arange(100 * 12, dtype=np.uint32).view(np.uint8).reshape(-1, 12)
+    decoded = meshopt.decode_vertex_buffer(meshopt.encode_vertex_buffer(data, 12), len(data), 12)
+    assert np.array_equal(decoded, data)
+
+
+def test_empty_vertex_buffer():
+    encoded = meshopt.encode_vertex_buffer(np.zeros((0, 16), dtype=np.uint8), 16)
+    decoded = meshopt.decode_vertex_buffer(encoded, 0, 16)
+    assert decoded.shape == (0, 16)
+    assert decoded.dtype == np.uint8
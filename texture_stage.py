@@ -0,0 +1,186 @@
+import os
+import time
+import queue
+import socket
+import threading
+import traceback
+import subprocess as sp
+from concurrent.futures import ProcessPoolExecutor
+
+from dds import convert_dds_to_png
+
+VIPS_PATH = "vips/vips.exe"
+
+# shards on other machines may convert the same texture into a shared store at the same time
+PARTIAL_SUFFIX = "." + socket.gethostname() + "-" + str(os.getpid()) + ".partial.png"
+
+
+def convert_with_vips(source, output):
+    popen_kwargs = {}
+    if hasattr(sp, "STARTUPINFO"):
+        startupinfo = sp.STARTUPINFO()
+        startupinfo.dwFlags |= sp.STARTF_USESHOWWINDOW
+        popen_kwargs["startupinfo"] = startupinfo
+    returncode = sp.call([VIPS_PATH, "affine", source, output, ' 1 0 0 1'], **popen_kwargs)
+    if returncode != 0:
+        raise RuntimeError("vips exited with code " + str(returncode))
+
+
+CONVERTERS = {
+    "native": convert_dds_to_png,
+    "vips": convert_with_vips,
+}
+
+
+class TextureStage:
+    """Converts DDS textures into the texture store with a bounded producer/consumer pipeline.
+
+    A producer thread hashes the texture entries and queues one job per texture that still
+    has to be converted. The queue holds at most `backlog` jobs, so hashing blocks instead
+    of running ahead of conversion. `workers` consumer threads take jobs from the queue and
+    convert them, either in the thread itself or, with processes=True, on a process pool of
+    the same size. Results are yielded in completion order."""
+
+    def __init__(self, texture_store, workers, converter="native", processes=False, backlog=None):
+        self.texture_store = texture_store
+        self.workers = max(1, workers)
+        self.converter = CONVERTERS[converter]
+        self.processes = processes
+        self.jobs = queue.Queue(maxsize=self.workers * 2 if backlog is None else max(1, backlog))
+        self.results = queue.Queue()
+
+        self.unique = 0
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def produce(self, entries, hash_for, source_for, rebuild):
+        seen = set()
+        try:
+            for entry in entries:
+                try:
+                    job = self.job_for(entry, hash_for, source_for, rebuild, seen)
+                except Exception as err:
+                    # reported like a failed conversion, the other textures go on
+                    self.results.put({"job": {"entry": entry}, "status": "error", "error": str(err),
+                                      "traceback": traceback.format_exc(), "thread": threading.get_ident(),
+                                      "seconds": 0.0})
+                    continue
+                if job is not None:
+                    # blocks while the backlog is full
+                    self.jobs.put(job)
+        finally:
+            for _ in range(self.workers):
+                self.jobs.put(None)
+
+    def job_for(self, entry, hash_for, source_for, rebuild, seen):
+        """Conversion job of an entry, or None if its texture is a duplicate or already stored."""
+        content_hash = hash_for(entry)
+        if content_hash is None:
+            raise OSError("can't read " + source_for(entry))
+        self.texture_store.index[entry.path.lower()] = content_hash
+        if content_hash in seen:
+            return None
+        seen.add(content_hash)
+        self.unique += 1
+        if not rebuild and self.texture_store.has(content_hash):
+            self.skipped += 1
+            return None
+
+        output_path = self.texture_store.path(content_hash)
+        if not os.path.exists(os.path.dirname(output_path)):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        return {
+            "entry": entry,
+            "hash": content_hash,
+            "source": source_for(entry),
+            "output": output_path,
+            # converted next to the final name and renamed once complete,
+            # so the store never has partial files
+            "partial": output_path[:-len(".png")] + PARTIAL_SUFFIX,
+        }
+
+    def consume(self, executor):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.results.put(None)
+                return
+            result = {"job": job, "status": "ok", "error": "", "thread": threading.get_ident()}
+            start = time.perf_counter()
+            try:
+                if executor is None:
+                    self.converter(job["source"], job["partial"])
+                else:
+                    executor.submit(self.converter, job["source"], job["partial"]).result()
+                os.replace(job["partial"], job["output"])
+            except Exception as err:
+                result["status"] = "error"
+                result["error"] = str(err)
+                result["traceback"] = traceback.format_exc()
+                if os.path.isfile(job["partial"]):
+                    os.remove(job["partial"])
+            result["seconds"] = time.perf_counter() - start
+            self.results.put(result)
+
+    def run(self, entries, hash_for, source_for, rebuild=False):
+        """Convert every texture in entries that is not in the store yet.
+
+        hash_for(entry) returns the content hash of an entry and source_for(entry) its path
+        on disk. Yields one result dict per converted texture."""
+        self.started_at = time.perf_counter()
+        executor = ProcessPoolExecutor(self.workers) if self.processes else None
+        threads = [threading.Thread(target=self.produce, args=(entries, hash_for, source_for, rebuild), daemon=True)]
+        threads += [threading.Thread(target=self.consume, args=(executor,), daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        running = self.workers
+        try:
+            while running:
+                result = self.results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                # only successful conversions count towards the throughput
+                if result["status"] == "ok":
+                    self.completed += 1
+                    self.bytes_in += result["job"]["entry"].size
+                else:
+                    self.failed += 1
+                yield result
+        finally:
+            for thread in threads:
+                thread.join()
+            if executor is not None:
+                executor.shutdown()
+            self.finished_at = time.perf_counter()
+
+    @property
+    def queue_depth(self):
+        return self.jobs.qsize()
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return end - self.started_at
+
+    def images_per_second(self):
+        elapsed = self.elapsed()
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    def status(self):
+        return ("queue: " + str(self.queue_depth) + ", " + "{:.1f}".format(self.images_per_second()) + " images/s")
+
+    def summary(self):
+        elapsed = self.elapsed()
+        megabytes = self.bytes_in / (1 << 20)
+        return (str(self.unique) + " unique textures, " + str(self.skipped) + " already in the store, " +
+                str(self.completed) + " converted, " + str(self.failed) + " failed in " +
+                "{:.1f}".format(elapsed) + "s on " + str(self.workers) + " workers, " +
+                "{:.1f}".format(self.images_per_second()) + " images/s, " +
+                "{:.1f}".format(megabytes / elapsed if elapsed > 0 else 0.0) + " MB/s")
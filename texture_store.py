@@ -0,0 +1,67 @@
+import os
+import json
+
+from build_db import file_hash
+
+STORE_FOLDER = "textures/store"
+
+
+class TextureStore:
+    """Content addressed store for converted textures.
+
+    Every unique DDS is converted once to <out>/textures/store/<ab>/<hash>.png, where
+    hash is the content hash of the source. GLTF files reference the stored PNG through
+    a URI relative to the GLTF file, so the output tree can be moved as a whole.
+
+    The index maps a texture path as written in the NIF (lower case, forward slashes,
+    relative to the texture root) to its content hash."""
+
+    out_folder = ""
+    index = None
+    index_path = ""
+
+    def __init__(self, out_folder, index=None, index_path=None):
+        self.out_folder = out_folder
+        self.index = {} if index is None else dict(index)
+        # sharded runs keep their own index and merge them afterwards
+        self.index_path = (os.path.join(out_folder, *STORE_FOLDER.split("/"), "index.json")
+                           if index_path is None else index_path)
+
+    def relpath(self, content_hash):
+        """Path of a stored texture relative to the output folder, with forward slashes."""
+        return STORE_FOLDER + "/" + content_hash[:2] + "/" + content_hash + ".png"
+
+    def path(self, content_hash):
+        return os.path.join(self.out_folder, *self.relpath(content_hash).split("/"))
+
+    def has(self, content_hash):
+        return os.path.isfile(self.path(content_hash))
+
+    def hash_for(self, texture_path, source_path):
+        """Content hash of a referenced texture, hashing the source if the index doesn't know it.
+        Returns None when the source texture doesn't exist."""
+        content_hash = self.index.get(texture_path)
+        if content_hash is None and os.path.isfile(source_path):
+            content_hash = file_hash(source_path)
+            self.index[texture_path] = content_hash
+        return content_hash
+
+    def uri(self, content_hash, gltf_path):
+        """URI of a stored texture relative to the folder of the GLTF file that uses it."""
+        relative = os.path.relpath(self.path(content_hash), os.path.dirname(os.path.abspath(gltf_path)))
+        return relative.replace("\\", "/")
+
+    def save_index(self):
+        if not os.path.exists(os.path.dirname(self.index_path)):
+            os.makedirs(os.path.dirname(self.index_path))
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, sort_keys=True, separators=(",", ":"))
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    @classmethod
+    def load(cls, out_folder, index_path=None):
+        store = cls(out_folder, index_path=index_path)
+        if os.path.isfile(store.index_path):
+            with open(store.index_path) as f:
+                store.index = json.load(f)
+        return store
@@ -0,0 +1,291 @@
+import os
+import time
+import traceback
+import collections
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+from colorama import Fore
+
+# a slot whose worker dies this many times in a row without taking a job isn't restarted again,
+# such as when the conversion libraries fail to import
+MAX_IDLE_RESTARTS = 3
+
+# sent by a worker once the conversion stack is imported, it only gets jobs from then on
+READY = "ready"
+
+
+def job_result(job_id, path, worker_id, pid):
+    """Result message of a job before it has run, failed jobs are sent with these defaults."""
+    return {
+        "job": job_id,
+        "path": path,
+        "worker": worker_id,
+        "pid": pid,
+        "outputs": [],
+        "textures": [],
+        "texture_hashes": {},
+        "repaired_normals": 0,
+        "rescaled_normals": 0,
+        "optimize": [],
+        "compress": None,
+        "lod": [],
+        "instanced": 0,
+        "geometry_cached": False,
+        "flatten": None,
+        "hash": None,
+    }
+
+
+def failed_result(job_id, path, worker_id, pid, error, seconds=0.0):
+    return dict(job_result(job_id, path, worker_id, pid), status="error", error=error, seconds=seconds)
+
+
+def worker_main(worker_id, conn, options):
+    """Long lived conversion worker. The conversion stack (pyffi, numpy, mathutils, wand)
+    is imported once per worker and reused for every NIF the pool sends over its pipe."""
+    import file_process
+    from build_db import file_hash
+    from texture_store import TextureStore
+
+    texture_store = TextureStore(options["out_folder"], options["texture_index"])
+    conn.send(READY)
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        job_id, path = task
+        result = job_result(job_id, path, worker_id, os.getpid())
+        start = time.perf_counter()
+        try:
+            result["hash"] = file_hash(path)
+            niffile = file_process.convert_nif(path, options["texture_root"], options["in_folder"],
+                                               options["out_folder"], options["unrealmode"], texture_store,
+                                               content_hash=result["hash"], **options["convert_options"])
+            result["status"] = "ok"
+            result["outputs"] = [path for path in (niffile.gltf_path, niffile.bin_path) if path]
+            result["textures"] = sorted(niffile.texture_dependencies)
+            # hashes the worker already computed, so the main process doesn't read those files again
+            result["texture_hashes"] = {texture: texture_store.index.get(texture) for texture in result["textures"]}
+            result["repaired_normals"] = niffile.repaired_normals
+            result["rescaled_normals"] = niffile.rescaled_normals
+            result["optimize"] = niffile.optimize_stats
+            result["compress"] = niffile.compression_stats
+            result["lod"] = niffile.lod_stats
+            result["instanced"] = niffile.instanced_shapes
+            result["geometry_cached"] = niffile.geometry_cached
+            result["flatten"] = niffile.flatten_stats if niffile.flatten else None
+        except Exception as err:
+            result["status"] = "error"
+            result["error"] = str(err)
+            result["traceback"] = traceback.format_exc()
+        result["seconds"] = time.perf_counter() - start
+
+        try:
+            conn.send(result)
+        except Exception as err:
+            # nothing was written if the result doesn't pickle, report the job as failed instead
+            conn.send(failed_result(job_id, path, worker_id, os.getpid(),
+                                    "could not send the result: " + str(err), result["seconds"]))
+
+
+class WorkerPool:
+    """A fixed set of worker processes that convert NIF paths.
+
+    Every worker has its own pipe, submitted jobs wait in the pool and are sent to a worker
+    that is ready and has nothing to do, so the pool always knows which worker holds a job.
+    Results come back as dictionaries through next_result(), one per submitted path,
+    with "status" set to "ok" or "error". A worker that dies mid job is replaced and
+    its job is reported as an error instead of being lost. A slot whose worker keeps dying
+    before it takes a job is given up after MAX_IDLE_RESTARTS, and once no worker is left the
+    queued jobs are failed and next_result raises RuntimeError."""
+
+    context = None
+    options = None
+
+    def __init__(self, worker_count, texture_root, in_folder, out_folder, unrealmode=False, texture_index=None,
+                 convert_options=None):
+        # spawn everywhere so linux workers behave like the windows ones
+        self.context = mp.get_context("spawn")
+        self.options = {
+            "texture_root": texture_root,
+            "in_folder": in_folder,
+            "out_folder": out_folder,
+            "unrealmode": unrealmode,
+            "texture_index": {} if texture_index is None else texture_index,
+            # keyword options for file_process.convert_nif
+            "convert_options": {} if convert_options is None else convert_options,
+        }
+
+        self.workers = {}
+        self.connections = {}
+        self.jobs = {}
+        # submitted jobs that no worker has been sent yet
+        self.queued = collections.deque()
+        # workers that are ready for a job and the job every busy worker was sent
+        self.idle = set()
+        self.assigned = {}
+        # results ready to be returned: jobs failed by the pool and results drained from dead workers
+        self.failed = []
+        # deaths without a job since the last result of every slot
+        self.idle_deaths = {}
+        self.next_job = 0
+
+        for worker_id in range(max(1, worker_count)):
+            self.start_worker(worker_id)
+
+    @property
+    def worker_count(self):
+        return len(self.workers)
+
+    @property
+    def outstanding(self):
+        return len(self.jobs) + len(self.failed)
+
+    def start_worker(self, worker_id):
+        conn, worker_conn = self.context.Pipe()
+        process = self.context.Process(target=worker_main, args=(worker_id, worker_conn, self.options), daemon=True)
+        process.start()
+        worker_conn.close()
+        self.workers[worker_id] = process
+        self.connections[worker_id] = conn
+        print(Fore.BLUE + "PID: [" + str(process.pid) + "] Started conversion worker " + str(worker_id))
+
+    def submit(self, path):
+        job_id = self.next_job
+        self.next_job += 1
+        self.jobs[job_id] = path
+        self.queued.append(job_id)
+        self.dispatch()
+        return job_id
+
+    def dispatch(self):
+        """Send queued jobs to idle workers, recording the owner before the job leaves."""
+        while self.queued and self.idle:
+            worker_id = self.idle.pop()
+            job_id = self.queued.popleft()
+            self.assigned[worker_id] = job_id
+            try:
+                self.connections[worker_id].send((job_id, self.jobs[job_id]))
+            except OSError:
+                # the worker is gone, its sentinel restarts it and the job waits for another one
+                del self.assigned[worker_id]
+                self.queued.appendleft(job_id)
+
+    def receive(self, worker_id, conn):
+        """The next result message of a worker, None if it only reported being ready.
+        Raises EOFError once its pipe is closed."""
+        message = conn.recv()
+        if message == READY:
+            self.idle.add(worker_id)
+            return None
+        self.assigned.pop(worker_id, None)
+        self.idle.add(worker_id)
+        self.jobs.pop(message["job"], None)
+        self.idle_deaths[worker_id] = 0
+        return message
+
+    def restart_worker(self, worker_id):
+        """Replace a worker that exited unexpectedly and fail the job it was running.
+        Slots that keep dying without a job are given up instead."""
+        process = self.workers.pop(worker_id)
+        process.join()
+        conn = self.connections.pop(worker_id)
+        # a result sent right before dying is still in the pipe
+        try:
+            while conn.poll():
+                message = self.receive(worker_id, conn)
+                if message is not None:
+                    self.failed.append(message)
+        except EOFError:
+            pass
+        conn.close()
+        self.idle.discard(worker_id)
+
+        job_id = self.assigned.pop(worker_id, None)
+        if job_id is not None:
+            self.failed.append(failed_result(job_id, self.jobs.pop(job_id), worker_id, process.pid,
+                                             "worker exited with code " + str(process.exitcode)))
+        else:
+            self.idle_deaths[worker_id] = self.idle_deaths.get(worker_id, 0) + 1
+
+        if self.idle_deaths.get(worker_id, 0) >= MAX_IDLE_RESTARTS:
+            print(Fore.RED + "PID: [" + str(process.pid) + "] Worker " + str(worker_id) + " died " +
+                  str(MAX_IDLE_RESTARTS) + " times without taking a job (exit code " + str(process.exitcode) +
+                  "), giving up")
+            return
+        print(Fore.RED + "PID: [" + str(process.pid) + "] Worker " + str(worker_id) +
+              " died with exit code " + str(process.exitcode) + ", restarting")
+        self.start_worker(worker_id)
+
+    def fail_queued(self, error):
+        """Fail every job that hasn't finished, there is no worker left to take them."""
+        for job_id, path in sorted(self.jobs.items()):
+            self.failed.append(failed_result(job_id, path, -1, None, error))
+        self.jobs = {}
+        self.queued.clear()
+
+    def next_result(self):
+        """Block until a submitted job finishes and return its result message."""
+        if not self.outstanding:
+            raise RuntimeError("no outstanding jobs")
+
+        while True:
+            if self.failed:
+                return self.failed.pop(0)
+            self.dispatch()
+
+            # wake up on either a finished job or a worker exiting, there is no polling
+            ready = wait(list(self.connections.values()) +
+                         [process.sentinel for process in self.workers.values()])
+            for worker_id, conn in self.connections.items():
+                if conn in ready and conn.poll():
+                    try:
+                        message = self.receive(worker_id, conn)
+                    except EOFError:
+                        # the worker is gone, its sentinel handles the restart
+                        continue
+                    if message is not None:
+                        return message
+            for worker_id, process in list(self.workers.items()):
+                if process.sentinel in ready:
+                    self.restart_worker(worker_id)
+            if not self.workers:
+                error = "every conversion worker died without taking a job, see the worker output above"
+                self.fail_queued(error)
+                raise RuntimeError(error)
+
+    def results(self):
+        """Yield results until every submitted job has finished."""
+        while self.outstanding:
+            yield self.next_result()
+
+    def close(self):
+        for conn in self.connections.values():
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for process in self.workers.values():
+            process.join()
+        for conn in self.connections.values():
+            conn.close()
+        self.workers = {}
+        self.connections = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for process in self.workers.values():
+                process.terminate()
+            self.workers = {}
+        return False